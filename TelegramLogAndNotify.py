@@ -1,42 +1,134 @@
 from pyrogram import Client, Filters, RawUpdateHandler
 from pyrogram.api import functions, types
-from pyrogram.api.errors import FloodWait
 import time
 from datetime import datetime
-import configparser, pymysql_pool
+import configparser, pymysql_pool, storage
+import message_writer, admin_cache, notifier, pipeline, backfill, metrics, update_recorder, chat_registry, entity_cache, message_cache, media_archive, alert_rules, journal, error_log, read_api, retention, profiler, gap_recovery
+import threading
+import argparse, json, os, signal
 import sys, traceback
 import urllib.request as urlreq
-import requests
 
 class TelegramBot():
 
-    def __init__(self):
+    def __init__(self, client=None):
         
-        self.client = Client("Listener")
+        self.configPath = "config.ini"
+        self.errorLog = error_log.ErrorLog()
+        # One client per account session, self.client is the first one and serves the menu
+        self.client = None
+        self.clients = {}
+        self.sessionNames = {}
+        if client:
+            self.addClient(chat_registry.DEFAULT_SESSION, client)
         
-        self.client.add_handler(RawUpdateHandler(self.processUpdate))
+        self.updateCount = metrics.registry.counter("telegram_updates_total", "Raw updates received from Telegram, by type", ["type"])
+        self.adminCheckTime = metrics.registry.histogram("telegram_admin_check_seconds", "Time spent deciding whether a sender is an admin", ["chat_type"])
+        self.pinnedFetchTime = metrics.registry.histogram("telegram_pinned_fetch_seconds", "Time spent fetching pinned messages")
+        self.recordTime = metrics.registry.histogram("telegram_record_seconds", "Time spent handing a message to the database writer")
+        self.notifyTime = metrics.registry.histogram("telegram_notify_seconds", "Time spent handing a notification to the dispatcher")
+        self.pinLookups = metrics.registry.counter("telegram_pin_lookups_total", "Pinned messages by where they were found", ["source"])
         
-    def run(self):
+    def run(self, daemon=False):
     
         self.config = configparser.ConfigParser()
         try:
-            self.config.read("config.ini")
+            self.config.read(self.configPath)
         except:
             self.logError("Error while loading the config file, exiting", True)
+        self.errorLog.window = self.config.getfloat("errors", "dedup_window", fallback=60)
         
+        self.setupClients()
         self.setupDBConnection()
+        self.setupEntityCache()
+        self.setupAdminCache()
+        self.setupMessageCache()
+        self.setupMedia()
+        self.setupNotifier()
+        self.setupAlerts()
+        self.setupProfiling()
+        self.setupPipeline()
+        self.setupRecovery()
+        self.setupMetrics()
+        self.setupRetention()
+        self.setupReadAPI()
+        self.setupRecorder()
+        self.setupChatRegistry()
+        
+        daemon = daemon or self.config.getboolean("daemon", "enabled", fallback=False)
+        self.listening = False
+        # A daemon with a snapshot listens as soon as the clients are connected and catches up with Telegram afterwards
+        warm = daemon and self.loadSnapshot()
+        self.listening = warm
         
         print("\nStarting Telegram API connection\n")
-        self.client.start()
-        print("API connection started")
+        for session, client in self.clients.items():
+            client.start()
+            print("API connection started for " + session)
         
-        self.listening = False
-        self.chats = self.getChats()
-        self.monitoredChats = self.loadMonitoredChatsTable()
+        if warm:
+            threading.Thread(target=self.reconcile, name="Reconcile", daemon=True).start()
+        else:
+            self.chats = self.getChats()
+            self.monitoredChats = self.loadMonitoredChatsTable()
+            if daemon:
+                print("\nStarted listening for updates\n")
+                self.listening = True
+            else:
+                self.menu()
+            self.getAdmins()
+            
+        self.updateAdmins()
+        
+        if self.recovery:
+            threading.Thread(target=self.catchUp, name="CatchUp", daemon=True).start()
         
-        self.menu()
+        if self.config.getboolean("backfill", "on_start", fallback=False):
+            threading.Thread(target=self.backfill, args=(list(self.monitoredChats),), name="Backfill", daemon=True).start()
             
         self.client.idle()
+        for client in self.clients.values():
+            if client is not self.client:
+                client.stop()
+        
+        self.shutdown()
+        
+    def shutdown(self):
+        
+        print("\nShutting down")
+        metrics.registry.stop()
+        if self.readAPI:
+            self.readAPI.stop()
+        if self.retention:
+            self.retention.stop()
+        self.cancelResync()
+        if self.recovery:
+            self.recovery.stop()
+        self.pipeline.stop()
+        self.pinFetcher.stop()
+        self.adminCache.stop()
+        if self.notifier:
+            self.notifier.stop()
+        if self.alerts:
+            self.alerts.stop()
+        if self.media:
+            self.media.stop()
+        self.writer.stop()
+        # Everything the saved state covers is stored by now
+        if self.updateState:
+            self.updateState.stop()
+        if hasattr(self, "pool"):
+            stats = self.pool.stats()
+            print("Connection pool - " + str(stats["checkouts"]) + " checkouts, " + str(stats["waits"]) + " waited, " + str(stats["creations"]) + " connections created, " + str(stats["failures"]) + " failed, " + str(stats["evictions"]) + " evicted")
+        self.storage.close()
+        try:
+            self.entities.save()
+        except:
+            self.logError("Error while saving the entity cache")
+        self.saveSnapshot()
+        if self.recorder:
+            self.recorder.close()
+        self.errorLog.close()
         
     def menu(self):
         
@@ -47,6 +139,10 @@ all - show a list of joined chats/channels/groups in the account
 listening - show a list of joined chats/channels/groups we are listening to for updates
 add - add hats/channels/groups to the listening list, pass comma-separated list of usernames or ids
 remove - remove chats/channels/groups from the listening list, pass comma-separated list of usernames or ids
+backfill - record the history of monitored chats/channels/groups, optionally pass comma-separated list of usernames or ids
+search - search recorded messages, pass words to look for and optionally chat:<username or id> type:<channel|admin|pinned> since:<YYYY-MM-DD> until:<YYYY-MM-DD>
+more - show the next page of the last search
+profile - sample the stacks of all threads into a flamegraph file, optionally pass the number of seconds
 
 start - start listening for updates
 '''  
@@ -66,9 +162,8 @@ start - start listening for updates
                     
                 elif (command == "all"):
                     print("\nTITLE - USERNAME - ID")
-                    for chatID in self.chats:
-                        chat = self.chats[chatID]
-                        print(chat[0] + " - " + chat[1] + " - " + str(chatID))
+                    for chatID, chat in self.chats.items():
+                        print(chat[0] + " - " + chat[1] + " - " + str(chatID) + (" - " + self.chats.owner(chatID) if len(self.clients) > 1 else ""))
                         
                 elif (command == "listening"):
                     if len(self.monitoredChats) > 0:
@@ -95,6 +190,41 @@ start - start listening for updates
                     items = [i.strip() for i in items if i.strip() != ""]
                     self.removeChats(items)
                     
+                elif (command == "backfill"):
+                    if len(inputSplit) == 1:
+                        self.backfill(list(self.monitoredChats))
+                        continue
+                    items = inputSplit[1].split(",")
+                    items = [i.strip() for i in items if i.strip() != ""]
+                    chatIDs = []
+                    for item in items:
+                        if (item[0] == "@"):
+                            item = self.chats.byUsername(item)
+                        elif item.isdigit():
+                            item = int(item)
+                        if item not in self.monitoredChats:
+                            print("Not monitored, add it first: " + str(item))
+                            continue
+                        chatIDs.append(item)
+                    self.backfill(chatIDs)
+                    
+                elif (command == "search"):
+                    if len(inputSplit) == 1:
+                        print("No arguments provided")
+                        continue
+                    self.search(inputSplit[1])
+                    
+                elif (command == "more"):
+                    if not getattr(self, "lastSearch", None):
+                        print("No search to continue")
+                        continue
+                    self.showSearchPage()
+                    
+                elif (command == "profile"):
+                    duration = float(inputSplit[1]) if len(inputSplit) > 1 else self.profileDuration
+                    if not self.profiler.start(duration):
+                        print("A profile is already being taken")
+                    
                 else:
                     print("Sorry, the command was not recognized")
                     
@@ -104,62 +234,74 @@ start - start listening for updates
                     
     def setupDBConnection(self):
     
-        host = self.config["database"]["host"]
-        user = self.config["database"]["user"]
-        password = self.config["database"]["password"]
-        db = self.config["database"]["db"]
-        charset = self.config["database"]["charset"]
-        dbsettings = {"host": host, "user": user, "password": password, "db": db, "charset": charset}
+        self.openStorage()
+        self.checkTables()
+        self.setupWriter()
+        
+    def openStorage(self, readOnly=False):
+    
+        self.tables = {tableType: self.config.get("database", tableType + "_table", fallback=tableType + "table") for tableType in ("chat", "message", "sender", "backfill", "schema", "media", "alert", "archive", "state", "archived")}
+        backend = self.config.get("database", "backend", fallback="mysql")
+        
         try:
-            self.pool = pymysql_pool.ConnectionPool(size=1, name='pool', **dbsettings)
+            if backend == "sqlite":
+                path = self.config.get("database", "sqlite_path", fallback="telegram.db")
+                self.storage = storage.SQLiteStorage(path, self.tables, readOnly)
+            else:
+                host = self.config["database"]["host"]
+                user = self.config["database"]["user"]
+                password = self.config["database"]["password"]
+                db = self.config["database"]["db"]
+                charset = self.config["database"]["charset"]
+                dbsettings = {"host": host, "user": user, "password": password, "db": db, "charset": charset}
+                minSize = self.config.getint("database", "pool_min_size", fallback=1)
+                maxSize = self.config.getint("database", "pool_max_size", fallback=4)
+                idleTimeout = self.config.getint("database", "pool_idle_timeout", fallback=300)
+                pingAfter = self.config.getint("database", "pool_ping_after", fallback=30)
+                if readOnly:
+                    dbsettings["init_command"] = "SET SESSION TRANSACTION READ ONLY"
+                self.pool = pymysql_pool.ConnectionPool(size=minSize, name='pool', max_size=maxSize, idle_timeout=idleTimeout, ping_after=pingAfter, **dbsettings)
+                partitionByMonth = self.config.getboolean("database", "partition_by_month", fallback=False)
+                partitionMonthsAhead = self.config.getint("database", "partition_months_ahead", fallback=3)
+                self.storage = storage.MySQLStorage(self.pool, self.tables, partitionByMonth, partitionMonthsAhead)
         except:
             self.logError("Error while attempting to connect to database, exiting\n", True)
         print("Database connection established")
         
-        self.checkTables()
-        
     def checkTables(self):
         
-        self.chatTable = self.config["database"]["chat_table"]
-        self.messageTable = self.config["database"]["message_table"]
-        
-        tables = {}
-        tables["chat"] = {"name": self.chatTable, "statement": "(ID int unsigned not null, Title varchar(255), Username varchar(255), PRIMARY KEY (ID))"}
-        tables["message"] = {"name": self.messageTable, "statement": "(ID int unsigned not null auto_increment, Time datetime, Type varchar(255), Chat int unsigned not null, Sender varchar(255), Message text, PRIMARY KEY(ID), FOREIGN KEY (Chat) REFERENCES " + self.chatTable + "(ID))"}
-
-        connection = self.pool.get_connection()
-        c = connection.cursor()
+        try:
+            self.storage.ensureSchema()
+        except:
+            self.logError("Error while checking tables in database\n", True)
         
-        for tableType in tables:
+    def setupWriter(self):
         
-            table = tables[tableType]
-            
+        batchSize = self.config.getint("writer", "batch_size", fallback=500)
+        flushInterval = self.config.getfloat("writer", "flush_interval", fallback=1.0)
+        queueSize = self.config.getint("writer", "queue_size", fallback=10000)
+        report = self.config.getboolean("writer", "report", fallback=False)
+        path = self.config.get("journal", "path", fallback="journal")
+        if path:
+            segmentSize = self.config.getint("journal", "segment_size", fallback=16 * 1024 * 1024)
+            syncInterval = self.config.getfloat("journal", "sync_interval", fallback=0.2)
             try:
-                c.execute("SHOW TABLES LIKE '" + table["name"] + "'")
-                result = c.fetchone()
+                self.journal = journal.Journal(path, segmentSize, syncInterval).open()
             except:
-                self.logError("Error while looking for " + tableType + " table (" + table["name"] + ") in database\n", True)
-                
-            if result:
-                print("Found " + tableType + " table (" + table["name"] + ")")
-            else:
-                print("Creating " + tableType + " table (" + table["name"] + ")")
-                try:
-                    c.execute("CREATE TABLE " + table["name"] + " " + table["statement"])
-                    connection.commit()
-                except:
-                    self.logError("Error while creating " + tableType + " table (" + table["name"] + ")\n", True)
-                    
-        connection.close()
+                self.logError("Error while opening the journal, exiting\n", True)
+            if self.journal.pending():
+                print("Journal holds " + str(self.journal.backlogBytes()) + " bytes of messages from an earlier run, writing them to the database")
+        else:
+            self.journal = None
+        replayBatchSize = self.config.getint("journal", "replay_batch_size", fallback=5000)
+        retryInterval = self.config.getfloat("journal", "retry_interval", fallback=5.0)
+        poisonRetries = self.config.getint("journal", "poison_retries", fallback=3)
+        self.writer = message_writer.MessageWriter(self.storage, self.logError, batchSize, flushInterval, queueSize, report, self.journal, replayBatchSize, retryInterval, poisonRetries=poisonRetries)
+        self.writer.start()
         
     def loadMonitoredChatsTable(self):
         try:
-            connection = self.pool.get_connection()
-            c = connection.cursor()
-            c.execute("SELECT * FROM " + self.chatTable)
-            chats = list(c)
-            self.monitoredChats = {chat[0]: [chat[1], chat[2]] for chat in chats}
-            connection.close()
+            self.monitoredChats = self.storage.loadMonitoredChats()
         except:
             self.logError("Error while getting list of monitored chats/channels/groups from database")
         
@@ -169,39 +311,168 @@ start - start listening for updates
         
     def cleanUpMonitored(self):
         delete = []
-        for monitored in self.monitoredChats:
+        for monitored in list(self.monitoredChats):
             if monitored not in self.chats:
                 delete.append(monitored)
         if len(delete) > 0:
             try:
-                connection = self.pool.get_connection()
-                c = connection.cursor()
+                self.storage.deleteChats(delete)
                 for id in delete:
-                    c.execute("DELETE FROM " + self.chatTable + " WHERE ID=" + str(id))
                     del self.monitoredChats[id]
-                connection.commit()
-                connection.close()
             except:
                 self.logError("Error while clearing a monitored chat we no longer are a member of")
                 
         
+    def setupClients(self):
+        
+        sessions = [session.strip() for session in self.config.get("accounts", "sessions", fallback=chat_registry.DEFAULT_SESSION).split(",") if session.strip()]
+        for session in sessions:
+            if session not in self.clients:
+                self.addClient(session, Client(session))
+        if len(self.clients) > 1:
+            print("Listening with " + str(len(self.clients)) + " accounts: " + ", ".join(self.clients))
+            
+    def addClient(self, session, client):
+        self.clients[session] = client
+        self.sessionNames[id(client)] = session
+        if self.client is None:
+            self.client = client
+        client.add_handler(RawUpdateHandler(self.processUpdate))
+        
+    def sessionOf(self, client):
+        return self.sessionNames.get(id(client), chat_registry.DEFAULT_SESSION)
+        
+    def sessionFor(self, chatID):
+        # The account that handles a chat, the first one for chats no account has joined
+        owner = self.chats.owner(chatID)
+        return owner if owner in self.clients else self.sessionOf(self.client)
+        
+    def clientFor(self, chatID):
+        return self.clients[self.sessionFor(chatID)]
+        
     def getChats(self):
-        chats = self.client.send(functions.messages.GetAllChats([]))
-        self.chats = chats.chats
-        self.supergroupIDs = [chat.id for chat in self.chats if isinstance(chat, types.Channel) and chat.megagroup == True]
-        self.chats = {chat.id: [str(chat.title), ("@" if hasattr(chat, "username") and chat.username else "")+(str(chat.username) if hasattr(chat, "username") else "None")] for chat in self.chats} 
+        for session, client in self.clients.items():
+            chats = client.send(functions.messages.GetAllChats([]))
+            self.chats.replaceAll(chats.chats, session)
         return self.chats
         
+    def setupChatRegistry(self):
+        
+        self.chats = chat_registry.ChatRegistry()
+        self.resyncDelay = self.config.getfloat("chats", "resync_delay", fallback=60)
+        self.resyncTimer = None
+        self.resyncLock = threading.Lock()
+        
+    def updateChannel(self, channelID, chats, session):
+        # Only the channel named in the update is refreshed, a full GetAllChats follows once the burst is over
+        self.entities.forget("chat", channelID)
+        chat = chats.get(channelID)
+        if chat is None:
+            try:
+                chat = self.fetchChannel(channelID, session)
+            except:
+                # No access to the channel any more
+                chat = None
+        if chat is None:
+            self.chats.remove(channelID, session)
+        else:
+            self.chats.apply(chat, session)
+        
+        if channelID in self.monitoredChats:
+            if channelID not in self.chats:
+                self.cleanUpMonitored()
+            elif list(self.chats[channelID][:2]) != list(self.monitoredChats[channelID]):
+                self.updateMonitoredChatsList([channelID], "add")
+        self.scheduleResync()
+        
+    def fetchChannel(self, channelID, session):
+        peer = self.resolvePeer(channelID, session)
+        result = self.clients[session].send(functions.channels.GetChannels(id=[types.InputChannel(channel_id=peer.channel_id, access_hash=peer.access_hash)]))
+        return next((chat for chat in result.chats if chat.id == channelID), None)
+        
+    def scheduleResync(self):
+        if self.resyncDelay <= 0:
+            return
+        with self.resyncLock:
+            if self.resyncTimer:
+                return
+            self.resyncTimer = threading.Timer(self.resyncDelay, self.resyncChats)
+            self.resyncTimer.daemon = True
+            self.resyncTimer.start()
+            
+    def cancelResync(self):
+        with self.resyncLock:
+            if self.resyncTimer:
+                self.resyncTimer.cancel()
+                self.resyncTimer = None
+        
+    def resyncChats(self):
+        with self.resyncLock:
+            self.resyncTimer = None
+        try:
+            self.getChats()
+            self.cleanUpMonitored()
+        except:
+            self.logError("Error while refreshing the list of joined chats/channels/groups")
+        self.saveSnapshot()
+        
+    def loadSnapshot(self):
+        path = self.config.get("daemon", "snapshot_path", fallback="")
+        if not path or not os.path.exists(path):
+            return False
+        try:
+            with open(path) as file:
+                snapshot = json.load(file)
+            self.chats.restore(snapshot["chats"])
+            self.monitoredChats = {chatID: [title, username] for chatID, title, username in snapshot["monitored"]}
+        except:
+            self.logError("Error while loading the chat snapshot, starting cold")
+            self.chats = chat_registry.ChatRegistry()
+            return False
+        print("Loaded snapshot of " + str(len(self.chats)) + " chats, " + str(len(self.monitoredChats)) + " monitored, saved " + snapshot["saved"])
+        print("\nStarted listening for updates\n")
+        return True
+        
+    def saveSnapshot(self):
+        path = self.config.get("daemon", "snapshot_path", fallback="")
+        if not path or not hasattr(self, "monitoredChats"):
+            return
+        snapshot = {
+            "saved": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "chats": self.chats.snapshot(),
+            "monitored": [[chatID, chat[0], chat[1]] for chatID, chat in list(self.monitoredChats.items())]
+        }
+        try:
+            temporary = path + ".tmp"
+            with open(temporary, "w") as file:
+                json.dump(snapshot, file)
+            os.replace(temporary, path)
+        except:
+            self.logError("Error while saving the chat snapshot")
+            
+    def reconcile(self):
+        # Brings the snapshot in line with Telegram and the database while updates are already being handled
+        start = time.monotonic()
+        try:
+            self.getChats()
+            self.monitoredChats = self.loadMonitoredChatsTable()
+        except:
+            self.logError("Error while reconciling the chat snapshot")
+            return
+        print("Reconciled chat snapshot in " + "%.1f" % (time.monotonic() - start) + " seconds - " + str(len(self.chats)) + " chats, " + str(len(self.monitoredChats)) + " monitored")
+        self.saveSnapshot()
+        self.getAdmins()
+        
     def addChats(self, items):
         new = []
         for item in items:
             print("Adding to monitored: " + item)
             if (item[0] == "@"):
-                item = next((key for key, value in self.chats.items() if value[1] == item), None)
+                item = self.chats.byUsername(item)
             elif not item.isdigit():
                 print("Invalid format for: " + item)
                 continue
-            item = int(item)
+            item = int(item) if item else None
             if not item or not item in self.chats:
                 print("You haven't joined this channel yet")
                 continue
@@ -217,7 +488,7 @@ start - start listening for updates
         for item in items:
             print("Removing from monitored: " + item)
             if (item[0] == "@"):
-                item = next((key for key, value in self.chats.items() if value[1] == item), None)
+                item = self.chats.byUsername(item)
                 if not item:
                     print("You haven't even joined this channel , check for typing errors")
                     continue
@@ -238,65 +509,155 @@ start - start listening for updates
             
     def updateMonitoredChatsList(self, modified, action):
         try:
-            connection = self.pool.get_connection()
-            c = connection.cursor()
-            for id in modified:
-                chat = self.chats[id]
-                if action == "add":
-                    c.execute("INSERT INTO " + self.chatTable + "(ID, Title, Username) VALUES (%s, %s, %s)", (id, chat[0], chat[1]))
-                elif action == "remove":
-                    sql = "DELETE FROM " + self.chatTable + " WHERE ID=" + str(id)
-                    c.execute(sql)
-            connection.commit()
-            connection.close()
+            if action == "add":
+                self.storage.upsertChats([(id, self.chats[id][0], self.chats[id][1]) for id in modified])
+            elif action == "remove":
+                self.storage.deleteChats(modified)
             for id in modified:
                 if action == "remove":
                     del self.monitoredChats[id]
                 elif action == "add":
-                     self.monitoredChats[id] = self.chats[id]
+                     self.monitoredChats[id] = list(self.chats[id][:2])
         except:
             self.logError("Error while updating monitored list in database")
         
         
+    def search(self, arguments):
+        words = []
+        filters = {"chatID": None, "type": None, "since": None, "until": None}
+        for token in arguments.split():
+            key, separator, value = token.partition(":")
+            if not separator or key not in ("chat", "type", "since", "until") or not value:
+                words.append(token)
+            elif key == "chat":
+                filters["chatID"] = self.chats.byUsername(value) if value[0] == "@" else int(value)
+                if filters["chatID"] is None:
+                    print("Unknown chat: " + value)
+                    return
+            elif key == "type":
+                if value not in storage.MESSAGE_TYPES:
+                    print("Unknown message type: " + value)
+                    return
+                filters["type"] = value
+            else:
+                # Whole days, until is inclusive
+                day = datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+                filters[key] = day + (" 00:00:00" if key == "since" else " 23:59:59")
+        if not words:
+            print("Nothing to search for")
+            return
+        self.lastSearch = {"query": " ".join(words), "filters": filters, "after": None}
+        self.showSearchPage()
+        
+    def showSearchPage(self):
+        pageSize = self.config.getint("search", "page_size", fallback=20)
+        search = self.lastSearch
+        start = time.perf_counter()
+        rows = self.storage.searchMessages(search["query"], limit=pageSize, after=search["after"], **search["filters"])
+        elapsed = time.perf_counter() - start
+        if not rows:
+            print("No " + ("more " if search["after"] else "") + "results")
+            self.lastSearch = None
+            return
+        print("\nSCORE - TIME - TYPE - CHAT - SENDER: MESSAGE")
+        for score, id, timestamp, type, chatID, name, username, message in rows:
+            chat = self.monitoredChats.get(chatID)
+            print("%.3f" % score + " - " + str(timestamp) + " - " + type + " - " + (chat[0] if chat else str(chatID)) + (" - " + str(name) + "(" + str(username) + ")" if name else "") + ": " + str(message))
+        print(str(len(rows)) + " results in " + "%.1f" % (elapsed * 1000) + " ms" + (", more for the next page" if len(rows) == pageSize else ""))
+        search["after"] = (rows[-1][0], rows[-1][1])
+        if len(rows) < pageSize:
+            self.lastSearch = None
+        
+    def backfill(self, chatIDs):
+        
+        # Every account backfills the chats it owns, with its own rate limit
+        shards = {}
+        for chatID in chatIDs:
+            shards.setdefault(self.sessionFor(chatID), []).append(chatID)
+        threads = [threading.Thread(target=self.backfillShard, args=(session, shard), name="Backfill-" + session) for session, shard in shards.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+            
+    def backfillShard(self, session, chatIDs):
+        
+        if not hasattr(self, "rateSchedulers"):
+            self.rateSchedulers = {}
+        if session not in self.rateSchedulers:
+            self.rateSchedulers[session] = backfill.RateScheduler(self.config.getfloat("backfill", "requests_per_second", fallback=3))
+        pageSize = self.config.getint("backfill", "page_size", fallback=100)
+        maxMessages = self.config.getint("backfill", "max_messages", fallback=0)
+        workers = self.config.getint("backfill", "workers", fallback=2)
+        resolvePeer = lambda chatID: self.resolvePeer(chatID, session)
+        backfiller = backfill.Backfiller(self.clients[session], self.storage, self.rateSchedulers[session], self.classifyHistoryMessage, self.storeRecords, self.logError, pageSize, maxMessages, workers, resolvePeer)
+        try:
+            backfiller.run(chatIDs)
+        except:
+            self.logError("Error while backfilling monitored chats/channels/groups")
+            
+    def classifyHistoryMessage(self, chat, message, users):
+        return self.classifyMessage(chat, self.extractChatInfo(chat), message, users, verbose=False)
+        
+    def recordRow(self, record):
+        return self.makeRow(record["timestamp"], record["type"], record["chat"], record["sender"], record["message"], record["messageID"], record.get("media"))
+        
+    def storeRecords(self, records):
+        # Records fetched in bulk go through the writer in one batch, journaled if the database refuses
+        # them and seen by its listeners, and their media is archived like that of live messages
+        if not records:
+            return
+        self.writer.writeBatch([self.recordRow(record) for record in records])
+        if self.media:
+            for record in records:
+                if record["media"]:
+                    self.media.submit(record["chat"]["id"], record["media"])
+        
+    def setupAdminCache(self):
+        
+        ttl = self.config.getint("admins", "ttl", fallback=900)
+        refreshInterval = self.config.getint("admins", "refresh_interval", fallback=300)
+        self.adminCache = admin_cache.AdminCache(self.client, self.logError, ttl, refreshInterval, self.resolvePeer, self.clientFor)
+        
+    def setupMessageCache(self):
+        
+        self.recentMessages = message_cache.RecentMessages(self.config.getint("pins", "recent_per_chat", fallback=200))
+        window = self.config.getfloat("pins", "batch_window", fallback=0.05)
+        batchSize = self.config.getint("pins", "batch_size", fallback=100)
+        self.pinFetcher = message_cache.PinFetcher(self.client, self.resolvePeer, self.logError, window, batchSize, self.clientFor)
+        self.pinFetcher.start()
+        
+    def setupEntityCache(self):
+        
+        path = self.config.get("entities", "path", fallback="")
+        maxEntries = self.config.getint("entities", "max_entries", fallback=50000)
+        self.entities = entity_cache.EntityCache(path, maxEntries)
+        try:
+            loaded = self.entities.load()
+            if loaded:
+                print("Loaded " + str(loaded) + " cached entities from " + path)
+        except:
+            self.logError("Error while loading the entity cache, starting cold")
+            
+    def resolvePeer(self, chatID, session=None):
+        session = session or self.sessionFor(chatID)
+        return self.entities.peer(chatID, self.clients[session].resolve_peer, session)
+        
+    def monitoredSupergroups(self):
+        return [group for group in self.chats.supergroups() if group in self.monitoredChats]
+        
     def getAdmins(self):
 
         self.admins = {}
 
-        for group in self.supergroupIDs:
+        for group in self.monitoredSupergroups():
         
             print("Getting admins for: " + str(group))
-
-            groupAdmins = []
-            limit = 200
-            offset = 0
-            filter = types.ChannelParticipantsAdmins()
-
-            while True:
-                try:
-                    participants = self.client.send(
-                        functions.channels.GetParticipants(
-                            channel=self.client.resolve_peer(group),
-                            filter=filter,
-                            offset=offset,
-                            limit=limit,
-                            hash=0
-                        )
-                    )
-                except FloodWait as e:
-                    time.sleep(e.x)
-                    continue
-                    
-                if isinstance(participants, types.channels.ChannelParticipantsNotModified):
-                    print("No admin changes")
-                    pass
-
-                if not participants.participants:
-                    break
-
-                groupAdmins.extend(participants.participants)
-                offset += limit
-                
-            self.admins[group] = [admin.user_id for admin in groupAdmins]
+            
+            try:
+                self.admins[group] = self.adminCache.refreshChannel(group)
+            except:
+                self.logError("Error while getting admins for: " + str(group))
         
         for group in self.admins:
             print(" - " + str(group) + " - ")
@@ -307,121 +668,373 @@ start - start listening for updates
         return self.admins
         
     def updateAdmins(self):
-        while True:
-            time.sleep(20)
-            print("Admin list refresh")
-            self.admins = self.getAdmins()
-        
-    def checkIfAdmin(self, channelID, senderID):
-        admins = self.admins[channelID]
-        if senderID in admins:
-            return True
-        else:
-            return False
+        print("Admin list refresh every " + str(self.adminCache.refreshInterval) + " seconds")
+        self.adminCache.start(self.monitoredSupergroups)
             
     def checkIfChannelAdmin(self, channelID, senderID):
-        participant = self.client.send(
-                        functions.channels.GetParticipant(
-                            channel=self.client.resolve_peer(channelID),
-                            user_id=self.client.resolve_peer(senderID)
-                        )
-                    )
-        sender = participant.participant
-        if isinstance(sender, types.ChannelParticipantCreator) or isinstance(sender, types.ChannelParticipantAdmin):
-            return True
-        else:
-            return False
+        with self.adminCheckTime.time("supergroup"), self.tracer.span("admin_check"):
+            return self.adminCache.isChannelAdmin(channelID, senderID)
             
     def checkIfGroupAdmin(self, groupID, senderID):
-        chat = self.client.send(
-                functions.messages.GetFullChat(groupID)
-                )
-        participants = chat.full_chat.participants.participants
-        for participant in participants:
-            if participant.user_id == senderID:
-                if isinstance(participant, types.ChatParticipantCreator) or isinstance(participant, types.ChatParticipantAdmin):
-                    return True
-                else:
-                    return False
+        with self.adminCheckTime.time("group"), self.tracer.span("admin_check"):
+            return self.adminCache.isGroupAdmin(groupID, senderID)
 
     def processUpdate (self, client, update, users, chats):
             
-            if self.listening:
-
-                if isinstance(update, types.UpdateNewChannelMessage):
+            self.updateCount.inc(type(update).__name__)
+            if self.recorder:
+                self.recorder.record(update, users, chats)
+            self.adminCache.handleUpdate(update)
+            
+            session = self.sessionOf(client)
+            if isinstance(update, types.UpdateChannel):
+                self.updateChannel(update.channel_id, chats, session)
                 
-                    if isinstance(update.message, types.MessageService):
-                        return
+            elif self.listening:
                 
-                    chat = chats[update.message.to_id.channel_id]
-                    chatInfo = self.extractChatInfo(chat)
-                    if int(chatInfo["id"]) not in self.monitoredChats:
-                        return
-                    sender = update.message.from_id
-                    if sender:
-                        sender = users[sender]
-                        senderInfo = self.extractSenderInfo(sender)
-                    else:
-                        senderInfo = None
-                    if chat.megagroup == True:
-                        if self.checkIfChannelAdmin(chatInfo["id"], senderInfo["id"]):
-                            timestamp = update.message.date
-                            message = update.message.message
-                            print("Supergroup admin message - " + chatInfo["string"] + (" - Sender: " + senderInfo["string"] if sender else "") + ": " + message)
-                            self.recordToDatabase(timestamp, "admin", chatInfo, senderInfo, message)
-                            self.sendNotification("admin", chatInfo, senderInfo, message)
-                        else:
-                            print("Supergroup message not from admin - " + chatInfo["string"] + (" - Sender: " + senderInfo["string"] if sender else "") + ": " + update.message.message)
-                    else:
-                        timestamp = update.message.date
-                        message = update.message.message
-                        print("Channel message - " + chatInfo["string"] + (" - Sender: " + senderInfo["string"] if sender else "") + ": " + message)
-                        self.recordToDatabase(timestamp, "channel", chatInfo, senderInfo, message)
-                        self.sendNotification("channel", chatInfo, "", message)
+                if self.updateState:
+                    self.trackUpdate(session, update)
+
+                kind = None
+                if isinstance(update, types.UpdateNewChannelMessage):
+                    if not isinstance(update.message, types.MessageService):
+                        kind = "channel"
                                 
                 elif isinstance(update, types.UpdateChannelPinnedMessage):
-                        
                     if update.id != 0:
-                        chat = chats[update.channel_id]
-                        chatInfo = self.extractChatInfo(chat)
-                        if int(chatInfo["id"]) not in self.monitoredChats:
-                            return
-                        messageInfo = client.get_messages(update.channel_id, update.id)
-                        sender = messageInfo.from_user
-                        if sender:
-                            senderInfo = self.extractSenderInfo(sender)
-                        else:
-                            senderInfo = None
-                        timestamp = messageInfo.date
-                        message = messageInfo.text
-                        print("New pinned message - " + chatInfo["string"] + (" - Sender: " + senderInfo["string"] if sender else "") + ": " + message)
-                        self.recordToDatabase(timestamp, "pinned", chatInfo, senderInfo, message)
-                        self.sendNotification("pinned", chatInfo, senderInfo if sender else "", message)
+                        kind = "pinned"
                         
                 elif isinstance(update, types.UpdateNewMessage):
-                    if isinstance(update.message, types.MessageService):
-                        return
-                    chat = chats[update.message.to_id.chat_id]
-                    chatInfo = self.extractChatInfo(chat)
-                    if int(chatInfo["id"]) not in self.monitoredChats:
-                        return
-                    sender = users[update.message.from_id]
-                    senderInfo = self.extractSenderInfo(sender)
-                    timestamp = update.message.date
-                    message = update.message.message
-                    if self.checkIfGroupAdmin(chatInfo["id"], senderInfo["id"]):
-                        print("Group admin message - " + chatInfo["string"] + (" - Sender: " + senderInfo["string"] if sender else "") + ": " + message)
-                        self.recordToDatabase(timestamp, "admin", chatInfo, senderInfo, message)
-                        self.sendNotification("admin", chatInfo, senderInfo, message)
-                    else:
-                        print("Group message not from admin - " + chatInfo["string"] + (" - Sender: " + senderInfo["string"] if sender else "") + ": " + message)
-                    
-            elif isinstance(update, types.UpdateChannel):
-                #print("Channel list changed")
-                self.chats = self.getChats()
-                self.cleanUpMonitored()
+                    if not isinstance(update.message, types.MessageService) and isinstance(update.message.to_id, types.PeerChat):
+                        kind = "group"
+                        
+                if kind:
+                    self.pipeline.submit({"kind": kind, "session": session, "client": client, "update": update, "users": users, "chats": chats})
+                elif self.updateState:
+                    self.updateState.finish(session, update)
+                
+    def finishUpdate(self, item, outcome):
+        # Called by the pipeline once it is done with an update. A dropped or failed one is fetched again
+        # by recovery, unless nobody records its chat here anyway
+        if not self.updateState:
+            return
+        session, update = item["session"], item["update"]
+        if outcome is None:
+            self.updateState.finish(session, update)
+            return
+        channelID = gap_recovery.channelOf(update)
+        if not self.recovery or (channelID is not None and not self.recoveryWanted(channelID, session)):
+            self.updateState.finish(session, update)
+            return
+        self.recovery.schedule(session, channelID)
+        
+    def trackUpdate(self, session, update):
+        gap = self.updateState.observe(session, update)
+        if gap is None or not self.recovery:
+            return
+        # A channel nobody monitors, or one another account handles, has nothing to recover here
+        if gap and (gap not in self.monitoredChats or self.sessionFor(gap) != session):
+            return
+        self.recovery.schedule(session, gap)
+        
+    def setupRecovery(self):
+        
+        if not self.config.getboolean("gaps", "enabled", fallback=True):
+            self.updateState = None
+            self.recovery = None
+            return
+        saveInterval = self.config.getfloat("gaps", "save_interval", fallback=5)
+        self.updateState = gap_recovery.UpdateState(self.storage, self.logError, saveInterval)
+        try:
+            self.updateState.load()
+        except:
+            self.logError("Error while loading the saved update state, updates missed before this start can't be recovered")
+        self.updateState.start()
+        pageSize = self.config.getint("gaps", "page_size", fallback=100)
+        workers = self.config.getint("gaps", "workers", fallback=8)
+        requestsPerSecond = self.config.getfloat("gaps", "requests_per_second", fallback=20)
+        self.notifyRecovered = self.config.getboolean("gaps", "notify", fallback=True)
+        self.recovery = gap_recovery.GapRecovery(self.updateState, self.clients, self.resolvePeer, self.classifyHistoryMessage, self.recordRecovered, self.recoveryWanted, self.logError, pageSize, workers, requestsPerSecond)
+        self.recovery.start()
+        
+    def catchUp(self):
+        # Every monitored channel and supergroup with the account that owns it, basic groups come with each account's common difference
+        channels = [(self.sessionFor(chatID), chatID) for chatID in list(self.monitoredChats) if chatID in self.chats and self.chats[chatID].kind != "group"]
+        try:
+            self.recovery.catchUp(channels)
+        except:
+            self.logError("Error while catching up with missed updates")
+            
+    def recoveryWanted(self, chatID, session):
+        return chatID in self.monitoredChats and self.sessionFor(chatID) == session
+        
+    def recordRecovered(self, records):
+        # Messages that also came in live are left to the pipeline, the rest go through the writer in one
+        # batch and are archived and notified about like live ones. Raises if the batch reached neither the
+        # database nor the journal, so recovery doesn't move past it
+        records = [record for record in records if not self.recentMessages.get(record["chat"]["id"], record["messageID"])]
+        if not records:
+            return 0
+        self.writer.writeBatch([self.recordRow(record) for record in records])
+        for record in records:
+            self.recentMessages.add(record["chat"]["id"], record["messageID"], record["timestamp"], record["sender"], record["message"])
+            if self.media and record["media"]:
+                self.media.submit(record["chat"]["id"], record["media"])
+            if self.notifyRecovered:
+                self.notifyUpdate(record)
+        return len(records)
+        
+    def setupMetrics(self):
+        
+        registry = metrics.registry
+        if hasattr(self, "pool"):
+            registry.callback("mysql_pool_connections", "Connections in the MySQL pool, by state", ["state"], lambda: {(state,): self.pool.stats()[state] for state in ("in_use", "idle")})
+            for stat, help in (("checkouts", "Connections checked out of the pool"), ("waits", "Checkouts that had to wait for a free connection"), ("timeouts", "Checkouts that gave up waiting"), ("creations", "Connections opened by the pool"), ("failures", "Connections the pool failed to open"), ("evictions", "Idle connections closed by the pool")):
+                registry.callback("mysql_pool_" + stat + "_total", help, [], lambda stat=stat: self.pool.stats()[stat], "counter")
+            registry.callback("mysql_pool_wait_seconds_total", "Total time spent checking out connections", [], lambda: self.pool.stats()["wait_time"], "counter")
+        registry.callback("telegram_queue_depth", "Items waiting in each internal queue", ["queue"], self.queueDepths)
+        registry.callback("telegram_journal_backlog_bytes", "Bytes of messages in the local journal waiting for the database", [], self.writer.journalBacklog)
+        
+        if self.config.getboolean("metrics", "enabled", fallback=False):
+            host = self.config.get("metrics", "host", fallback="127.0.0.1")
+            port = self.config.getint("metrics", "port", fallback=9464)
+            try:
+                registry.serve(host, port)
+                print("Serving metrics on http://" + host + ":" + str(port) + "/metrics")
+            except:
+                self.logError("Error while starting the metrics listener")
+                
+    def setupRetention(self):
+        
+        if not self.config.getboolean("retention", "enabled", fallback=False):
+            self.retention = None
+            return
+        defaultDays = self.config.getint("retention", "hot_days", fallback=0)
+        chatDays = {int(chatID): int(days) for chatID, days in self.retentionWindows(self.config.get("retention", "chat_days", fallback=""))}
+        typeDays = {type: int(days) for type, days in self.retentionWindows(self.config.get("retention", "type_days", fallback=""))}
+        path = self.config.get("retention", "path", fallback="archive")
+        format = self.config.get("retention", "format", fallback="jsonl")
+        if format == "parquet":
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                self.logError("The parquet archive format needs pyarrow, install it with pip install pyarrow or set [retention] format = jsonl, exiting\n", True)
+        batchSize = self.config.getint("retention", "batch_size", fallback=5000)
+        interval = self.config.getfloat("retention", "interval", fallback=3600)
+        dutyCycle = self.config.getfloat("retention", "duty_cycle", fallback=0.2)
+        self.retention = retention.Retention(self.storage, self.logError, path, defaultDays, chatDays, typeDays, format, batchSize, interval, dutyCycle, self.ingestionBusy)
+        self.retention.start()
+        print("Archiving messages past their hot window to " + path)
+        
+    def retentionWindows(self, value):
+        # "key:days, key:days" pairs
+        return [item.split(":", 1) for item in (item.strip() for item in value.split(",")) if item]
+        
+    def ingestionBusy(self):
+        # Background jobs hold off while rows queue up for the database or wait in the journal
+        return self.writer.pending() >= self.writer.highWater // 5 or (self.journal is not None and self.journal.pending())
+        
+    def setupReadAPI(self):
+        
+        if not self.config.getboolean("api", "enabled", fallback=False):
+            self.readAPI = None
+            return
+        # A storage of its own on read-only connections, dashboard queries never wait for or hold up the writer's pool
+        try:
+            if self.config.get("database", "backend", fallback="mysql") == "sqlite":
+                readStorage = storage.SQLiteStorage(self.config.get("database", "sqlite_path", fallback="telegram.db"), self.tables, readOnly=True)
+            else:
+                dbsettings = {setting: self.config.get("api", "db_" + setting, fallback="") or self.config["database"][setting] for setting in ("host", "user", "password", "db", "charset")}
+                poolSize = self.config.getint("api", "pool_size", fallback=2)
+                idleTimeout = self.config.getint("database", "pool_idle_timeout", fallback=300)
+                pingAfter = self.config.getint("database", "pool_ping_after", fallback=30)
+                self.readPool = pymysql_pool.ConnectionPool(size=1, name='readpool', max_size=poolSize, idle_timeout=idleTimeout, ping_after=pingAfter, init_command="SET SESSION TRANSACTION READ ONLY", **dbsettings)
+                readStorage = storage.MySQLStorage(self.readPool, self.tables)
+        except:
+            self.logError("Error while connecting the read API to the database, the API stays off")
+            self.readAPI = None
+            return
+        cacheTTL = self.config.getfloat("api", "cache_ttl", fallback=10)
+        cacheEntries = self.config.getint("api", "cache_entries", fallback=1000)
+        pageSize = self.config.getint("api", "page_size", fallback=50)
+        maxPageSize = self.config.getint("api", "max_page_size", fallback=500)
+        self.readAPI = read_api.ReadAPI(readStorage, self.logError, cacheTTL, cacheEntries, pageSize, maxPageSize, self.retention)
+        self.writer.addListener(self.readAPI.invalidate)
+        host = self.config.get("api", "host", fallback="127.0.0.1")
+        port = self.config.getint("api", "port", fallback=9465)
+        try:
+            self.readAPI.serve(host, port)
+            print("Serving the read API on http://" + host + ":" + str(port))
+        except:
+            self.logError("Error while starting the read API listener")
+            
+    def setupProfiling(self):
+        
+        threshold = self.config.getfloat("profiling", "slow_update_threshold", fallback=1.0)
+        self.tracer = profiler.SlowUpdateTracer(threshold, self.describeUpdate)
+        path = self.config.get("profiling", "path", fallback="profiles")
+        interval = self.config.getfloat("profiling", "sample_interval", fallback=0.005)
+        self.profileDuration = self.config.getfloat("profiling", "duration", fallback=30)
+        self.profiler = profiler.SamplingProfiler(path, interval)
+        # kill -USR1 <pid> takes a profile without the menu, in daemon mode or once listening started
+        if hasattr(signal, "SIGUSR1"):
+            try:
+                signal.signal(signal.SIGUSR1, lambda number, frame: self.profiler.start(self.profileDuration))
+            except ValueError:
+                pass
                 
+    def describeUpdate(self, item):
+        if "messageID" in item:
+            return item["type"] + " message " + str(item["messageID"]) + " in " + item["chat"]["string"]
+        return item["kind"] + " update" + (" in " + item["chatInfo"]["string"] if "chatInfo" in item else "")
+        
+    def setupRecorder(self):
+        
+        path = self.config.get("recorder", "path", fallback="")
+        self.recorder = update_recorder.UpdateRecorder(path) if path else None
+        if self.recorder:
+            print("Recording raw updates to " + path)
+            
+    def queueDepths(self):
+        depths = {("pipeline_" + name,): depth for name, depth in self.pipeline.depths().items()}
+        depths[("writer",)] = self.writer.pending()
+        if self.notifier:
+            depths[("notifier",)] = self.notifier.pending()
+        if self.media:
+            depths[("media",)] = self.media.pending()
+        return depths
+        
+    def setupPipeline(self):
+        
+        policy = self.config.get("pipeline", "policy", fallback="block")
+        queueSize = self.config.getint("pipeline", "queue_size", fallback=1000)
+        self.pipeline = pipeline.Pipeline(self.logError, policy, self.tracer, self.finishUpdate)
+        self.pipeline.addStage("filter", self.filterUpdate, self.config.getint("pipeline", "filter_workers", fallback=1), queueSize)
+        self.pipeline.addStage("enrich", self.enrichUpdate, self.config.getint("pipeline", "enrich_workers", fallback=4), queueSize)
+        self.pipeline.addStage("persist", self.persistUpdate, self.config.getint("pipeline", "persist_workers", fallback=1), queueSize)
+        self.pipeline.addStage("notify", self.notifyUpdate, self.config.getint("pipeline", "notify_workers", fallback=1), queueSize)
+        self.pipeline.start()
+        
+    def filterUpdate(self, item):
+        update = item["update"]
+        if item["kind"] == "channel":
+            chat = item["chats"][update.message.to_id.channel_id]
+        elif item["kind"] == "pinned":
+            chat = item["chats"][update.channel_id]
+        else:
+            chat = item["chats"][update.message.to_id.chat_id]
+        chatInfo = self.extractChatInfo(chat)
+        if int(chatInfo["id"]) not in self.monitoredChats:
+            return None
+        # A chat joined by several accounts arrives once per account, only its owner's copy goes on
+        owner = self.chats.owner(chatInfo["id"])
+        if owner is not None and owner != item["session"]:
+            return None
+        item["chat"] = chat
+        item["chatInfo"] = chatInfo
+        if item["kind"] != "pinned":
+            # Filled here, in arrival order, so a pin enriched later finds the message it points at and
+            # gap recovery skips messages already handled
+            message = update.message
+            senderInfo = self.extractSenderInfo(item["users"][message.from_id]) if message.from_id else None
+            self.recentMessages.add(chatInfo["id"], message.id, message.date, senderInfo, message.message)
+        return item
+        
+    def enrichUpdate(self, item):
+        update = item["update"]
+        chat = item["chat"]
+        chatInfo = item["chatInfo"]
+        
+        if item["kind"] == "pinned":
+            with self.pinnedFetchTime.time(), self.tracer.span("pinned_lookup"):
+                pinned = self.findPinnedMessage(chatInfo["id"], update.id)
+            if pinned is None:
+                print("Pinned message not found - " + chatInfo["string"] + " - " + str(update.id))
+                return None
+            date, senderInfo, text = pinned
+            return self.makeRecord("pinned", "New pinned message", date, chatInfo, senderInfo, text, update.id)
+            
+        return self.classifyMessage(chat, chatInfo, update.message, item["users"])
+        
+    def findPinnedMessage(self, channelID, messageID):
+        # Recently seen messages first, then the database, then a channels.GetMessages shared with other pins
+        pinned = self.recentMessages.get(channelID, messageID)
+        if pinned:
+            self.pinLookups.inc("cache")
+            return pinned
+            
+        try:
+            with self.tracer.span("pinned_db"):
+                stored = self.storage.findMessages(channelID, [messageID]).get(messageID)
+        except:
+            self.logError("Error while looking up pinned message in database")
+            stored = None
+        if stored:
+            self.pinLookups.inc("database")
+            date, senderID, name, username, text = stored
+            senderInfo = {"id": senderID, "name": name, "username": username, "string": str(name) + "(" + str(username) + ")"} if senderID else None
+            return (date, senderInfo, text)
+            
+        with self.tracer.span("pinned_rpc"):
+            fetched = self.pinFetcher.fetch(channelID, messageID)
+        if fetched is None:
+            self.pinLookups.inc("missing")
+            return None
+        self.pinLookups.inc("rpc")
+        date, sender, text = fetched
+        pinned = (date, self.extractSenderInfo(sender) if sender else None, text)
+        self.recentMessages.add(channelID, messageID, *pinned)
+        return pinned
+        
+    def classifyMessage(self, chat, chatInfo, message, users, verbose=True):
+        if message.from_id:
+            senderInfo = self.extractSenderInfo(users[message.from_id])
+        else:
+            senderInfo = None
+        timestamp = message.date
+        text = message.message
+        media = media_archive.describeMedia(message)
+        
+        if not isinstance(chat, types.Channel):
+            if senderInfo and self.checkIfGroupAdmin(chatInfo["id"], senderInfo["id"]):
+                return self.makeRecord("admin", "Group admin message", timestamp, chatInfo, senderInfo, text, message.id, media=media)
+            if verbose:
+                print("Group message not from admin - " + chatInfo["string"] + (" - Sender: " + senderInfo["string"] if senderInfo else "") + ": " + text)
+            return None
+            
+        if chat.megagroup == True:
+            if senderInfo and self.checkIfChannelAdmin(chatInfo["id"], senderInfo["id"]):
+                return self.makeRecord("admin", "Supergroup admin message", timestamp, chatInfo, senderInfo, text, message.id, media=media)
+            if verbose:
+                print("Supergroup message not from admin - " + chatInfo["string"] + (" - Sender: " + senderInfo["string"] if senderInfo else "") + ": " + text)
+            return None
+            
+        return self.makeRecord("channel", "Channel message", timestamp, chatInfo, senderInfo, text, message.id, notifySender=False, media=media)
+        
+
+    def makeRecord(self, type, label, timestamp, chatInfo, senderInfo, message, messageID, notifySender=True, media=None):
+        return {"type": type, "label": label, "timestamp": timestamp, "chat": chatInfo, "sender": senderInfo, "message": message, "messageID": messageID, "notifySender": notifySender, "media": media}
+        
+    def persistUpdate(self, record):
+        print(record["label"] + " - " + record["chat"]["string"] + (" - Sender: " + record["sender"]["string"] if record["sender"] else "") + ": " + record["message"] + (" [" + record["media"]["type"] + "]" if record["media"] else ""))
+        self.recordToDatabase(record["timestamp"], record["type"], record["chat"], record["sender"], record["message"], record["messageID"], record["media"])
+        if self.media and record["media"]:
+            self.media.submit(record["chat"]["id"], record["media"])
+        return record
+        
+    def notifyUpdate(self, record):
+        rules = None
+        if self.alerts:
+            with self.tracer.span("alert_match"):
+                rules = self.alerts.match(record["chat"]["id"], record["type"], record["message"])
+            if not rules:
+                return
+        self.sendNotification(record["type"], record["chat"], record["sender"] if record["sender"] and record["notifySender"] else "", record["message"], rules)
+        
     def extractChatInfo(self, chat):
+        return self.entities.info("chat", chat.id, (chat.title, getattr(chat, "username", None)), lambda: self.formatChatInfo(chat))
+        
+    def formatChatInfo(self, chat):
         chatInfo = {}
         chatInfo["title"] = chat.title
         chatInfo["id"] = chat.id
@@ -433,6 +1046,9 @@ start - start listening for updates
         return chatInfo
     
     def extractSenderInfo(self, sender):
+        return self.entities.info("user", sender.id, (sender.first_name, sender.last_name, getattr(sender, "username", None)), lambda: self.formatSenderInfo(sender))
+        
+    def formatSenderInfo(self, sender):
         senderInfo = {}
         senderInfo["id"] = sender.id
         senderInfo["name"] = sender.first_name + (" " + str(sender.last_name) if sender.last_name else "")
@@ -443,48 +1059,116 @@ start - start listening for updates
         senderInfo["string"] = senderInfo["name"] + "(" + senderInfo["username"] + ")" 
         return senderInfo
             
-    def recordToDatabase(self, timestamp, type, chat, sender, message):
+    def recordToDatabase(self, timestamp, type, chat, sender, message, messageID, media=None):
+        with self.recordTime.time(), self.tracer.span("db_queue"):
+            self.writer.write(self.makeRow(timestamp, type, chat, sender, message, messageID, media))
+        
+    def makeRow(self, timestamp, type, chat, sender, message, messageID, media=None):
         time = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
         chat = chat["id"]
+        mediaType, mediaID = (media["type"], media["id"]) if media else (None, None)
         if sender:
-            sender = sender["string"]
-        else:
-            sender = ""
-        try:
-            connection = self.pool.get_connection()
-            c = connection.cursor()
-            c.execute("INSERT INTO " + self.messageTable + "(Time, Type, Chat, Sender, Message) VALUES (%s, %s, %s, %s, %s)", (time, type, chat, sender, message))
-            connection.commit()
-            connection.close()
-        except:
-            self.logError("Error while writing update to the database")
+            return (time, type, chat, messageID, sender["id"], sender["name"], sender["username"], message, mediaType, mediaID)
+        return (time, type, chat, messageID, None, None, None, message, mediaType, mediaID)
         
-    def sendNotification(self, type, chat, sender, message):
+    def setupMedia(self):
+        
+        if not self.config.getboolean("media", "enabled", fallback=False):
+            self.media = None
+            return
+        path = self.config.get("media", "path", fallback="media")
+        workers = self.config.getint("media", "workers", fallback=2)
+        queueSize = self.config.getint("media", "queue_size", fallback=100)
+        chunkSize = self.config.getint("media", "chunk_size", fallback=512 * 1024)
+        maxSize = self.config.getint("media", "max_size", fallback=0)
+        mediaTypes = tuple(type.strip() for type in self.config.get("media", "types", fallback="photo,video,document").split(","))
+        self.media = media_archive.MediaArchiver(self.storage, self.clientFor, self.logError, path, workers, queueSize, chunkSize, maxSize, mediaTypes)
+        self.media.start()
+        print("Archiving " + ", ".join(mediaTypes) + " to " + path)
+        
+    def setupNotifier(self):
+    
         URL = self.config["IFTTT"]["URL"]
-        if URL != "":
-            text = "New " + type + " message in " + chat["string"] + (" from " + sender["string"] if sender else "") + "\n\n" + message
+        if URL == "":
+            self.notifier = None
+            return
+        workers = self.config.getint("IFTTT", "workers", fallback=2)
+        queueSize = self.config.getint("IFTTT", "queue_size", fallback=1000)
+        timeout = self.config.getfloat("IFTTT", "timeout", fallback=10)
+        retries = self.config.getint("IFTTT", "retries", fallback=3)
+        backoff = self.config.getfloat("IFTTT", "backoff", fallback=1.0)
+        digestWindow = self.config.getfloat("IFTTT", "digest_window", fallback=0)
+        enqueueTimeout = self.config.getfloat("IFTTT", "enqueue_timeout", fallback=30)
+        self.notifier = notifier.NotificationDispatcher(URL, self.logError, workers, queueSize, timeout, retries, backoff, digestWindow, enqueueTimeout)
+        self.notifier.start()
+        
+    def sendNotification(self, type, chat, sender, message, rules=None):
+        if self.notifier:
+            text = "New " + type + " message in " + chat["string"] + (" from " + sender["string"] if sender else "") + (" matching " + ", ".join(rules) if rules else "") + "\n\n" + message
             #print(text)
-            data = {"value1": text}
-            try:
-                response = requests.post(URL, data=data)
-                print(response.text)
-            except:
-                self.logError("Error while sending notification to phone")
+            with self.notifyTime.time(), self.tracer.span("webhook_queue"):
+                self.notifier.send(chat["id"], text)
+        
+    def setupAlerts(self):
+        
+        if not self.config.getboolean("alerts", "enabled", fallback=False):
+            self.alerts = None
+            return
+        reloadInterval = self.config.getfloat("alerts", "reload_interval", fallback=30)
+        self.alerts = alert_rules.AlertRules(self.loadAlertPatterns, self.logError, reloadInterval)
+        self.alerts.start()
+        
+    def loadAlertPatterns(self):
+        # Every [alert <name>] section of the config file, read again on each reload, and the rows of
+        # the alert table when [alerts] table is enabled
+        config = configparser.ConfigParser()
+        config.read(self.configPath)
+        wholeWords = config.getboolean("alerts", "whole_words", fallback=True)
+        patterns = []
+        for section in config.sections():
+            if not section.startswith("alert "):
+                continue
+            rule = section[len("alert "):].strip()
+            options = config[section]
+            chats = self.alertScope(options.get("chats", "all"), int)
+            types = self.alertScope(options.get("types", "all"), str)
+            sectionWholeWords = options.getboolean("whole_words", fallback=wholeWords)
+            keywords = [keyword.strip() for line in options.get("keywords", "").splitlines() for keyword in line.split(",") if keyword.strip()]
+            regexes = [line.strip() for line in options.get("regex", "").splitlines() if line.strip()]
+            patterns.extend(alert_rules.Pattern(rule, keyword, False, chats, types, sectionWholeWords) for keyword in keywords)
+            patterns.extend(alert_rules.Pattern(rule, regex, True, chats, types, False) for regex in regexes)
+            if not keywords and not regexes:
+                patterns.append(alert_rules.Pattern(rule, None, False, chats, types, False))
+        if config.getboolean("alerts", "table", fallback=False):
+            for rule, chatID, type, text, isRegex in self.storage.loadAlertRules():
+                patterns.append(alert_rules.Pattern(rule, text, bool(isRegex), frozenset([chatID]) if chatID is not None else None, frozenset([type]) if type else None, wholeWords))
+        return tuple(patterns)
+        
+    def alertScope(self, value, convert):
+        items = [item.strip() for item in value.split(",") if item.strip()]
+        if not items or "all" in items:
+            return None
+        return frozenset(convert(item) for item in items)
         
     def logError(self, message, fatal=False):
     
-        print(message)
         error = str(sys.exc_info()[0]) + "\n\n" + str(sys.exc_info()[1])
-        print (error)
-        with open("errors.log", 'a') as logfile:
-                logfile.write("\n" + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " - " + error + "\n\n" + str(traceback.format_exc()) + "\n")
-                logfile.write("---------------------------------------------------------------")
+        entry = "\n" + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " - " + error + "\n\n" + str(traceback.format_exc()) + "\n" + "---------------------------------------------------------------"
+        # The same error again within the dedup window is only counted, an outage doesn't flood the console and errors.log
+        if self.errorLog.log((message.strip(), str(sys.exc_info()[0]) + ": " + str(sys.exc_info()[1])), entry):
+            print(message)
+            print (error)
         if (fatal):
             #sprint ("\n" + str(traceback.format_exc()))
+            self.errorLog.flush()
             raise SystemExit
             
     
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Log and notify Telegram channel and admin messages")
+    parser.add_argument("--daemon", action="store_true", help="start listening right away without the interactive menu")
+    args = parser.parse_args()
+    
     bot = TelegramBot()
-    bot.run()
\ No newline at end of file
+    bot.run(args.daemon)
\ No newline at end of file
@@ -0,0 +1,163 @@
+from pyrogram.api import functions, types
+from pyrogram.api.errors import FloodWait
+import threading
+import time
+
+class AdminCache():
+
+    # Admin user IDs per chat, loaded in bulk (one GetParticipants/GetFullChat per chat)
+    # and kept until the TTL runs out or an admin/participant change update invalidates it
+
+    def __init__(self, client, logError, ttl=900, refreshInterval=300, resolvePeer=None, clientFor=None):
+
+        self.client = client
+        self.resolvePeer = resolvePeer or client.resolve_peer
+        # With several accounts, the one that owns the chat answers for it
+        self.clientFor = clientFor or (lambda chatID: client)
+        self.logError = logError
+        self.ttl = ttl
+        self.refreshInterval = refreshInterval
+
+        self.entries = {}
+        self.fetching = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def isChannelAdmin(self, channelID, userID):
+        admins = self.get(channelID)
+        if admins is None:
+            admins = self.load(channelID, self.refreshChannel)
+        return userID in admins
+
+    def isGroupAdmin(self, groupID, userID):
+        admins = self.get(groupID)
+        if admins is None:
+            admins = self.load(groupID, self.refreshGroup)
+        return userID in admins
+
+    def load(self, chatID, refresh):
+        # Concurrent misses on a chat wait for the first one's fetch instead of sending their own
+        with self.lock:
+            fetching = self.fetching.setdefault(chatID, threading.Lock())
+        with fetching:
+            admins = self.get(chatID)
+            if admins is None:
+                admins = refresh(chatID)
+        return admins
+
+    def get(self, chatID):
+        with self.lock:
+            entry = self.entries.get(chatID)
+        if entry and entry["expires"] > time.monotonic():
+            return entry["admins"]
+        return None
+
+    def store(self, chatID, admins, hash):
+        with self.lock:
+            self.entries[chatID] = {"admins": admins, "hash": hash, "expires": time.monotonic() + self.ttl}
+
+    def invalidate(self, chatID):
+        with self.lock:
+            entry = self.entries.get(chatID)
+            if entry:
+                # Keep the hash, an unchanged admin list still comes back as NotModified
+                entry["expires"] = 0
+
+    def handleUpdate(self, update):
+        if isinstance(update, (types.UpdateChatParticipantAdmin, types.UpdateChatAdmins)):
+            self.invalidate(update.chat_id)
+        elif isinstance(update, types.UpdateChatParticipants):
+            self.invalidate(update.participants.chat_id)
+        elif isinstance(update, types.UpdateChannel):
+            self.invalidate(update.channel_id)
+
+    def refreshChannel(self, channelID):
+        with self.lock:
+            entry = self.entries.get(channelID)
+        hash = entry["hash"] if entry else 0
+
+        channel = self.resolvePeer(channelID)
+        admins = []
+        limit = 200
+        offset = 0
+        filter = types.ChannelParticipantsAdmins()
+
+        while True:
+            try:
+                participants = self.clientFor(channelID).send(
+                    functions.channels.GetParticipants(
+                        channel=channel,
+                        filter=filter,
+                        offset=offset,
+                        limit=limit,
+                        hash=hash if offset == 0 else 0
+                    )
+                )
+            except FloodWait as e:
+                time.sleep(e.x)
+                continue
+
+            if isinstance(participants, types.channels.ChannelParticipantsNotModified):
+                self.store(channelID, entry["admins"], entry["hash"])
+                return entry["admins"]
+
+            admins.extend(participant.user_id for participant in participants.participants)
+            if len(participants.participants) < limit:
+                break
+            offset += limit
+
+        # The hash only describes a list the server sent in a single page
+        hash = self.computeHash(admins) if offset == 0 else 0
+        admins = set(admins)
+        self.store(channelID, admins, hash)
+        return admins
+
+    def refreshGroup(self, groupID):
+        while True:
+            try:
+                chat = self.clientFor(groupID).send(functions.messages.GetFullChat(chat_id=groupID))
+                break
+            except FloodWait as e:
+                time.sleep(e.x)
+
+        admins = set()
+        for participant in chat.full_chat.participants.participants:
+            if isinstance(participant, types.ChatParticipantCreator) or isinstance(participant, types.ChatParticipantAdmin):
+                admins.add(participant.user_id)
+        self.store(groupID, admins, 0)
+        return admins
+
+    def computeHash(self, ids):
+        acc = 0
+        for id in ids:
+            acc = ((acc * 20261) + 0x80000000 + id) % 0x80000000
+        return acc
+
+    def start(self, targets):
+        # targets is a callable returning the supergroup IDs to keep warm
+        self.targets = targets
+        self.thread = threading.Thread(target=self.run, name="AdminRefresher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping.is_set():
+            groups = self.targets()
+            if not groups:
+                self.stopping.wait(self.refreshInterval)
+                continue
+            # Spread the refreshes over the whole interval instead of bursting them
+            delay = self.refreshInterval / len(groups)
+            for group in groups:
+                if self.stopping.wait(delay):
+                    return
+                try:
+                    self.refreshChannel(group)
+                except:
+                    self.logError("Error while refreshing admins for: " + str(group))
@@ -0,0 +1,181 @@
+from collections import deque, namedtuple
+import metrics
+import re
+import threading
+import time
+
+# One keyword or regex of a named rule. text is None for a rule without patterns, which matches
+# every message in its scope. chats and types are frozensets, None means any
+Pattern = namedtuple("Pattern", ["rule", "text", "regex", "chats", "types", "wholeWords"])
+
+class KeywordAutomaton():
+
+    # Aho-Corasick over casefolded keywords: a single pass over a message finds every keyword
+    # it contains, however many keywords there are
+
+    def __init__(self, keywords):
+        # keywords: iterable of (keyword, value), values of keywords ending in a state are kept in outputs
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for keyword, value in keywords:
+            state = 0
+            for char in keyword:
+                next = self.goto[state].get(char)
+                if next is None:
+                    next = self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                state = next
+            self.outputs[state].append((len(keyword), value))
+
+        # Breadth first, so the state a failure link points at is always complete already
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next in self.goto[state].items():
+                pending.append(next)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next] = self.goto[fallback].get(char, 0)
+                self.outputs[next] = self.outputs[next] + self.outputs[self.fail[next]]
+
+    def __len__(self):
+        return len(self.goto)
+
+    def search(self, text):
+        # Yields (start, end, value) for every keyword occurrence in text
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in outputs[state]:
+                yield end - length, end, value
+
+class RuleSet():
+
+    # Immutable once built: every keyword in one automaton, every regex compiled, and the regexes
+    # indexed by chat so a message only runs the ones that apply to it
+
+    def __init__(self, patterns, logError=None):
+        self.rules = set()
+        self.always = []
+        self.regexes = {}
+        self.errors = 0
+        keywords = []
+        for pattern in patterns:
+            self.rules.add(pattern.rule)
+            if pattern.text is None:
+                self.always.append(pattern)
+            elif pattern.regex:
+                try:
+                    compiled = re.compile(pattern.text, re.IGNORECASE)
+                except re.error as e:
+                    self.errors += 1
+                    if logError:
+                        # Called inside the except block, so the error log gets this regex error's traceback
+                        logError("Invalid regex in alert rule " + pattern.rule + ": " + pattern.text + " (" + str(e) + ")")
+                    continue
+                for chatID in pattern.chats if pattern.chats is not None else (None,):
+                    self.regexes.setdefault(chatID, []).append((compiled, pattern))
+            elif pattern.text.strip():
+                keywords.append((pattern.text.strip().casefold(), pattern))
+        self.keywordCount = len(keywords)
+        self.regexCount = sum(len(regexes) for regexes in self.regexes.values())
+        self.automaton = KeywordAutomaton(keywords)
+
+    def match(self, chatID, type, text):
+        # Names of the rules matching a message, empty if none does
+        matched = set()
+        for pattern in self.always:
+            if self.applies(pattern, chatID, type):
+                matched.add(pattern.rule)
+        if not text:
+            return matched
+        folded = text.casefold()
+        for start, end, pattern in self.automaton.search(folded):
+            if pattern.rule in matched or not self.applies(pattern, chatID, type):
+                continue
+            if pattern.wholeWords and not self.wordAt(folded, start, end):
+                continue
+            matched.add(pattern.rule)
+        for regexes in (self.regexes.get(None, ()), self.regexes.get(chatID, ())):
+            for compiled, pattern in regexes:
+                if pattern.rule in matched or (pattern.types is not None and type not in pattern.types):
+                    continue
+                if compiled.search(text):
+                    matched.add(pattern.rule)
+        return matched
+
+    def applies(self, pattern, chatID, type):
+        return (pattern.chats is None or chatID in pattern.chats) and (pattern.types is None or type in pattern.types)
+
+    def wordAt(self, text, start, end):
+        return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+class AlertRules():
+
+    # Holds the current RuleSet and rebuilds it on a thread of its own every reloadInterval
+    # seconds when loadPatterns returns something different. The new set replaces the old one
+    # in a single assignment, messages being matched meanwhile keep using the one they started with
+
+    def __init__(self, loadPatterns, logError, reloadInterval=30):
+
+        self.loadPatterns = loadPatterns
+        self.logError = logError
+        self.reloadInterval = reloadInterval
+
+        self.patterns = None
+        self.ruleSet = RuleSet([])
+        self.stopping = threading.Event()
+        self.thread = None
+        self.matches = metrics.registry.counter("telegram_alert_matches_total", "Messages matching each alert rule", ["rule"])
+        self.outcomes = metrics.registry.counter("telegram_alerts_total", "Messages checked against the alert rules, by outcome", ["outcome"])
+        self.matchTime = metrics.registry.histogram("telegram_alert_match_seconds", "Time spent matching one message against the alert rules")
+        self.reloads = metrics.registry.counter("telegram_alert_reloads_total", "Alert rule sets built")
+
+    def start(self):
+        self.reload()
+        if self.reloadInterval > 0:
+            self.thread = threading.Thread(target=self.run, name="AlertRules", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.reloadInterval):
+            try:
+                self.reload()
+            except:
+                self.logError("Error while reloading alert rules, keeping the current ones")
+
+    def reload(self):
+        patterns = self.loadPatterns()
+        if patterns == self.patterns:
+            return False
+        start = time.monotonic()
+        ruleSet = RuleSet(patterns, self.logError)
+        self.ruleSet = ruleSet
+        self.patterns = patterns
+        self.reloads.inc()
+        print("Alert rules loaded - " + str(len(ruleSet.rules)) + " rules, " + str(ruleSet.keywordCount) + " keywords (" + str(len(ruleSet.automaton)) + " states), "
+              + str(ruleSet.regexCount) + " regexes" + (", " + str(ruleSet.errors) + " invalid" if ruleSet.errors else "") + " in " + "%.3f" % (time.monotonic() - start) + " seconds")
+        return True
+
+    def match(self, chatID, type, text):
+        with self.matchTime.time():
+            matched = self.ruleSet.match(chatID, type, text)
+        self.outcomes.inc("matched" if matched else "unmatched")
+        for rule in matched:
+            self.matches.inc(rule)
+        return sorted(matched)
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,136 @@
+from pyrogram.api import functions, types
+from pyrogram.api.errors import FloodWait
+import queue
+import threading
+import time
+
+class RateScheduler():
+
+    # Spaces out API requests from every thread sharing it, and pauses all of them
+    # when any one of them hits a FloodWait
+
+    def __init__(self, requestsPerSecond=0):
+
+        self.interval = 1.0 / requestsPerSecond if requestsPerSecond > 0 else 0
+        self.lock = threading.Lock()
+        self.nextSlot = 0
+        self.pausedUntil = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.nextSlot, self.pausedUntil)
+            self.nextSlot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def floodWait(self, seconds):
+        print("FloodWait, pausing requests for " + str(seconds) + " seconds")
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + seconds)
+
+class Backfiller():
+
+    # Pages backwards through the history of each chat with messages.GetHistory. The oldest
+    # message ID fetched so far is stored as the chat's cursor once record() has stored the page,
+    # so an interrupted backfill, or one stopped by maxMessages, resumes where it left off
+
+    def __init__(self, client, storage, scheduler, classify, record, logError, pageSize=100, maxMessages=0, workers=2, resolvePeer=None):
+
+        self.client = client
+        self.resolvePeer = resolvePeer or client.resolve_peer
+        self.storage = storage
+        self.scheduler = scheduler
+        self.classify = classify
+        self.record = record
+        self.logError = logError
+        self.pageSize = pageSize
+        self.maxMessages = maxMessages
+        self.workers = workers
+
+    def run(self, chatIDs):
+        cursors = self.storage.loadBackfillCursors()
+        pending = queue.Queue()
+        for chatID in chatIDs:
+            cursor = cursors.get(chatID, [0, False])
+            if cursor[1]:
+                print("Backfill already complete for: " + str(chatID))
+                continue
+            pending.put((chatID, cursor[0]))
+
+        start = time.monotonic()
+        self.total = 0
+        self.totalLock = threading.Lock()
+        threads = []
+        for i in range(min(self.workers, pending.qsize())):
+            thread = threading.Thread(target=self.work, args=(pending,), name="Backfill-" + str(i), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        print("Backfill finished - " + str(self.total) + " messages recorded in " + "%.1f" % (time.monotonic() - start) + " seconds")
+
+    def work(self, pending):
+        while True:
+            try:
+                chatID, offsetID = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.backfillChat(chatID, offsetID)
+            except:
+                self.logError("Error while backfilling: " + str(chatID))
+
+    def backfillChat(self, chatID, offsetID):
+        print("Backfilling: " + str(chatID) + (" from message " + str(offsetID) if offsetID else ""))
+        peer = self.resolvePeer(chatID)
+        fetched = 0
+        recorded = 0
+
+        while True:
+            self.scheduler.wait()
+            try:
+                history = self.client.send(
+                    functions.messages.GetHistory(
+                        peer=peer,
+                        offset_id=offsetID,
+                        offset_date=0,
+                        add_offset=0,
+                        limit=self.pageSize,
+                        max_id=0,
+                        min_id=0,
+                        hash=0
+                    )
+                )
+            except FloodWait as e:
+                self.scheduler.floodWait(e.x)
+                continue
+
+            if not history.messages:
+                self.storage.saveBackfillCursor(chatID, offsetID, True)
+                break
+
+            chat = next(chat for chat in history.chats if chat.id == chatID)
+            users = {user.id: user for user in history.users}
+            records = []
+            for message in history.messages:
+                # Skips MessageService and MessageEmpty the same way the live path does
+                if not isinstance(message, types.Message):
+                    continue
+                record = self.classify(chat, message, users)
+                if record:
+                    records.append(record)
+            self.record(records)
+
+            offsetID = min(message.id for message in history.messages)
+            fetched += len(history.messages)
+            recorded += len(records)
+            done = len(history.messages) < self.pageSize
+            self.storage.saveBackfillCursor(chatID, offsetID, done)
+            # The cap only ends this run, the next one carries on from the cursor
+            if done or (self.maxMessages > 0 and fetched >= self.maxMessages):
+                break
+
+        with self.totalLock:
+            self.total += recorded
+        print("Backfilled: " + str(chatID) + " - " + str(fetched) + " messages read, " + str(recorded) + " recorded")
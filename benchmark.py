@@ -0,0 +1,300 @@
+from pyrogram.api import functions, types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import argparse, configparser, contextlib
+import json, os, random, resource, shutil
+import sqlite3, sys, tempfile, threading, time
+import TelegramLogAndNotify, update_recorder
+
+# Offline throughput benchmark for TelegramBot.processUpdate. Updates come from a synthetic
+# generator or from a recording made with [recorder] path, and run through the real pipeline
+# with a stub Telegram client, a local SQLite database and a local fake webhook
+#
+#   python benchmark.py --messages 50000
+#   python benchmark.py --replay updates.rec --baseline baseline.json
+#   python benchmark.py --save-baseline baseline.json
+
+class StubClient():
+
+    def __init__(self, admins, latency=0):
+        self.admins = admins
+        self.messages = {}
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def add_handler(self, handler):
+        pass
+
+    def resolve_peer(self, peer):
+        return types.InputPeerChannel(channel_id=peer, access_hash=0)
+
+    def rpc(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def send(self, request):
+        self.rpc()
+        if isinstance(request, functions.channels.GetParticipants):
+            admins = self.admins.get(request.channel.channel_id, []) if request.offset == 0 else []
+            return SimpleNamespace(participants=[SimpleNamespace(user_id=user) for user in admins])
+        if isinstance(request, functions.messages.GetFullChat):
+            participants = [types.ChatParticipantAdmin(user_id=user, inviter_id=0, date=0) for user in self.admins.get(request.chat_id, [])]
+            return SimpleNamespace(full_chat=SimpleNamespace(participants=SimpleNamespace(participants=participants)))
+        if isinstance(request, functions.channels.GetMessages):
+            messages = []
+            users = []
+            for messageID in request.id:
+                message = self.messages.get((request.channel.channel_id, messageID.id))
+                if message is None:
+                    messages.append(types.MessageEmpty(id=messageID.id))
+                    continue
+                messages.append(SimpleNamespace(id=messageID.id, date=message.date, message=message.text, from_id=message.from_user.id if message.from_user else None))
+                if message.from_user:
+                    users.append(message.from_user)
+            return SimpleNamespace(messages=messages, users=users)
+        raise NotImplementedError("Stub client can't answer " + type(request).__name__)
+
+class FakeWebhook():
+
+    def __init__(self, delay=0):
+        self.posts = 0
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if delay:
+                    time.sleep(delay)
+                webhook.posts += 1
+                body = b"ok"
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1]) + "/trigger"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def syntheticUpdates(count, chatCount, userCount, pinnedRatio, adminRatio, seed, stub):
+    # Thirds of the chats are broadcast channels, supergroups and basic groups. Each group has
+    # five admins, adminRatio of the group messages are sent by one of them
+    rnd = random.Random(seed)
+    now = int(time.time())
+    users = [types.User(id=1000 + i, first_name="User", last_name=str(i), username="user" + str(i)) for i in range(userCount)]
+    chats = []
+    for i in range(chatCount):
+        id = 100000 + i
+        if i % 3 == 2:
+            chats.append(types.Chat(id=id, title="Group " + str(i), photo=types.ChatPhotoEmpty(), participants_count=userCount, date=now, version=0))
+        else:
+            chats.append(types.Channel(id=id, title="Channel " + str(i), photo=types.ChatPhotoEmpty(), date=now, version=0, access_hash=id, megagroup=(i % 3 == 1), username="channel" + str(i)))
+        stub.admins[id] = [user.id for user in rnd.sample(users, min(5, userCount))]
+
+    updates = []
+    lastMessage = {}
+    # Channels number their updates on their own, basic groups share the account's common sequence
+    commonPts = 0
+    for i in range(count):
+        chat = rnd.choice(chats)
+        messageID = lastMessage.get(chat.id, 0) + 1
+        text = "Synthetic message " + str(i) + " " + "x" * rnd.randint(0, 200)
+        if isinstance(chat, types.Channel) and not chat.megagroup:
+            sender = None
+        elif rnd.random() < adminRatio:
+            adminID = rnd.choice(stub.admins[chat.id])
+            sender = next(user for user in users if user.id == adminID)
+        else:
+            sender = rnd.choice(users)
+        userMap = {sender.id: sender} if sender else {}
+
+        if isinstance(chat, types.Channel) and lastMessage.get(chat.id) and rnd.random() < pinnedRatio:
+            pinned = lastMessage[chat.id]
+            stub.messages[(chat.id, pinned)] = SimpleNamespace(from_user=sender, date=now, text=text)
+            updates.append((types.UpdateChannelPinnedMessage(channel_id=chat.id, id=pinned), userMap, {chat.id: chat}))
+            continue
+
+        lastMessage[chat.id] = messageID
+        if isinstance(chat, types.Channel):
+            message = types.Message(id=messageID, to_id=types.PeerChannel(channel_id=chat.id), date=now + i, message=text, from_id=sender.id if sender else None)
+            updates.append((types.UpdateNewChannelMessage(message=message, pts=messageID, pts_count=1), userMap, {chat.id: chat}))
+        else:
+            commonPts += 1
+            message = types.Message(id=messageID, to_id=types.PeerChat(chat_id=chat.id), date=now + i, message=text, from_id=sender.id)
+            updates.append((types.UpdateNewMessage(message=message, pts=commonPts, pts_count=1), userMap, {chat.id: chat}))
+    return updates
+
+def recordedUpdates(path):
+    return [(update, users, chats) for received, update, users, chats in update_recorder.readRecording(path)]
+
+def chatsInUpdates(updates):
+    chats = {}
+    for update, users, updateChats in updates:
+        chats.update(updateChats)
+    return chats
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[int(fraction * (len(ordered) - 1))] if ordered else 0.0
+
+def runBenchmark(updates, stub, args):
+    workdir = tempfile.mkdtemp(prefix="telegram-benchmark-")
+    webhook = FakeWebhook(args.webhook_delay)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    for section in ("database", "IFTTT", "metrics", "recorder", "backfill", "entities", "daemon", "journal"):
+        if not config.has_section(section):
+            config.add_section(section)
+    config["database"]["backend"] = "sqlite"
+    config["database"]["sqlite_path"] = os.path.join(workdir, "benchmark.db")
+    config["IFTTT"]["URL"] = webhook.url
+    config["metrics"]["enabled"] = "no"
+    config["recorder"]["path"] = ""
+    config["backfill"]["on_start"] = "no"
+    config["entities"]["path"] = ""
+    config["daemon"]["snapshot_path"] = ""
+    config["journal"]["path"] = os.path.join(workdir, "journal")
+
+    bot = TelegramLogAndNotify.TelegramBot(client=stub)
+    bot.config = config
+    bot.configPath = args.config
+    output = open(os.devnull, "w") if not args.show_output else sys.stdout
+
+    try:
+        with contextlib.redirect_stdout(output):
+            bot.setupDBConnection()
+            bot.setupEntityCache()
+            bot.setupAdminCache()
+            bot.setupMessageCache()
+            bot.setupMedia()
+            bot.setupNotifier()
+            bot.setupAlerts()
+            bot.setupProfiling()
+            bot.setupPipeline()
+            bot.setupRecovery()
+            bot.setupMetrics()
+            bot.setupRetention()
+            bot.setupReadAPI()
+            bot.setupRecorder()
+            bot.setupChatRegistry()
+
+            bot.chats.replaceAll(chatsInUpdates(updates).values())
+            bot.storage.upsertChats([(id, chat[0], chat[1]) for id, chat in bot.chats.items()])
+            bot.monitoredChats = bot.storage.loadMonitoredChats()
+            bot.listening = True
+
+            latencies = []
+            start = time.perf_counter()
+            for update, users, updateChats in updates:
+                handlerStart = time.perf_counter()
+                bot.processUpdate(stub, update, users, updateChats)
+                latencies.append(time.perf_counter() - handlerStart)
+            handled = time.perf_counter()
+            bot.shutdown()
+            drained = time.perf_counter()
+
+        connection = sqlite3.connect(config["database"]["sqlite_path"])
+        stored = connection.execute("SELECT COUNT(*) FROM " + bot.tables["message"]).fetchone()[0]
+        connection.close()
+    finally:
+        webhook.stop()
+        if output is not sys.stdout:
+            output.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "updates": len(updates),
+        "stored": stored,
+        "notifications": webhook.posts,
+        "rpc_calls": stub.calls,
+        "handler_seconds": round(handled - start, 4),
+        "total_seconds": round(drained - start, 4),
+        "updates_per_sec": round(len(updates) / (drained - start), 1),
+        "handler_p50_ms": round(percentile(latencies, 0.50) * 1000, 4),
+        "handler_p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+def compare(results, baseline, tolerance):
+    # Higher is better for throughput, lower is better for latency and memory
+    regressions = []
+    print("\nMETRIC - BASELINE - CURRENT - CHANGE")
+    for key, higherIsBetter in (("updates_per_sec", True), ("handler_p50_ms", False), ("handler_p99_ms", False), ("peak_rss_mb", False)):
+        old = baseline.get(key)
+        new = results[key]
+        if not old:
+            continue
+        change = (new - old) / old
+        print(key + " - " + str(old) + " - " + str(new) + " - " + "%+.1f%%" % (change * 100))
+        if (higherIsBetter and change < -tolerance) or (not higherIsBetter and change > tolerance):
+            regressions.append(key)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for the update processing path")
+    parser.add_argument("--messages", type=int, default=20000, help="number of synthetic updates")
+    parser.add_argument("--chats", type=int, default=30, help="number of synthetic chats")
+    parser.add_argument("--users", type=int, default=500, help="number of synthetic users")
+    parser.add_argument("--pinned-ratio", type=float, default=0.01, help="share of channel updates that are pins")
+    parser.add_argument("--admin-ratio", type=float, default=0.2, help="share of group messages sent by admins")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--replay", help="replay a recording made with [recorder] path instead of synthetic updates")
+    parser.add_argument("--record", help="write the synthetic updates to this recording and exit")
+    parser.add_argument("--rpc-latency", type=float, default=0, help="seconds the stub client sleeps per RPC")
+    parser.add_argument("--webhook-delay", type=float, default=0, help="seconds the fake webhook takes to answer")
+    parser.add_argument("--config", default="config.ini", help="config file for writer/pipeline/notifier settings")
+    parser.add_argument("--baseline", help="compare against results saved with --save-baseline")
+    parser.add_argument("--save-baseline", help="save the results as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression against the baseline")
+    parser.add_argument("--show-output", action="store_true", help="keep the bot's console output")
+    args = parser.parse_args()
+
+    stub = StubClient({}, args.rpc_latency)
+    if args.replay:
+        updates = recordedUpdates(args.replay)
+        print("Loaded " + str(len(updates)) + " recorded updates from " + args.replay)
+    else:
+        updates = syntheticUpdates(args.messages, args.chats, args.users, args.pinned_ratio, args.admin_ratio, args.seed, stub)
+        print("Generated " + str(len(updates)) + " synthetic updates")
+
+    if args.record:
+        recorder = update_recorder.UpdateRecorder(args.record)
+        for update, users, chats in updates:
+            recorder.record(update, users, chats)
+        recorder.close()
+        return
+
+    results = runBenchmark(updates, stub, args)
+    print()
+    for key in results:
+        print(key + ": " + str(results[key]))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print("\nSaved baseline to " + args.save_baseline)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressed beyond " + "%.0f%%" % (args.tolerance * 100) + ": " + ", ".join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+from pyrogram.api import types
+from collections import namedtuple
+import threading
+import zlib
+
+DEFAULT_SESSION = "Listener"
+
+# Indexable like the old [title, username] lists: chat[0] is the title, chat[1] the username
+ChatRecord = namedtuple("ChatRecord", ["title", "username", "kind"])
+
+class ChatRegistry():
+
+    # Joined chats indexed by ID and by lowercased username, with the supergroup IDs kept
+    # as a set. Single chats can be updated in place without refetching the whole list.
+    # With several accounts, every chat also knows which sessions joined it and which one owns it
+
+    def __init__(self):
+        self.records = {}
+        self.usernames = {}
+        self.supergroupIDs = set()
+        self.members = {}
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def makeRecord(self, chat):
+        username = ("@" if hasattr(chat, "username") and chat.username else "") + (str(chat.username) if hasattr(chat, "username") else "None")
+        if isinstance(chat, types.Channel):
+            kind = "supergroup" if chat.megagroup == True else "channel"
+        else:
+            kind = "group"
+        return ChatRecord(str(chat.title), username, kind)
+
+    def isMember(self, chat):
+        # Chats we were kicked from or left still show up in GetAllChats/update maps
+        if isinstance(chat, (types.ChatForbidden, types.ChannelForbidden, types.ChatEmpty)):
+            return False
+        return not getattr(chat, "left", False) and not getattr(chat, "deactivated", False)
+
+    def replaceAll(self, chats, session=DEFAULT_SESSION):
+        # Everything session joined, chats missing from the list are left by that session only
+        records = {chat.id: self.makeRecord(chat) for chat in chats if self.isMember(chat)}
+        with self.lock:
+            for chatID in list(self.members):
+                if chatID not in records:
+                    self.leave(chatID, session)
+            for chatID, record in records.items():
+                self.join(chatID, record, session)
+
+    def apply(self, chat, session=DEFAULT_SESSION):
+        if not self.isMember(chat):
+            return self.remove(chat.id, session)
+        record = self.makeRecord(chat)
+        with self.lock:
+            self.join(chat.id, record, session)
+        return True
+
+    def remove(self, chatID, session=DEFAULT_SESSION):
+        with self.lock:
+            return self.leave(chatID, session)
+
+    def join(self, chatID, record, session):
+        # Called with the lock held
+        self.unindex(chatID)
+        self.records[chatID] = record
+        if record.username != "None":
+            self.usernames[record.username.lower()] = chatID
+        if record.kind == "supergroup":
+            self.supergroupIDs.add(chatID)
+        members = self.members.setdefault(chatID, set())
+        if session not in members:
+            members.add(session)
+            self.owners.pop(chatID, None)
+
+    def leave(self, chatID, session):
+        # Called with the lock held
+        members = self.members.get(chatID)
+        if not members or session not in members:
+            return False
+        members.discard(session)
+        self.owners.pop(chatID, None)
+        if not members:
+            del self.members[chatID]
+            self.unindex(chatID)
+            del self.records[chatID]
+        return True
+
+    def owner(self, chatID):
+        # Rendezvous hashing: stable across restarts, and adding or removing an account only
+        # moves the chats that account wins or owned
+        owner = self.owners.get(chatID)
+        if owner is None:
+            with self.lock:
+                members = self.members.get(chatID)
+                if not members:
+                    return None
+                owner = max(members, key=lambda session: zlib.crc32((session + ":" + str(chatID)).encode()))
+                self.owners[chatID] = owner
+        return owner
+
+    def sessions(self, chatID):
+        with self.lock:
+            return set(self.members.get(chatID, ()))
+
+    def unindex(self, chatID):
+        # Called with the lock held
+        old = self.records.get(chatID)
+        if old:
+            if self.usernames.get(old.username.lower()) == chatID:
+                del self.usernames[old.username.lower()]
+            self.supergroupIDs.discard(chatID)
+
+    def byUsername(self, username):
+        return self.usernames.get(username.lower())
+
+    def supergroups(self):
+        with self.lock:
+            return set(self.supergroupIDs)
+
+    def snapshot(self):
+        with self.lock:
+            return [[chatID, record.title, record.username, record.kind, sorted(self.members.get(chatID, ()))] for chatID, record in self.records.items()]
+
+    def restore(self, snapshot):
+        with self.lock:
+            for chatID, title, username, kind, sessions in snapshot:
+                for session in sessions:
+                    self.join(chatID, ChatRecord(title, username, kind), session)
+
+    def __contains__(self, chatID):
+        return chatID in self.records
+
+    def __getitem__(self, chatID):
+        return self.records[chatID]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(list(self.records))
+
+    def items(self):
+        with self.lock:
+            return list(self.records.items())
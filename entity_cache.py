@@ -0,0 +1,91 @@
+from pyrogram.api.core import Object
+from collections import OrderedDict
+from io import BytesIO
+import json
+import os
+import threading
+
+class EntityCache():
+
+    # Formatted chat/sender info and resolved input peers keyed by ("chat"|"user", Telegram ID).
+    # Peers are kept per session, every account gets its own access hashes.
+    # Least recently used entries are evicted above maxEntries, the cache is saved on shutdown
+    # and loaded on start so a restart doesn't resolve every peer again
+
+    def __init__(self, path=None, maxEntries=50000):
+
+        self.path = path
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self, kind, id, key, build):
+        # key holds the fields the info is formatted from, a different key means the entity was renamed
+        with self.lock:
+            entry = self.entries.get((kind, id))
+            if entry and entry["key"] == key and entry["info"] is not None:
+                self.entries.move_to_end((kind, id))
+                self.hits += 1
+                return entry["info"]
+            self.misses += 1
+        info = build()
+        with self.lock:
+            entry = self.entries.get((kind, id))
+            if entry:
+                # A rename doesn't change the access hash, the peer stays valid
+                entry["key"] = key
+                entry["info"] = info
+                self.entries.move_to_end((kind, id))
+            else:
+                self.add((kind, id), {"key": key, "info": info, "peers": {}})
+        return info
+
+    def peer(self, id, resolve, session=""):
+        with self.lock:
+            entry = self.entries.get(("chat", id))
+            if entry and session in entry["peers"]:
+                self.entries.move_to_end(("chat", id))
+                return entry["peers"][session]
+        peer = resolve(id)
+        with self.lock:
+            entry = self.entries.get(("chat", id))
+            if entry:
+                entry["peers"][session] = peer
+            else:
+                self.add(("chat", id), {"key": None, "info": None, "peers": {session: peer}})
+        return peer
+
+    def forget(self, kind, id):
+        with self.lock:
+            self.entries.pop((kind, id), None)
+
+    def add(self, entryKey, entry):
+        # Called with the lock held
+        self.entries[entryKey] = entry
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as file:
+            saved = json.load(file)
+        with self.lock:
+            for kind, id, key, info, peers in saved[-self.maxEntries:]:
+                peers = {session: Object.read(BytesIO(bytes.fromhex(peer))) for session, peer in peers.items()}
+                self.entries[(kind, id)] = {"key": tuple(key) if key else None, "info": info, "peers": peers}
+        return len(self.entries)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            # Oldest first so loading keeps the LRU order
+            saved = [[kind, id, entry["key"], entry["info"], {session: peer.write().hex() for session, peer in entry["peers"].items()}] for (kind, id), entry in self.entries.items()]
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(saved, file)
+        os.replace(temporary, self.path)
+        print("Entity cache saved - " + str(len(saved)) + " entries, " + str(self.hits) + " hits, " + str(self.misses) + " misses")
@@ -0,0 +1,76 @@
+from datetime import datetime
+import queue
+import threading
+import time
+
+class ErrorLog():
+
+    # Appends errors to path from a thread of its own, so a burst of failures never waits on the
+    # disk. An error identical to one logged less than window seconds ago is only counted, the
+    # count is written once the window has passed
+
+    def __init__(self, path="errors.log", window=60, queueSize=1000):
+
+        self.path = path
+        self.window = window
+
+        self.queue = queue.Queue(queueSize)
+        self.recent = {}
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="ErrorLog", daemon=True)
+        self.thread.start()
+
+    def log(self, key, entry):
+        # Returns False when the error was suppressed as a repeat
+        now = time.monotonic()
+        with self.lock:
+            seen = self.recent.get(key)
+            if seen and now - seen["since"] < self.window:
+                seen["repeats"] += 1
+                return False
+            self.recent[key] = {"since": now, "repeats": 0}
+        self.enqueue(entry)
+        return True
+
+    def enqueue(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def expire(self, everything=False):
+        now = time.monotonic()
+        with self.lock:
+            expired = [(key, seen) for key, seen in self.recent.items() if everything or now - seen["since"] >= self.window]
+            for key, seen in expired:
+                del self.recent[key]
+        return ["\n" + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " - " + key[0] + " - " + key[1] + " repeated " + str(seen["repeats"]) + " more times within " + str(self.window) + " seconds\n"
+                for key, seen in expired if seen["repeats"]]
+
+    def run(self):
+        while True:
+            try:
+                entries = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                entries = []
+            # Errors arriving together go out in a single write
+            while entries and entries[-1] is not None and not self.queue.empty():
+                entries.append(self.queue.get_nowait())
+            closing = bool(entries) and entries[-1] is None
+            text = "".join(entry for entry in entries if entry) + "".join(self.expire(closing))
+            if text:
+                with open(self.path, "a") as logfile:
+                    logfile.write(text)
+            for entry in entries:
+                self.queue.task_done()
+            if closing:
+                return
+
+    def flush(self):
+        # Waits until everything logged so far is on disk
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,168 @@
+from datetime import datetime
+import argparse, configparser, csv, gzip
+import io, json, os, queue, threading, time
+import storage, TelegramLogAndNotify
+
+# Streams the message archive to a file without holding more than a few batches in memory
+#
+#   python export.py messages.jsonl.gz
+#   python export.py admin.csv.gz --type admin --since 2020-01-01 --until 2020-12-31
+#   python export.py messages.parquet --state export.state.json     (only rows added since the last run)
+
+COLUMNS = ("ID", "Time", "Type", "Chat", "TelegramMessageID", "SenderID", "SenderName", "SenderUsername", "Message", "MediaType", "MediaID")
+
+class JSONLinesWriter():
+
+    def __init__(self, file):
+        self.file = io.TextIOWrapper(file, encoding="utf-8", newline="\n")
+
+    def write(self, rows):
+        self.file.write("".join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows))
+
+    def close(self):
+        self.file.close()
+
+class CSVWriter():
+
+    def __init__(self, file):
+        self.file = io.TextIOWrapper(file, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter():
+
+    # Parquet compresses per column itself, rows are collected into row groups of rowGroupSize
+
+    def __init__(self, path, compression, rowGroupSize=100000):
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet export needs pyarrow (pip install pyarrow)")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([("ID", pyarrow.int64()), ("Time", pyarrow.string()), ("Type", pyarrow.string()), ("Chat", pyarrow.int64()), ("TelegramMessageID", pyarrow.int64()),
+                                      ("SenderID", pyarrow.int64()), ("SenderName", pyarrow.string()), ("SenderUsername", pyarrow.string()), ("Message", pyarrow.string()),
+                                      ("MediaType", pyarrow.string()), ("MediaID", pyarrow.int64())])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=compression if compression != "none" else None)
+        self.rowGroupSize = rowGroupSize
+        self.pending = []
+
+    def write(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= self.rowGroupSize:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            columns = list(zip(*self.pending))
+            self.writer.write_table(self.pyarrow.Table.from_arrays([self.pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)], schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def openWriter(path, format, compression, level):
+    if format == "parquet":
+        return ParquetWriter(path, compression if compression != "gzip" else "zstd")
+    file = gzip.open(path, "wb", compresslevel=level) if compression == "gzip" else open(path, "wb")
+    return JSONLinesWriter(file) if format == "jsonl" else CSVWriter(file)
+
+def normalize(rows):
+    # MySQL hands back datetimes, SQLite the text it stored
+    return [(row[0], str(row[1]) if isinstance(row[1], datetime) else row[1]) + tuple(row[2:]) for row in rows]
+
+def readAhead(batches, depth):
+    # Reads the next batches from the database while the current one is compressed and written
+    pending = queue.Queue(depth)
+    failure = []
+
+    def read():
+        try:
+            for rows in batches:
+                pending.put(rows)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            pending.put(None)
+
+    threading.Thread(target=read, name="ExportReader", daemon=True).start()
+    while True:
+        rows = pending.get()
+        if rows is None:
+            break
+        yield rows
+    if failure:
+        raise failure[0]
+
+def dayBoundary(value, end):
+    if value is None:
+        return None
+    day = datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    return day + (" 23:59:59" if end else " 00:00:00")
+
+def main():
+    parser = argparse.ArgumentParser(description="Export recorded messages to JSON lines, CSV or Parquet")
+    parser.add_argument("output", help="file to write, the format is taken from the extension unless --format is given")
+    parser.add_argument("--format", choices=("jsonl", "csv", "parquet"))
+    parser.add_argument("--compression", choices=("gzip", "zstd", "snappy", "none"), default="gzip", help="gzip or none for JSON lines/CSV, any of them for Parquet (gzip means zstd there)")
+    parser.add_argument("--level", type=int, default=6, help="gzip compression level")
+    parser.add_argument("--chat", type=int, help="only this chat ID")
+    parser.add_argument("--type", choices=storage.MESSAGE_TYPES)
+    parser.add_argument("--since", help="YYYY-MM-DD, inclusive")
+    parser.add_argument("--until", help="YYYY-MM-DD, inclusive")
+    parser.add_argument("--after-id", type=int, default=0, help="only messages with a larger ID")
+    parser.add_argument("--state", help="resume after the last ID exported with this state file and update it when done")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="rows per database query")
+    parser.add_argument("--batch-size", type=int, default=2000, help="rows fetched from the server at a time")
+    parser.add_argument("--config", default="config.ini")
+    args = parser.parse_args()
+
+    format = args.format or next((name for name in ("jsonl", "csv", "parquet") if args.output.replace(".gz", "").endswith("." + name)), "jsonl")
+    if format != "parquet" and args.compression not in ("gzip", "none"):
+        parser.error("--compression " + args.compression + " is only available for Parquet, JSON lines and CSV take gzip or none")
+    afterID = args.after_id
+    if args.state and os.path.exists(args.state):
+        with open(args.state) as file:
+            afterID = max(afterID, json.load(file)["last_id"])
+        print("Resuming after message ID " + str(afterID))
+
+    bot = TelegramLogAndNotify.TelegramBot()
+    bot.config = configparser.ConfigParser()
+    bot.config.read(args.config)
+    # Read-only connections, an export never creates tables or runs migrations
+    bot.openStorage(readOnly=True)
+    if not bot.storage.schemaIsCurrent():
+        bot.storage.close()
+        raise SystemExit("The database schema is missing or out of date, start the bot once to migrate it before exporting")
+
+    writer = openWriter(args.output, format, args.compression, args.level)
+    batches = bot.storage.exportMessages(afterID, args.chat, args.type, dayBoundary(args.since, False), dayBoundary(args.until, True), args.chunk_size, args.batch_size)
+    count = 0
+    lastID = afterID
+    start = time.monotonic()
+    try:
+        for rows in readAhead(batches, 4):
+            writer.write(normalize(rows))
+            count += len(rows)
+            lastID = rows[-1][0]
+            if count % 1000000 < len(rows):
+                print(str(count) + " rows exported, " + "%.0f" % (count / (time.monotonic() - start)) + " rows/s")
+    finally:
+        writer.close()
+        bot.storage.close()
+
+    print("Exported " + str(count) + " messages to " + args.output + " in " + "%.1f" % (time.monotonic() - start) + " seconds" + (", last ID " + str(lastID) if count else ""))
+    if args.state:
+        temporary = args.state + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"last_id": lastID, "exported": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, file)
+        os.replace(temporary, args.state)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+from pyrogram.api import functions, types
+from pyrogram.api.errors import FloodWait
+import backfill
+import metrics
+import queue
+import threading
+import time
+
+def channelOf(update):
+    # The channel whose pts sequence an update belongs to, None for the account's common sequence
+    channelID = getattr(update, "channel_id", None)
+    if channelID is None:
+        peer = getattr(getattr(update, "message", None), "to_id", None)
+        if isinstance(peer, types.PeerChannel):
+            channelID = peer.channel_id
+    return channelID
+
+def channelKey(chatID):
+    return ("", chatID)
+
+def commonKey(session):
+    return (session, 0)
+
+class UpdateState():
+
+    # Where the bot stands in Telegram's update sequences: the pts of every channel and the common
+    # (pts, qts, date) of every account. Gaps are found from the latest update seen, but what is saved
+    # and recovered from stops short of the oldest update the pipeline isn't done with, so an update it
+    # drops or fails on is fetched again. Saved every interval seconds, always the values from one
+    # interval earlier so the writer has stored what they cover. A held sequence is being recovered
+    # and isn't saved until it is complete
+
+    def __init__(self, storage, logError, interval=5):
+
+        self.storage = storage
+        self.logError = logError
+        self.interval = interval
+
+        self.values = {}
+        self.seen = {}
+        self.pending = {}
+        self.saved = {}
+        self.previous = {}
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def load(self):
+        self.values = dict(self.storage.loadUpdateState())
+        self.seen = dict(self.values)
+        self.saved = dict(self.values)
+        self.previous = dict(self.values)
+        return len(self.values)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="UpdateState", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.save()
+            except:
+                self.logError("Error while saving the update state")
+
+    def channel(self, chatID):
+        with self.lock:
+            value = self.values.get(channelKey(chatID))
+        return value[0] if value else None
+
+    def common(self, session):
+        with self.lock:
+            return self.values.get(commonKey(session))
+
+    def sequence(self, session, update):
+        # (key, pts) of an update, (None, None) for updates outside the pts sequences
+        pts = getattr(update, "pts", None)
+        if not pts:
+            return None, None
+        channelID = channelOf(update)
+        return (commonKey(session) if channelID is None else channelKey(channelID)), pts
+
+    def observe(self, session, update):
+        # Called for every update seen while listening. Returns the channel ID, or 0 for the common
+        # sequence, when the update shows that updates before it were missed. The sequence then stays
+        # where it was until recovery fetched the missing part. Any other new update is pending until
+        # finish() is called for it
+        key, pts = self.sequence(session, update)
+        if key is None:
+            return None
+        count = getattr(update, "pts_count", 0) or 0
+        with self.lock:
+            known = self.seen.get(key)
+            if known is None:
+                # A common state needs qts and date as well, recovery asks for it with updates.GetState
+                if key[1] == 0:
+                    return None
+                known = (pts - count, 0, 0)
+            pending = self.pending.setdefault(key, {})
+            if pts <= known[0]:
+                # Another account's copy of an update that is still pending
+                if pts in pending:
+                    pending[pts][1] += 1
+                return None
+            if pts - count > known[0]:
+                return key[1]
+            date = getattr(getattr(update, "message", None), "date", None) or known[2]
+            self.seen[key] = (pts, max(getattr(update, "qts", 0) or 0, known[1]), max(date, known[2]))
+            pending[pts] = [pts - count, 1]
+            self.settle(key)
+        return None
+
+    def finish(self, session, update):
+        # The pipeline is done with an update. One it dropped or failed on is never finished, its
+        # sequence stays before it until advance() moves past it
+        key, pts = self.sequence(session, update)
+        if key is None:
+            return
+        with self.lock:
+            pending = self.pending.get(key, {})
+            entry = pending.get(pts)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if not entry[1]:
+                del pending[pts]
+            self.settle(key)
+
+    def advance(self, key, pts, qts=0, date=0):
+        # Recovery fetched everything up to pts, updates still pending before it are covered
+        with self.lock:
+            known = self.seen.get(key, (0, 0, 0))
+            self.seen[key] = (max(pts, known[0]), max(qts, known[1]), max(date, known[2]))
+            pending = self.pending.get(key, {})
+            for covered in [covered for covered in pending if covered <= pts]:
+                del pending[covered]
+            self.settle(key)
+
+    def settle(self, key):
+        # Called with the lock held
+        seen = self.seen[key]
+        pending = self.pending.get(key)
+        self.values[key] = (min(entry[0] for entry in pending.values()), seen[1], seen[2]) if pending else seen
+
+    def hold(self, key):
+        with self.lock:
+            if key in self.held:
+                return False
+            self.held.add(key)
+            return True
+
+    def release(self, key):
+        with self.lock:
+            self.held.discard(key)
+
+    def save(self, final=False):
+        # final saves what is in memory right away, for shutdown once the writer has drained
+        with self.lock:
+            current = dict(self.values)
+            due = current if final else self.previous
+            self.previous = current
+            rows = [key + value for key, value in due.items() if key not in self.held and self.saved.get(key) != value]
+        if rows:
+            self.storage.saveUpdateState(rows)
+            for row in rows:
+                self.saved[row[:2]] = row[2:]
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        try:
+            self.save(True)
+        except:
+            self.logError("Error while saving the update state")
+
+class GapRecovery():
+
+    # Fetches the updates missed while the bot was down, disconnected or not listening yet:
+    # updates.GetChannelDifference from the saved pts of every monitored channel and supergroup, and
+    # updates.GetDifference from the common state of every account for basic groups. Differences come
+    # in pages of pageSize messages, classified like history and handed to record() a page at a time.
+    # Channels are spread over workers that share each account's rate limit. A gap seen while
+    # listening is recovered in the background through schedule()
+
+    def __init__(self, state, clients, resolvePeer, classify, record, wanted, logError, pageSize=100, workers=8, requestsPerSecond=20):
+
+        self.state = state
+        self.clients = clients
+        self.resolvePeer = resolvePeer
+        self.classify = classify
+        self.record = record
+        self.wanted = wanted
+        self.logError = logError
+        self.pageSize = pageSize
+        self.workers = workers
+        self.schedulers = {session: backfill.RateScheduler(requestsPerSecond) for session in clients}
+
+        self.queue = queue.Queue()
+        self.scheduled = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.recoveredMessages = metrics.registry.counter("telegram_gap_messages_total", "Messages recorded from update differences after a gap")
+        self.tooLong = metrics.registry.counter("telegram_gap_too_long_total", "Gaps longer than Telegram replays, the messages before them need a backfill")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="GapRecovery", daemon=True)
+        self.thread.start()
+
+    def catchUp(self, channels):
+        # channels: [(session, chatID)] of the monitored channels and supergroups, each with its owner
+        start = time.monotonic()
+        pending = queue.Queue()
+        for session in self.clients:
+            pending.put((session, None))
+        for session, chatID in channels:
+            pending.put((session, chatID))
+        self.total = 0
+        self.totalLock = threading.Lock()
+        threads = []
+        for i in range(min(self.workers, pending.qsize())):
+            thread = threading.Thread(target=self.work, args=(pending,), name="GapRecovery-" + str(i), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        print("Caught up with missed updates - " + str(self.total) + " messages recorded in " + "%.1f" % (time.monotonic() - start) + " seconds")
+        return self.total
+
+    def work(self, pending):
+        while True:
+            try:
+                session, chatID = pending.get_nowait()
+            except queue.Empty:
+                return
+            recorded = self.recover(session, chatID)
+            with self.totalLock:
+                self.total += recorded
+
+    def schedule(self, session, chatID=None):
+        # Recovers one channel, or the common sequence of an account when chatID is None, in the background.
+        # Every update after a gap reports it again until recovery is done, it is queued once
+        item = (session, chatID or None)
+        with self.lock:
+            if item in self.scheduled:
+                return
+            self.scheduled.add(item)
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.recover(*item)
+            with self.lock:
+                self.scheduled.discard(item)
+
+    def recover(self, session, chatID):
+        key = commonKey(session) if chatID is None else channelKey(chatID)
+        # Already being recovered, whatever it fetches covers this gap too
+        if not self.state.hold(key):
+            return 0
+        try:
+            return self.recoverCommon(session) if chatID is None else self.recoverChannel(session, chatID)
+        except:
+            self.logError("Error while recovering missed updates for: " + (session if chatID is None else str(chatID)))
+            return 0
+        finally:
+            self.state.release(key)
+
+    def request(self, session, query):
+        scheduler = self.schedulers[session]
+        while True:
+            scheduler.wait()
+            try:
+                return self.clients[session].send(query)
+            except FloodWait as e:
+                scheduler.floodWait(e.x)
+
+    def recoverChannel(self, session, chatID):
+        peer = self.resolvePeer(chatID, session)
+        channel = types.InputChannel(channel_id=peer.channel_id, access_hash=peer.access_hash)
+        key = channelKey(chatID)
+        pts = self.state.channel(chatID)
+        if pts is None:
+            # Never seen before, its current pts is where recovery starts next time. Channel dialogs carry it
+            dialogs = self.request(session, functions.messages.GetPeerDialogs(peers=[types.InputDialogPeer(peer=peer)]))
+            self.state.advance(key, dialogs.dialogs[0].pts)
+            return 0
+
+        recorded = 0
+        while True:
+            difference = self.request(session, functions.updates.GetChannelDifference(channel=channel, filter=types.ChannelMessagesFilterEmpty(), pts=pts, limit=self.pageSize))
+            if isinstance(difference, types.updates.ChannelDifferenceEmpty):
+                self.state.advance(key, difference.pts)
+                break
+            if isinstance(difference, types.updates.ChannelDifferenceTooLong):
+                # Only the latest messages come back, the ones before them are left to a backfill
+                print("Missed too many updates in " + str(chatID) + ", recording the latest " + str(len(difference.messages)) + " messages only")
+                self.tooLong.inc()
+                recorded += self.store(session, difference.messages, difference.chats, difference.users)
+                pts = difference.pts
+            else:
+                recorded += self.store(session, difference.new_messages, difference.chats, difference.users)
+                pts = difference.pts
+            self.state.advance(key, pts)
+            if difference.final:
+                break
+        if recorded:
+            print("Recovered " + str(recorded) + " missed messages in " + str(chatID))
+        return recorded
+
+    def recoverCommon(self, session):
+        key = commonKey(session)
+        common = self.state.common(session)
+        if common is None:
+            state = self.request(session, functions.updates.GetState())
+            self.state.advance(key, state.pts, state.qts, state.date)
+            return 0
+
+        pts, qts, date = common
+        recorded = 0
+        while True:
+            difference = self.request(session, functions.updates.GetDifference(pts=pts, date=date, qts=qts))
+            if isinstance(difference, types.updates.DifferenceEmpty):
+                self.state.advance(key, pts, qts, difference.date)
+                break
+            if isinstance(difference, types.updates.DifferenceTooLong):
+                print("Missed too many updates for " + session + ", basic group messages before now are left to a backfill")
+                self.tooLong.inc()
+                pts = difference.pts
+                self.state.advance(key, pts, qts, date)
+                continue
+            recorded += self.store(session, difference.new_messages, difference.chats, difference.users)
+            state = difference.intermediate_state if isinstance(difference, types.updates.DifferenceSlice) else difference.state
+            pts, qts, date = state.pts, state.qts, state.date
+            self.state.advance(key, pts, qts, date)
+            if not isinstance(difference, types.updates.DifferenceSlice):
+                break
+        if recorded:
+            print("Recovered " + str(recorded) + " missed basic group messages for " + session)
+        return recorded
+
+    def store(self, session, messages, chats, users):
+        chats = {chat.id: chat for chat in chats}
+        users = {user.id: user for user in users}
+        records = []
+        for message in messages:
+            # Skips MessageService and MessageEmpty the same way the live path does
+            if not isinstance(message, types.Message):
+                continue
+            peer = message.to_id
+            if isinstance(peer, types.PeerChannel):
+                chatID = peer.channel_id
+            elif isinstance(peer, types.PeerChat):
+                chatID = peer.chat_id
+            else:
+                continue
+            if chatID not in chats or not self.wanted(chatID, session):
+                continue
+            record = self.classify(chats[chatID], message, users)
+            if record:
+                records.append(record)
+        recorded = self.record(records)
+        self.recoveredMessages.inc(amount=recorded)
+        return recorded
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
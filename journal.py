@@ -0,0 +1,199 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+# Every record is a header of (payload length, crc32 of the payload) followed by a JSON list of rows
+HEADER = struct.Struct("<II")
+
+class Journal():
+
+    # Append-only local journal of message rows the database didn't take yet, kept in numbered
+    # segment files under path. Appends are flushed to the OS right away and fsynced at most
+    # every syncInterval seconds by a thread of its own. The read position survives restarts in
+    # a cursor file, segments behind it are deleted. A corrupt record is skipped and reading goes on
+    # at the next whole record with a valid checksum, only a write cut off at the end of the newest
+    # segment is truncated. Rows the database keeps rejecting go to quarantine.jsonl, one per line
+
+    def __init__(self, path, segmentSize=16 * 1024 * 1024, syncInterval=0.2):
+
+        self.path = path
+        self.segmentSize = segmentSize
+        self.syncInterval = syncInterval
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.segment = 0
+        self.end = (0, 0)
+        self.cursor = (0, 0)
+        self.unsynced = False
+        self.stopping = threading.Event()
+        self.thread = None
+        self.corrupt = 0
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        cursorPath = os.path.join(self.path, "cursor")
+        if os.path.exists(cursorPath):
+            with open(cursorPath) as file:
+                self.cursor = tuple(json.load(file))
+        segments = self.segments()
+        self.segment = segments[-1] if segments else max(self.cursor[0], 1)
+        # Whatever follows the last readable record of the newest segment is a write that was cut off
+        length = self.validLength(self.segment)
+        self.file = open(self.segmentPath(self.segment), "ab")
+        if self.file.tell() > length:
+            self.file.truncate(length)
+            self.file.seek(length)
+        self.end = (self.segment, length)
+        if not segments or self.cursor > self.end:
+            self.cursor = self.end
+        elif self.cursor < (segments[0], 0):
+            self.cursor = (segments[0], 0)
+        self.thread = threading.Thread(target=self.run, name="JournalSync", daemon=True)
+        self.thread.start()
+        return self
+
+    def segments(self):
+        return sorted(int(name[:-len(".journal")]) for name in os.listdir(self.path) if name.endswith(".journal"))
+
+    def segmentPath(self, segment):
+        return os.path.join(self.path, "%012d.journal" % segment)
+
+    def validLength(self, segment):
+        length = 0
+        # Corrupt records in it are reported once read() gets to them
+        for payload, end in self.records(segment, 0, report=False):
+            length = end
+        return length
+
+    def readSegment(self, segment, offset, limit=None):
+        if not os.path.exists(self.segmentPath(segment)):
+            return b""
+        with open(self.segmentPath(segment), "rb") as file:
+            file.seek(offset)
+            return file.read() if limit is None else file.read(max(limit - offset, 0))
+
+    def records(self, segment, offset, limit=None, report=True):
+        # Yields (payload, offset after the record) from offset up to limit, payload None for a corrupt
+        # stretch that was skipped. Stops at the end or where no readable record follows
+        data = self.readSegment(segment, offset, limit)
+        position = 0
+        while position + HEADER.size <= len(data):
+            end = self.recordEnd(data, position)
+            if end:
+                yield data[position + HEADER.size:end], offset + end
+                position = end
+                continue
+            resumed = next((candidate for candidate in range(position + 1, len(data) - HEADER.size + 1) if self.recordEnd(data, candidate)), None)
+            if resumed is None:
+                return
+            if report:
+                self.corrupt += 1
+                print("Skipped " + str(resumed - position) + " corrupt bytes in journal segment " + str(segment) + " at offset " + str(offset + position))
+            position = resumed
+            yield None, offset + position
+
+    def recordEnd(self, data, position):
+        # End of the record starting at position, None unless it is whole with a valid checksum. Rows are
+        # never empty, a run of zero bytes isn't taken for empty records
+        length, checksum = HEADER.unpack_from(data, position)
+        end = position + HEADER.size + length
+        if length and end <= len(data) and zlib.crc32(data[position + HEADER.size:end]) == checksum:
+            return end
+        return None
+
+    def append(self, rows):
+        payload = json.dumps(rows, separators=(",", ":")).encode("utf-8")
+        with self.lock:
+            if self.end[1] and self.end[1] + HEADER.size + len(payload) > self.segmentSize:
+                self.roll()
+            self.file.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.file.flush()
+            self.end = (self.segment, self.end[1] + HEADER.size + len(payload))
+            self.unsynced = True
+
+    def roll(self):
+        # Called with the lock held
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.segmentPath(self.segment), "ab")
+        self.end = (self.segment, 0)
+        self.unsynced = False
+
+    def run(self):
+        while not self.stopping.wait(self.syncInterval):
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced and self.file:
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+
+    def pending(self):
+        with self.lock:
+            return self.cursor < self.end
+
+    def read(self, maxRows):
+        # (rows, position) with up to maxRows rows from whole records after the cursor, pass
+        # position to acknowledge once the rows are stored
+        with self.lock:
+            end = self.end
+        segment, offset = self.cursor
+        rows = []
+        while (segment, offset) < end and len(rows) < maxRows:
+            limit = end[1] if segment == end[0] else None
+            for payload, recordEnd in self.records(segment, offset, limit):
+                if payload is not None:
+                    rows.extend(json.loads(payload.decode("utf-8")))
+                offset = recordEnd
+                if len(rows) >= maxRows:
+                    return rows, (segment, offset)
+            if segment == end[0]:
+                # Nothing readable is left before the end, move past it rather than reading it again and again
+                return rows, end
+            # Done with this segment, or the rest of it is unreadable
+            segment, offset = segment + 1, 0
+        return rows, (segment, offset)
+
+    def quarantine(self, rows):
+        # Rows the database rejects one by one, kept for a look instead of blocking the rows after them
+        with open(os.path.join(self.path, "quarantine.jsonl"), "a", encoding="utf-8") as file:
+            file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def acknowledge(self, position):
+        with self.lock:
+            self.cursor = position
+            active = self.segment
+        temporary = os.path.join(self.path, "cursor.tmp")
+        with open(temporary, "w") as file:
+            json.dump(list(position), file)
+        os.replace(temporary, os.path.join(self.path, "cursor"))
+        for segment in self.segments():
+            if segment < position[0] and segment != active:
+                os.remove(self.segmentPath(segment))
+
+    def backlogBytes(self):
+        with self.lock:
+            cursor = self.cursor
+        total = 0
+        for segment in self.segments():
+            if segment >= cursor[0]:
+                total += os.path.getsize(self.segmentPath(segment)) - (cursor[1] if segment == cursor[0] else 0)
+        return max(total, 0)
+
+    def close(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.sync()
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,174 @@
+from pyrogram.api import functions, types
+from pyrogram.api.errors import FileMigrate, FloodWait
+from pyrogram.session import Auth, Session
+import hashlib
+import metrics
+import os
+import queue
+import threading
+import time
+
+def describeMedia(message):
+    # {"type", "id", "size", "mime", "location", "dc"} for a message with media, location is the
+    # input file location to download it from or None when there is nothing to download, dc the
+    # data center holding the file
+    media = getattr(message, "media", None)
+    if isinstance(media, types.MessageMediaPhoto) and isinstance(media.photo, types.Photo):
+        sizes = [size for size in media.photo.sizes if isinstance(size, (types.PhotoSize, types.PhotoCachedSize)) and isinstance(size.location, types.FileLocation)]
+        if not sizes:
+            return {"type": "photo", "id": media.photo.id, "size": 0, "mime": "image/jpeg", "location": None, "dc": None}
+        largest = max(sizes, key=lambda size: size.w * size.h)
+        location = types.InputFileLocation(volume_id=largest.location.volume_id, local_id=largest.location.local_id, secret=largest.location.secret)
+        size = largest.size if isinstance(largest, types.PhotoSize) else len(largest.bytes)
+        return {"type": "photo", "id": media.photo.id, "size": size, "mime": "image/jpeg", "location": location, "dc": largest.location.dc_id}
+    if isinstance(media, types.MessageMediaDocument) and isinstance(media.document, types.Document):
+        document = media.document
+        video = any(isinstance(attribute, types.DocumentAttributeVideo) for attribute in document.attributes)
+        location = types.InputDocumentFileLocation(id=document.id, access_hash=document.access_hash, version=document.version)
+        return {"type": "video" if video else "document", "id": document.id, "size": document.size, "mime": document.mime_type, "location": location, "dc": document.dc_id}
+    if media is not None and not isinstance(media, types.MessageMediaEmpty):
+        return {"type": "other", "id": None, "size": 0, "mime": None, "location": None, "dc": None}
+    return None
+
+def mediaSession(client, dcID):
+    # The client's download session for a data center, opened the way Client.get_file opens it so
+    # download_media and the archiver share one session per DC
+    with client.media_sessions_lock:
+        session = client.media_sessions.get(dcID)
+        if session is None:
+            if dcID != client.dc_id:
+                exported = client.send(functions.auth.ExportAuthorization(dc_id=dcID))
+                session = Session(dcID, client.test_mode, client.proxy, Auth(dcID, client.test_mode, client.proxy).create(), client.api_id)
+                session.start()
+                client.media_sessions[dcID] = session
+                session.send(functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes))
+            else:
+                session = Session(dcID, client.test_mode, client.proxy, client.auth_key, client.api_id)
+                session.start()
+                client.media_sessions[dcID] = session
+    return session
+
+class MediaArchiver():
+
+    # Downloads media of recorded messages into a content-addressed store (<path>/ab/cd/<sha256>)
+    # from a few worker threads. Files are streamed in chunkSize pieces and hashed on the way,
+    # a media ID already in the media table or content already in the store is not kept twice
+
+    def __init__(self, storage, clientFor, logError, path, workers=2, queueSize=100, chunkSize=512 * 1024, maxSize=0, mediaTypes=("photo", "video", "document")):
+
+        self.storage = storage
+        self.clientFor = clientFor
+        self.logError = logError
+        self.path = path
+        self.workers = workers
+        self.chunkSize = chunkSize
+        self.maxSize = maxSize
+        self.mediaTypes = mediaTypes
+
+        self.queue = queue.Queue(queueSize)
+        self.threads = []
+        self.inFlight = set()
+        self.lock = threading.Lock()
+        self.outcomes = metrics.registry.counter("telegram_media_total", "Media files by outcome", ["outcome"])
+        self.downloadedBytes = metrics.registry.counter("telegram_media_bytes_total", "Bytes downloaded into the media store")
+
+    def start(self):
+        os.makedirs(os.path.join(self.path, "tmp"), exist_ok=True)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name="Media-" + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, chatID, media):
+        # Never blocks, media arriving faster than it downloads is skipped
+        if media["location"] is None or media["type"] not in self.mediaTypes:
+            return False
+        if self.maxSize and media["size"] > self.maxSize:
+            self.outcomes.inc("too_large")
+            return False
+        with self.lock:
+            if media["id"] in self.inFlight:
+                self.outcomes.inc("duplicate")
+                return False
+            self.inFlight.add(media["id"])
+        try:
+            self.queue.put_nowait((chatID, media))
+        except queue.Full:
+            with self.lock:
+                self.inFlight.discard(media["id"])
+            self.outcomes.inc("dropped")
+            return False
+        return True
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            chatID, media = item
+            try:
+                self.outcomes.inc(self.archive(chatID, media))
+            except:
+                self.logError("Error while downloading " + media["type"] + " " + str(media["id"]) + " from: " + str(chatID))
+                self.outcomes.inc("failed")
+            finally:
+                with self.lock:
+                    self.inFlight.discard(media["id"])
+
+    def archive(self, chatID, media):
+        if self.storage.findMedia(media["id"]):
+            return "duplicate"
+
+        temporary = os.path.join(self.path, "tmp", str(media["id"]) + ".part")
+        digest = hashlib.sha256()
+        size = 0
+        client = self.clientFor(chatID)
+        dcID = media["dc"] or client.dc_id
+        try:
+            with open(temporary, "wb") as file:
+                while True:
+                    try:
+                        result = mediaSession(client, dcID).send(functions.upload.GetFile(location=media["location"], offset=size, limit=self.chunkSize))
+                    except FloodWait as e:
+                        time.sleep(e.x)
+                        continue
+                    except FileMigrate as e:
+                        # The file moved since the message was sent, the same chunk comes from its new DC
+                        dcID = e.x
+                        continue
+                    if not isinstance(result, types.upload.File):
+                        raise ValueError("Unexpected " + type(result).__name__ + " while downloading")
+                    chunk = result.bytes
+                    file.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    if len(chunk) < self.chunkSize:
+                        break
+            hash = digest.hexdigest()
+            target = self.pathFor(hash)
+            if os.path.exists(target):
+                outcome = "duplicate_content"
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(temporary, target)
+                outcome = "downloaded"
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+        self.downloadedBytes.inc(amount=size)
+        self.storage.saveMedia(media["id"], hash, size, media["mime"])
+        return outcome
+
+    def pathFor(self, hash):
+        return os.path.join(self.path, hash[0:2], hash[2:4], hash)
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        for i in range(self.workers):
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
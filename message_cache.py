@@ -0,0 +1,122 @@
+from pyrogram.api import functions, types
+from pyrogram.api.errors import FloodWait
+from collections import OrderedDict
+import threading
+import time
+
+class RecentMessages():
+
+    # The last perChat messages seen in each chat as (date, senderInfo, text), so a pin of a
+    # message we just received doesn't need to download it again
+
+    def __init__(self, perChat=200):
+
+        self.perChat = perChat
+        self.chats = {}
+        self.lock = threading.Lock()
+
+    def add(self, chatID, messageID, date, senderInfo, text):
+        if self.perChat <= 0:
+            return
+        with self.lock:
+            messages = self.chats.get(chatID)
+            if messages is None:
+                messages = self.chats[chatID] = OrderedDict()
+            messages[messageID] = (date, senderInfo, text)
+            if len(messages) > self.perChat:
+                messages.popitem(last=False)
+
+    def get(self, chatID, messageID):
+        with self.lock:
+            messages = self.chats.get(chatID)
+            return messages.get(messageID) if messages else None
+
+class PinFetcher():
+
+    # Downloads pinned messages that are neither cached nor stored. Requests arriving within
+    # window seconds of each other are sent as one channels.GetMessages per channel
+
+    def __init__(self, client, resolvePeer, logError, window=0.05, batchSize=100, clientFor=None):
+
+        self.client = client
+        self.clientFor = clientFor or (lambda chatID: client)
+        self.resolvePeer = resolvePeer
+        self.logError = logError
+        self.window = window
+        self.batchSize = batchSize
+
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.requests = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="PinFetcher", daemon=True)
+        self.thread.start()
+
+    def fetch(self, channelID, messageID):
+        # Blocks until the batch holding this message was sent. Returns (date, sender, text)
+        # with sender a User or None, or None if the message doesn't exist
+        with self.lock:
+            request = self.pending.get((channelID, messageID))
+            if request is None:
+                request = self.pending[(channelID, messageID)] = {"done": threading.Event(), "result": None}
+                self.wake.set()
+        request["done"].wait()
+        return request["result"]
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            if self.stopping.is_set() and not self.pending:
+                return
+            # Give pins arriving together the chance to join this batch
+            time.sleep(self.window)
+            with self.lock:
+                batch = self.pending
+                self.pending = {}
+                self.wake.clear()
+
+            channels = {}
+            for channelID, messageID in batch:
+                channels.setdefault(channelID, []).append(messageID)
+            for channelID, messageIDs in channels.items():
+                for i in range(0, len(messageIDs), self.batchSize):
+                    chunk = messageIDs[i:i + self.batchSize]
+                    try:
+                        results = self.getMessages(channelID, chunk)
+                    except:
+                        self.logError("Error while fetching pinned messages for: " + str(channelID))
+                        results = {}
+                    for messageID in chunk:
+                        request = batch[(channelID, messageID)]
+                        request["result"] = results.get(messageID)
+                        request["done"].set()
+
+    def getMessages(self, channelID, messageIDs):
+        peer = self.resolvePeer(channelID)
+        channel = types.InputChannel(channel_id=peer.channel_id, access_hash=peer.access_hash)
+        while True:
+            try:
+                self.requests += 1
+                result = self.clientFor(channelID).send(functions.channels.GetMessages(channel=channel, id=[types.InputMessageID(id=messageID) for messageID in messageIDs]))
+                break
+            except FloodWait as e:
+                time.sleep(e.x)
+
+        users = {user.id: user for user in result.users}
+        messages = {}
+        for message in result.messages:
+            if isinstance(message, types.MessageEmpty):
+                continue
+            messages[message.id] = (message.date, users.get(message.from_id) if message.from_id else None, message.message)
+        return messages
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
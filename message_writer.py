@@ -0,0 +1,248 @@
+import metrics
+import queue
+import threading
+import time
+
+class MessageWriter():
+
+    # Write-behind writer: rows are queued by the update handler and flushed by a
+    # background thread in batches, one executemany and one commit per batch. A batch the database
+    # rejects is retried row by row so one bad row only loses itself, unless the first probeRows rows
+    # all fail too and the database itself is the likely problem
+    # With a journal, a batch the database takes none of is appended to the journal instead of being
+    # lost, and so is every batch after it while the journal holds rows or the queue is more than
+    # half full. A replay thread moves the journal into the database in replayBatchSize chunks
+    # once the database takes writes again. A chunk that failed poisonRetries times in a row while
+    # the database answers otherwise is replayed row by row, and the rows it still rejects are
+    # quarantined so the rows behind them go on
+
+    def __init__(self, storage, logError, batchSize=500, flushInterval=1.0, queueSize=10000, report=False, journal=None, replayBatchSize=5000, retryInterval=5.0, probeRows=3, poisonRetries=3):
+
+        self.storage = storage
+        self.logError = logError
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.report = report
+        self.journal = journal
+        self.replayBatchSize = replayBatchSize
+        self.retryInterval = retryInterval
+        self.probeRows = probeRows
+        self.poisonRetries = poisonRetries
+
+        self.queue = queue.Queue(queueSize)
+        self.highWater = queueSize // 2
+        self.thread = None
+        self.replayThread = None
+        self.listeners = []
+        self.replayWake = threading.Event()
+        self.stopping = threading.Event()
+        self.stats = {"flushes": 0, "rows": 0, "failed": 0, "journaled": 0, "replayed": 0, "quarantined": 0, "lastSize": 0, "lastLatency": 0.0, "maxLatency": 0.0, "totalLatency": 0.0}
+        self.statsLock = threading.Lock()
+        self.flushTime = metrics.registry.histogram("telegram_db_flush_seconds", "Time spent writing one batch of messages to the database")
+        self.flushSize = metrics.registry.histogram("telegram_db_flush_rows", "Messages written per database batch", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+        self.flushFailures = metrics.registry.counter("telegram_db_flush_failures_total", "Messages in batches the database rejected")
+        self.journalRows = metrics.registry.counter("telegram_journal_rows_total", "Messages through the local journal, by direction", ["direction"])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="MessageWriter", daemon=True)
+        self.thread.start()
+        if self.journal:
+            self.replayThread = threading.Thread(target=self.replay, name="JournalReplay", daemon=True)
+            self.replayThread.start()
+
+    def addListener(self, listener):
+        # listener(rows) is called from the writer threads with every batch the database stored
+        self.listeners.append(listener)
+
+    def notifyListeners(self, rows):
+        for listener in self.listeners:
+            try:
+                listener(rows)
+            except:
+                self.logError("Error in database writer listener")
+
+    def write(self, row):
+        # Blocks when the queue is full so a stuck database slows the handler down instead of eating memory
+        self.queue.put(row)
+
+    def writeBatch(self, rows):
+        # Bulk rows, from a backfill page for one, stored right away by the calling thread with the same
+        # journal fallback and listeners as queued rows. Raises when they made it into neither
+        if not self.store(rows):
+            raise IOError("Neither the database nor the journal took " + str(len(rows)) + " messages")
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.replayThread:
+            self.stopping.set()
+            self.replayWake.set()
+            self.replayThread.join()
+            self.replayThread = None
+        if self.journal:
+            backlog = self.journal.backlogBytes()
+            self.journal.close()
+            if backlog:
+                print("Journal holds " + str(backlog) + " bytes of messages, they are written to the database on the next start")
+        print("Message writer stopped - " + self.summary())
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.flushInterval
+        while True:
+            timeout = deadline - time.monotonic()
+            try:
+                row = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                if row is None:
+                    self.flush(batch)
+                    return
+                batch.append(row)
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batchSize or time.monotonic() >= deadline:
+                self.flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flushInterval
+
+    def flush(self, batch):
+        self.store(batch)
+
+    def store(self, batch):
+        # True once the batch is in the database or the journal
+        if not batch:
+            return True
+        # Once rows wait in the journal, newer ones queue up behind them rather than retrying a database that just failed
+        if self.journal and (self.journal.pending() or self.queue.qsize() >= self.highWater):
+            return self.toJournal(batch)
+        start = time.monotonic()
+        try:
+            self.storage.insertMessages(batch)
+            stored, failed = batch, []
+        except:
+            stored, failed = self.insertRows(batch)
+        latency = (time.monotonic() - start) * 1000
+        if not stored and self.journal:
+            result = self.toJournal(batch)
+        else:
+            self.recordFlush(len(batch), latency, len(failed))
+            # Rows the database rejected on their own are lost, like they were before batching
+            result = bool(stored)
+        if stored:
+            self.notifyListeners(stored)
+        if self.report:
+            print("Database flush - " + str(len(batch)) + " messages in " + "%.1f" % latency + " ms" + ("" if not failed else " (" + str(len(failed)) + " rejected)" if stored else " (journaled)" if self.journal else " (failed)"))
+        return result
+
+    def insertRows(self, batch, probe=True):
+        # (stored, failed) rows of a batch the database rejected, inserted one at a time
+        stored = []
+        failed = []
+        for row in batch:
+            try:
+                self.storage.insertMessages([row])
+            except:
+                self.logError("Error while writing message " + str(row[3]) + " in " + str(row[2]) + " to the database")
+                failed.append(row)
+                if probe and not stored and len(failed) >= self.probeRows:
+                    return [], batch
+                continue
+            stored.append(row)
+        return stored, failed
+
+    def toJournal(self, batch):
+        try:
+            self.journal.append(batch)
+        except:
+            self.logError("Error while appending " + str(len(batch)) + " updates to the journal")
+            self.recordFlush(len(batch), 0.0, len(batch))
+            return False
+        self.journalRows.inc("in", amount=len(batch))
+        with self.statsLock:
+            self.stats["journaled"] += len(batch)
+        self.replayWake.set()
+        return True
+
+    def replay(self):
+        failures = 0
+        while not self.stopping.is_set():
+            if not self.journal.pending():
+                self.replayWake.wait(self.retryInterval)
+                self.replayWake.clear()
+                continue
+            try:
+                rows, position = self.journal.read(self.replayBatchSize)
+            except:
+                self.logError("Error while reading the journal, retrying in " + str(self.retryInterval) + " seconds")
+                self.stopping.wait(self.retryInterval)
+                continue
+            start = time.monotonic()
+            try:
+                if rows:
+                    self.storage.insertMessages(rows)
+            except:
+                failures += 1
+                self.logError("Error while replaying the journal into the database, retrying in " + str(self.retryInterval) + " seconds")
+                if failures < self.poisonRetries or not self.databaseAnswers():
+                    self.stopping.wait(self.retryInterval)
+                    continue
+                try:
+                    rows = self.replayRows(rows)
+                except:
+                    self.logError("Error while quarantining journaled messages, retrying in " + str(self.retryInterval) + " seconds")
+                    self.stopping.wait(self.retryInterval)
+                    continue
+            failures = 0
+            self.journal.acknowledge(position)
+            if rows:
+                self.recordFlush(len(rows), (time.monotonic() - start) * 1000)
+                self.notifyListeners(rows)
+                self.journalRows.inc("out", amount=len(rows))
+                with self.statsLock:
+                    self.stats["replayed"] += len(rows)
+
+    def replayRows(self, rows):
+        # The stored rows of a chunk replayed row by row, the rest go to the quarantine
+        stored, failed = self.insertRows(rows, False)
+        if failed:
+            self.journal.quarantine(failed)
+            print("Quarantined " + str(len(failed)) + " journaled messages the database keeps rejecting")
+            self.flushFailures.inc(amount=len(failed))
+            with self.statsLock:
+                self.stats["quarantined"] += len(failed)
+        return stored
+
+    def databaseAnswers(self):
+        # A failing chunk is only the rows' fault while the database answers other queries
+        try:
+            return self.storage.schemaIsCurrent()
+        except:
+            return False
+
+    def recordFlush(self, size, latency, failed=0):
+        self.flushTime.observe(latency / 1000)
+        self.flushSize.observe(size)
+        if failed:
+            self.flushFailures.inc(amount=failed)
+        with self.statsLock:
+            self.stats["flushes"] += 1
+            self.stats["lastSize"] = size
+            self.stats["lastLatency"] = latency
+            self.stats["totalLatency"] += latency
+            self.stats["maxLatency"] = max(self.stats["maxLatency"], latency)
+            self.stats["rows"] += size - failed
+            self.stats["failed"] += failed
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def journalBacklog(self):
+        return self.journal.backlogBytes() if self.journal else 0
+
+    def summary(self):
+        with self.statsLock:
+            stats = dict(self.stats)
+        average = stats["totalLatency"] / stats["flushes"] if stats["flushes"] else 0.0
+        return (str(stats["rows"]) + " messages written in " + str(stats["flushes"]) + " flushes, "
+                + str(stats["failed"]) + " failed, " + str(stats["journaled"]) + " journaled, " + str(stats["replayed"]) + " replayed, " + str(stats["quarantined"]) + " quarantined, avg flush " + "%.1f" % average + " ms, max " + "%.1f" % stats["maxLatency"] + " ms")
@@ -0,0 +1,167 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import contextlib
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def formatLabels(names, values, extra=""):
+    pairs = [name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter():
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labelValues, amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            values = dict(self.values)
+        return [self.name + formatLabels(self.labels, key) + " " + formatValue(value) for key, value in values.items()]
+
+class Histogram():
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labelValues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labelValues)
+            if entry is None:
+                entry = self.values[labelValues] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            entry["counts"][index] += 1
+            entry["sum"] += value
+
+    @contextlib.contextmanager
+    def time(self, *labelValues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelValues)
+
+    def collect(self):
+        with self.lock:
+            values = {key: (list(entry["counts"]), entry["sum"]) for key, entry in self.values.items()}
+        lines = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(self.name + "_bucket" + formatLabels(self.labels, key, 'le="' + formatValue(bound) + '"') + " " + str(cumulative))
+            lines.append(self.name + "_sum" + formatLabels(self.labels, key) + " " + formatValue(total))
+            lines.append(self.name + "_count" + formatLabels(self.labels, key) + " " + str(cumulative))
+        return lines
+
+class Callback():
+
+    # Values read at scrape time, for state other components already keep (pool stats, queue sizes).
+    # The function returns a number, or a dict of label value tuples to numbers
+
+    def __init__(self, name, help, labels, function, type="gauge"):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.type = type
+
+    def collect(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [self.name + formatLabels(self.labels, key) + " " + formatValue(value) for key, value in values.items()]
+
+class Registry():
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def register(self, metric):
+        with self.lock:
+            # Registering the same name again returns the existing metric, components can be recreated
+            if metric.name in self.metrics and not isinstance(metric, Callback):
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, labels, function, type="gauge"):
+        return self.register(Callback(name, help, labels, function, type))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.type)
+            try:
+                lines.extend(metric.collect())
+            except Exception:
+                # A callback for a component that is gone, leave the metric empty
+                pass
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="Metrics", daemon=True).start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+registry = Registry()
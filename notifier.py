@@ -0,0 +1,119 @@
+import metrics
+import queue
+import threading
+import time
+import requests
+
+class NotificationDispatcher():
+
+    # Sends webhook notifications from a small worker pool so the update handler only enqueues.
+    # With a digest window, notifications for the same chat arriving within the window are merged into one.
+    # A full queue makes send wait up to enqueueTimeout seconds for a worker before the notification is dropped
+
+    def __init__(self, url, logError, workers=2, queueSize=1000, timeout=10, retries=3, backoff=1.0, digestWindow=0, enqueueTimeout=30):
+
+        self.url = url
+        self.logError = logError
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.digestWindow = digestWindow
+        self.enqueueTimeout = enqueueTimeout
+
+        self.queue = queue.Queue(queueSize)
+        self.threads = []
+        self.digests = {}
+        self.digestLock = threading.Lock()
+        self.stopping = threading.Event()
+        self.dropped = 0
+        self.postTime = metrics.registry.histogram("telegram_webhook_seconds", "Time spent posting one notification to the webhook, retries included")
+        self.outcomes = metrics.registry.counter("telegram_notifications_total", "Notifications by outcome", ["outcome"])
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name="Notifier-" + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.digestWindow > 0:
+            thread = threading.Thread(target=self.digest, name="NotifierDigest", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def send(self, chatID, text):
+        if self.digestWindow > 0:
+            with self.digestLock:
+                if chatID in self.digests:
+                    self.digests[chatID]["texts"].append(text)
+                else:
+                    self.digests[chatID] = {"texts": [text], "due": time.monotonic() + self.digestWindow}
+        else:
+            self.enqueue(text)
+
+    def enqueue(self, text):
+        try:
+            self.queue.put(text, timeout=self.enqueueTimeout)
+        except queue.Full:
+            self.dropped += 1
+            self.outcomes.inc("dropped")
+
+    def digest(self):
+        while True:
+            now = time.monotonic()
+            with self.digestLock:
+                due = [chatID for chatID in self.digests if self.digests[chatID]["due"] <= now or self.stopping.is_set()]
+                ready = [self.digests.pop(chatID)["texts"] for chatID in due]
+                nextDue = min([digest["due"] for digest in self.digests.values()], default=now + self.digestWindow)
+            for texts in ready:
+                self.enqueue(self.mergeTexts(texts))
+            if self.stopping.is_set():
+                return
+            self.stopping.wait(max(nextDue - now, 0.05))
+
+    def mergeTexts(self, texts):
+        if len(texts) == 1:
+            return texts[0]
+        return str(len(texts)) + " notifications\n\n" + "\n\n- - -\n\n".join(texts)
+
+    def work(self):
+        # One keep-alive session per worker, requests.Session is not meant to be shared between threads
+        session = requests.Session()
+        while True:
+            text = self.queue.get()
+            if text is None:
+                session.close()
+                return
+            with self.postTime.time():
+                self.post(session, text)
+
+    def post(self, session, text):
+        data = {"value1": text}
+        for attempt in range(self.retries + 1):
+            try:
+                response = session.post(self.url, data=data, timeout=self.timeout)
+                if response.status_code < 500 and response.status_code != 429:
+                    self.outcomes.inc("sent")
+                    return
+            except requests.RequestException:
+                if attempt == self.retries:
+                    self.logError("Error while sending notification to phone")
+                    self.outcomes.inc("failed")
+                    return
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        print("Giving up on notification after " + str(self.retries + 1) + " attempts")
+        self.outcomes.inc("failed")
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        self.stopping.set()
+        if self.digestWindow > 0 and self.threads:
+            # The digest thread is started last, let it hand over what it still holds
+            self.threads[-1].join()
+        for i in range(self.workers):
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
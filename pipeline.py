@@ -0,0 +1,145 @@
+import queue
+import threading
+
+POLICIES = ("block", "drop_newest", "drop_oldest")
+
+class Stage():
+
+    # A bounded queue with its own worker threads. The handler returns the item to hand to the
+    # next stage, or None to stop processing it. Items travel as (item, trace, submitted) with trace
+    # None unless a tracer follows them and submitted the item as it entered the pipeline. Once an
+    # item is done, dropped or failed its trace is finished and done(submitted, outcome) is called,
+    # outcome None unless it was dropped or failed
+
+    def __init__(self, name, handler, workers, queueSize, policy, logError, tracer=None, done=None):
+
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy: " + policy)
+
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.policy = policy
+        self.logError = logError
+        self.tracer = tracer
+        self.done = done
+
+        self.queue = queue.Queue(queueSize)
+        self.next = None
+        self.threads = []
+        self.dropped = 0
+        self.processed = 0
+        self.counterLock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name="Stage-" + self.name + "-" + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        if self.policy == "block":
+            self.queue.put(item)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                if self.policy == "drop_newest":
+                    self.countDropped(item)
+                    return
+            try:
+                oldest = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            if oldest is None:
+                # A sentinel, put it back and shed the new item instead
+                self.queue.put(oldest)
+                self.countDropped(item)
+                return
+            self.countDropped(oldest)
+
+    def countDropped(self, envelope):
+        with self.counterLock:
+            self.dropped += 1
+        if envelope[1]:
+            envelope[1].mark(self.name + " queue")
+        self.finish(envelope, "dropped at " + self.name)
+
+    def finish(self, envelope, outcome=None):
+        item, trace, submitted = envelope
+        if trace:
+            self.tracer.finish(trace, outcome)
+        if self.done:
+            try:
+                self.done(submitted, outcome)
+            except:
+                self.logError("Error in " + self.name + " stage while finishing update")
+
+    def work(self):
+        while True:
+            envelope = self.queue.get()
+            if envelope is None:
+                return
+            item, trace, submitted = envelope
+            result = None
+            outcome = None
+            if trace:
+                self.tracer.enter(trace, self.name)
+            try:
+                result = self.handler(item)
+            except:
+                outcome = "failed at " + self.name
+                self.logError("Error in " + self.name + " stage while processing update")
+            else:
+                with self.counterLock:
+                    self.processed += 1
+            finally:
+                if trace:
+                    self.tracer.leave(trace, self.name, result)
+            if result is not None and self.next:
+                self.next.put((result, trace, submitted))
+            else:
+                self.finish(envelope, outcome)
+
+    def stop(self):
+        # Sentinels always block, they must not be shed by the drop policies
+        for i in range(self.workers):
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+class Pipeline():
+
+    def __init__(self, logError, policy="block", tracer=None, done=None):
+
+        self.logError = logError
+        self.policy = policy
+        self.tracer = tracer
+        self.done = done
+        self.stages = []
+
+    def addStage(self, name, handler, workers=1, queueSize=1000):
+        stage = Stage(name, handler, workers, queueSize, self.policy, self.logError, self.tracer, self.done)
+        if self.stages:
+            self.stages[-1].next = stage
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def submit(self, item):
+        self.stages[0].put((item, self.tracer.begin(item) if self.tracer else None, item))
+
+    def depths(self):
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def stop(self):
+        # Stop stage by stage so every stage is empty before the one after it is told to stop
+        for stage in self.stages:
+            stage.stop()
+        print("Pipeline drained - " + ", ".join(stage.name + ": " + str(stage.processed) + " processed, " + str(stage.dropped) + " dropped" for stage in self.stages))
@@ -0,0 +1,130 @@
+from collections import Counter
+from datetime import datetime
+import contextlib
+import metrics
+import os
+import re
+import sys
+import threading
+import time
+
+NOOP = contextlib.nullcontext()
+
+class SamplingProfiler():
+
+    # Takes the stack of every thread each interval seconds for a while and writes them as folded
+    # stacks ("thread;outer;...;inner count" per line) that flamegraph.pl and speedscope read.
+    # Nothing runs between profiles
+
+    def __init__(self, path="profiles", interval=0.005):
+
+        self.path = path
+        self.interval = interval
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self, duration):
+        # False if a profile is already being taken
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return False
+            self.thread = threading.Thread(target=self.run, args=(duration,), name="Profiler", daemon=True)
+            self.thread.start()
+        print("Profiling for " + str(duration) + " seconds")
+        return True
+
+    def run(self, duration):
+        stacks = Counter()
+        samples = 0
+        own = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            names = {thread.ident: re.sub(r"-\d+$", "", thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")")
+                    frame = frame.f_back
+                stack.append(names.get(ident, "unknown"))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, "profile-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".folded")
+        with open(path, "w") as file:
+            file.write("".join(stack + " " + str(count) + "\n" for stack, count in stacks.most_common()))
+        print("Profile written to " + path + " - " + str(samples) + " samples, " + str(len(stacks)) + " distinct stacks")
+
+class Trace():
+
+    # Time spent by one update waiting in each stage queue and running each stage, with the
+    # spans opened inside a stage
+
+    __slots__ = ("start", "last", "marks", "spans", "item")
+
+    def __init__(self, item):
+        self.start = self.last = time.monotonic()
+        self.marks = []
+        self.spans = []
+        self.item = item
+
+    def mark(self, name, spans=()):
+        now = time.monotonic()
+        self.marks.append((name, now - self.last, spans))
+        self.last = now
+
+class SlowUpdateTracer():
+
+    # Follows every update through the pipeline and logs the breakdown of any update that took
+    # longer than threshold seconds from submit to its last stage. A threshold of 0 turns it off,
+    # begin() then returns None and span() a shared no-op context
+
+    def __init__(self, threshold=1.0, describe=None):
+
+        self.threshold = threshold
+        self.describe = describe or (lambda item: "")
+        self.current = threading.local()
+        self.slowUpdates = metrics.registry.counter("telegram_slow_updates_total", "Updates that took longer than the slow update threshold")
+
+    def begin(self, item):
+        return Trace(item) if self.threshold > 0 else None
+
+    def enter(self, trace, stage):
+        trace.mark(stage + " queue")
+        trace.spans = []
+        self.current.trace = trace
+
+    def leave(self, trace, stage, result):
+        self.current.trace = None
+        trace.mark(stage, trace.spans)
+        if result is not None:
+            trace.item = result
+
+    def span(self, name):
+        trace = getattr(self.current, "trace", None) if self.threshold > 0 else None
+        return self.timeSpan(trace, name) if trace else NOOP
+
+    @contextlib.contextmanager
+    def timeSpan(self, trace, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            trace.spans.append((name, time.monotonic() - start))
+
+    def finish(self, trace, outcome=None):
+        # outcome says why an update stopped short, "dropped at filter" or "failed at enrich"
+        total = time.monotonic() - trace.start
+        if total < self.threshold:
+            return
+        self.slowUpdates.inc()
+        breakdown = ", ".join(name + " " + "%.3f" % seconds + (" [" + ", ".join(span + " " + "%.3f" % spent for span, spent in spans) + "]" if spans else "") for name, seconds, spans in trace.marks)
+        try:
+            description = self.describe(trace.item)
+        except Exception:
+            description = ""
+        print("Slow update" + (" " + outcome if outcome else "") + (" - " + description if description else "") + " - " + "%.3f" % total + " s: " + breakdown)
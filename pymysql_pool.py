@@ -4,11 +4,24 @@ email: chaoyuemyself@hotmail.com
 """
 import pymysql
 import warnings
-import queue
 import logging
 import threading
+import collections
+import contextlib
+import time
+
+
+def set_warning_filters():
+    """
+    Raise server warnings as errors, except MySQL 8.0.20+ flagging VALUES() in ON DUPLICATE KEY UPDATE as deprecated (1287):
+    the row alias replacing it is unknown to MariaDB and MySQL before 8.0.19, and pymysql only batches executemany inserts without it
+    """
+    warnings.filterwarnings('error', category=pymysql.err.Warning)
+    warnings.filterwarnings('ignore', message=r"\(1287, \"'VALUES function' is deprecated", category=pymysql.err.Warning)
+
+
+set_warning_filters()
 
-warnings.filterwarnings('error', category=pymysql.err.Warning)
 # use logging module for easy debug
 logging.basicConfig(format='%(asctime)s %(levelname)8s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger(__name__)
@@ -22,6 +35,7 @@ class Connection(pymysql.connections.Connection):
         the __exit__() method additionally put the connection back to it's pool
     """
     _pool = None
+    _in_pool = False
     _reusable_expection = (pymysql.err.ProgrammingError, pymysql.err.IntegrityError, pymysql.err.NotSupportedError)
 
     def __init__(self, *args, **kwargs):
@@ -33,27 +47,18 @@ class Connection(pymysql.connections.Connection):
         """
         Overwrite the __exit__() method of pymysql.connections.Connection
         Base action: on successful exit, commit. On exception, rollback
-        With pool additional action: put connection back to pool
+        With pool additional action: put connection back to pool, or drop it if the error left it unusable
         """
-        pymysql.connections.Connection.__exit__(self, exc, value, traceback)
-        if self._pool:
-            if not exc or exc in self._reusable_expection:
-                '''reusable connection'''
-                self._pool.put_connection(self)
+        try:
+            if exc:
+                self.rollback()
             else:
-                '''no reusable connection, close it and create a new one then put it to the pool'''
-                self._pool.put_connection(self._recreate(*self.args, **self.kwargs))
-                self._pool = None
-                try:
-                    self.close()
-                    logger.warning("Close not reusable connection from pool({}) caused by {}".format(self._pool.name, value))
-                except Exception:
-                    pass
-
-    def _recreate(self, *args, **kwargs):
-        conn = Connection(*args, **kwargs)
-        logger.debug('Create new connection due to pool({}) lacking'.format(self._pool.name))
-        return conn
+                self.commit()
+        finally:
+            if self._pool:
+                self._pool.release(self, broken=bool(exc) and not issubclass(exc, self._reusable_expection))
+            else:
+                pymysql.connections.Connection.close(self)
 
     def close(self):
         """
@@ -91,54 +96,189 @@ class ConnectionPool:
     Return connection_pool object, which has method can get connection from a pool with timeout and retry feature;
     put a reusable connection back to the pool, etc; also we can create different instance of this class that represent
     different pool of different DB Server or different user
+
+    The pool keeps at least size connections and grows lazily up to max_size when every connection is in use.
+    Connections idle for longer than ping_after seconds are pinged on checkout and replaced if dead, connections
+    above size idle for longer than idle_timeout seconds are closed.
     """
     _HARD_LIMIT = 100
-    _THREAD_LOCAL = threading.local()
-    _THREAD_LOCAL.retry_counter = 0  # a counter used for debug get_connection() method
 
-    def __init__(self, size=5, name=None, *args, **kwargs):
-        self._pool = queue.Queue(self._HARD_LIMIT)
+    def __init__(self, size=5, name=None, *args, max_size=None, idle_timeout=300, ping_after=30, **kwargs):
+        self.min_size = min(size, self._HARD_LIMIT)
+        self.max_size = min(max(max_size or size, self.min_size), self._HARD_LIMIT)
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.args = args
+        self.kwargs = kwargs
         self.name = name if name else '-'.join(
             [kwargs.get('host', 'localhost'), str(kwargs.get('port', 3306)),
              kwargs.get('user', ''), kwargs.get('database', '')])
-        for _ in range(size if size < self._HARD_LIMIT else self._HARD_LIMIT):
-            conn = Connection(*args, **kwargs)
-            conn._pool = self
-            self._pool.put(conn)
+
+        # idle connections as (connection, last used), oldest on the left
+        self._idle = collections.deque()
+        self._total = 0
+        self._in_use = 0
+        self._lock = threading.Condition()
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_time': 0.0, 'timeouts': 0, 'creations': 0,
+                       'failures': 0, 'validations': 0, 'evictions': 0}
+
+        for _ in range(self.min_size):
+            conn = self._create()
+            self._total += 1
+            self._idle.append((conn, time.monotonic()))
+            conn._in_pool = True
+
+    def _create(self):
+        try:
+            conn = Connection(*self.args, **self.kwargs)
+        except Exception:
+            with self._lock:
+                self._stats['failures'] += 1
+            raise
+        conn._pool = self
+        with self._lock:
+            self._stats['creations'] += 1
+        logger.debug('Create new connection in pool({})'.format(self.name))
+        return conn
+
+    def _discard(self, conn):
+        conn._pool = None
+        try:
+            pymysql.connections.Connection.close(conn)
+        except Exception:
+            pass
 
     def get_connection(self, timeout=1, retry_num=1):
         """
         timeout: timeout of get a connection from pool, should be a int(0 means return or raise immediately)
-        retry_num: how many times will retry to get a connection
+        retry_num: how many times will retry to get a connection, the total wait is timeout * (retry_num + 1)
         """
+        start = time.monotonic()
+        deadline = start + timeout * (retry_num + 1)
+        waited = False
+        evicted = []
+        with self._lock:
+            evicted = self._evict()
+            while True:
+                if self._idle:
+                    # take the most recently used connection, so surplus ones can go idle and be evicted
+                    conn, last_used = self._idle.pop()
+                    conn._in_pool = False
+                    break
+                if self._total < self.max_size:
+                    self._total += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise GetConnectionFromPoolError("can't get connection from pool({}) within {} second(s)".format(
+                        self.name, timeout * (retry_num + 1)))
+                waited = True
+                self._lock.wait(remaining)
+            self._in_use += 1
+
+        for old in evicted:
+            self._discard(old)
+
         try:
-            conn = self._pool.get(timeout=timeout) if timeout > 0 else self._pool.get_nowait()
-            logger.debug('Get connection from pool({})'.format(self.name))
+            if conn is None:
+                conn = self._create()
+            elif time.monotonic() - last_used > self.ping_after:
+                conn = self._validate(conn)
+        except Exception:
+            with self._lock:
+                self._total -= 1
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+            self._stats['wait_time'] += time.monotonic() - start
+        logger.debug('Get connection from pool({})'.format(self.name))
+        return conn
+
+    def _validate(self, conn):
+        with self._lock:
+            self._stats['validations'] += 1
+        try:
+            conn.ping(reconnect=False)
             return conn
-        except queue.Empty:
-            if retry_num > 0:
-                self._THREAD_LOCAL.retry_counter += 1
-                logger.debug('Retry get connection from pool({}), the {} times'.format(self.name, self._THREAD_LOCAL.retry_counter))
-                retry_num -= 1
-                return self.get_connection(timeout, retry_num)
-            else:
-                total_times = self._THREAD_LOCAL.retry_counter + 1
-                self._THREAD_LOCAL.retry_counter = 0
-                raise GetConnectionFromPoolError("can't get connection from pool({}) within {}*{} second(s)".format(
-                    self.name, timeout, total_times))
+        except Exception:
+            logger.warning('Replace dead connection in pool({})'.format(self.name))
+            self._discard(conn)
+            return self._create()
+
+    def _evict(self):
+        # called with the lock held, returns the connections to close once it is released
+        evicted = []
+        now = time.monotonic()
+        while self._idle and self._total > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            evicted.append(self._idle.popleft()[0])
+            self._total -= 1
+            self._stats['evictions'] += 1
+        return evicted
+
+    @contextlib.contextmanager
+    def connection(self, timeout=1, retry_num=1):
+        """
+        Check out a connection for the duration of a with block: commit on success, rollback on exception,
+        then hand it back to the pool (or drop it if the error left it unusable). Anything else leaving the
+        block, like GeneratorExit from a streaming generator closed half-way, drops the connection too
+        """
+        conn = self.get_connection(timeout, retry_num)
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            broken = not isinstance(e, Connection._reusable_expection)
+            if not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            # A dropped connection is closed without a rollback, the server discards the transaction and
+            # a half-read unbuffered result isn't read to the end first
+            self.release(conn, broken=broken)
+            raise
+        self.release(conn)
+
+    def release(self, conn, broken=False):
+        if broken:
+            logger.warning("Close not reusable connection from pool({})".format(self.name))
+            self._discard(conn)
+            with self._lock:
+                self._total -= 1
+                self._in_use -= 1
+                self._lock.notify()
+        else:
+            self.put_connection(conn)
 
     def put_connection(self, conn):
         if not conn._pool:
             conn._pool = self
         conn.cursor().close()
-        try:
-            self._pool.put_nowait(conn)
-            logger.debug("Put connection back to pool({})".format(self.name))
-        except queue.Full:
-            logger.warning("Put connection to pool({}) error, pool is full, size:{}".format(self.name, self.size()))
+        with self._lock:
+            if conn._in_pool:
+                return
+            conn._in_pool = True
+            self._idle.append((conn, time.monotonic()))
+            self._in_use -= 1
+            self._lock.notify()
+        logger.debug("Put connection back to pool({})".format(self.name))
 
     def size(self):
-        return self._pool.qsize()
+        return len(self._idle)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'size': self._total, 'in_use': self._in_use, 'idle': len(self._idle),
+                          'min_size': self.min_size, 'max_size': self.max_size})
+        return stats
 
 
 class GetConnectionFromPoolError(Exception):
@@ -0,0 +1,217 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+import base64
+import json
+import metrics
+import storage
+import threading
+import time
+
+COLUMNS = ("id", "time", "type", "chat", "message_id", "sender_id", "sender_name", "sender_username", "message", "media_type", "media_id")
+
+class BadRequest(Exception):
+    pass
+
+class ResultCache():
+
+    # Query results kept for ttl seconds. Every chat has a generation that goes up when the writer
+    # stores rows for it, an entry made at an older generation of its chat is stale right away.
+    # Entries spanning all chats have no chat and only expire
+
+    def __init__(self, ttl=10, maxEntries=1000):
+
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.lookups = metrics.registry.counter("telegram_api_cache_total", "Read API cache lookups by outcome", ["outcome"])
+
+    def get(self, key, chatID, build):
+        now = time.monotonic()
+        with self.lock:
+            # Read before building, rows stored while the query runs leave the result stale
+            generation = self.generations.get(chatID, 0)
+            entry = self.entries.get(key)
+            if entry and entry[0] > now and entry[1] == generation:
+                self.entries.move_to_end(key)
+                self.lookups.inc("hit")
+                return entry[2]
+        self.lookups.inc("miss")
+        value = build()
+        if self.ttl > 0:
+            with self.lock:
+                self.entries[key] = (now + self.ttl, generation, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxEntries:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, chatIDs):
+        with self.lock:
+            for chatID in chatIDs:
+                self.generations[chatID] = self.generations.get(chatID, 0) + 1
+
+class ReadAPI():
+
+    # Local HTTP/JSON endpoints for dashboards, answered from a read-only storage of their own so
+    # they never take connections from the writer:
+    #   GET /chats/<id>/messages?limit=&cursor=                        newest first
+    #   GET /messages?chat=&type=&since=&until=&limit=&cursor=        in (Chat, Time, ID) order
+    #   GET /counts?type=&since=&until=                               messages per chat
+    #   GET /chats/<id>/archive?since=&until=&limit=&cursor=          messages moved out by retention, oldest first
+    # Pages are keyset pages, "next" is the cursor of the following page or null on the last one
+
+    def __init__(self, storage, logError, cacheTTL=10, cacheEntries=1000, pageSize=50, maxPageSize=500, archive=None):
+
+        self.storage = storage
+        self.logError = logError
+        self.pageSize = pageSize
+        self.maxPageSize = maxPageSize
+        self.archive = archive
+        self.cache = ResultCache(cacheTTL, cacheEntries)
+        self.server = None
+        self.requestTime = metrics.registry.histogram("telegram_api_request_seconds", "Time spent answering one read API request", ["endpoint"])
+
+    def serve(self, host, port):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                status, body = api.handle(self.path)
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="ReadAPI", daemon=True).start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.storage.close()
+
+    def invalidate(self, rows):
+        # Called by the writer with every batch it stored
+        self.cache.invalidate({row[2] for row in rows})
+
+    def handle(self, path):
+        url = urlsplit(path)
+        parts = [part for part in url.path.split("/") if part]
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if len(parts) == 3 and parts[0] == "chats" and parts[2] == "messages":
+                endpoint, handler = "chat_messages", lambda: self.chatMessages(self.integer(parts[1], "chat"), query)
+            elif len(parts) == 3 and parts[0] == "chats" and parts[2] == "archive" and self.archive:
+                endpoint, handler = "chat_archive", lambda: self.chatArchive(self.integer(parts[1], "chat"), query)
+            elif parts == ["messages"]:
+                endpoint, handler = "messages", lambda: self.messages(query)
+            elif parts == ["counts"]:
+                endpoint, handler = "counts", lambda: self.counts(query)
+            else:
+                return 404, {"error": "not found"}
+            with self.requestTime.time(endpoint):
+                return 200, handler()
+        except BadRequest as e:
+            return 400, {"error": str(e)}
+        except:
+            self.logError("Error while answering read API request " + url.path)
+            return 500, {"error": "internal error"}
+
+    def chatMessages(self, chatID, query):
+        limit = self.limit(query)
+        before = self.decodeCursor(query.get("cursor"), 2)
+        key = ("chat_messages", chatID, limit, before)
+        return self.cache.get(key, chatID, lambda: self.page(self.storage.latestMessages(chatID, limit, before), limit, lambda row: [self.text(row[1]), row[0]]))
+
+    def messages(self, query):
+        chatID = self.integer(query["chat"], "chat") if "chat" in query else None
+        type = query.get("type")
+        if type is not None and type not in storage.MESSAGE_TYPES:
+            raise BadRequest("type must be one of " + ", ".join(storage.MESSAGE_TYPES))
+        since = self.time(query.get("since"), False)
+        until = self.time(query.get("until"), True)
+        limit = self.limit(query)
+        after = self.decodeCursor(query.get("cursor"), 3)
+        key = ("messages", chatID, type, since, until, limit, after)
+        return self.cache.get(key, chatID, lambda: self.page(self.storage.listMessages(chatID, type, since, until, limit, after), limit, lambda row: [row[3], self.text(row[1]), row[0]]))
+
+    def chatArchive(self, chatID, query):
+        since = self.time(query.get("since"), False)
+        until = self.time(query.get("until"), True)
+        limit = self.limit(query)
+        after = self.decodeCursor(query.get("cursor"), 2)
+        key = ("chat_archive", chatID, since, until, limit, after)
+
+        def build():
+            return self.page(self.archive.find(chatID, since, until, limit, after, catalog=self.storage), limit, lambda row: [row[1], row[0]])
+
+        # Archive files only change when retention adds one, the writer's invalidation doesn't apply
+        return self.cache.get(key, None, build)
+
+    def counts(self, query):
+        type = query.get("type")
+        since = self.time(query.get("since"), False)
+        until = self.time(query.get("until"), True)
+        key = ("counts", type, since, until)
+        return self.cache.get(key, None, lambda: {"chats": [{"chat": chatID, "title": title, "username": username, "count": count} for chatID, title, username, count in self.storage.countMessages(type, since, until)]})
+
+    def page(self, rows, limit, cursorOf):
+        messages = [dict(zip(COLUMNS, (row[0], self.text(row[1])) + tuple(row[2:]))) for row in rows]
+        return {"messages": messages, "next": self.encodeCursor(cursorOf(rows[-1])) if len(rows) == limit else None}
+
+    def limit(self, query):
+        limit = self.integer(query.get("limit", self.pageSize), "limit")
+        if limit < 1 or limit > self.maxPageSize:
+            raise BadRequest("limit must be between 1 and " + str(self.maxPageSize))
+        return limit
+
+    def integer(self, value, name):
+        try:
+            return int(value)
+        except ValueError:
+            raise BadRequest(name + " must be a number")
+
+    def time(self, value, end):
+        # YYYY-MM-DD or YYYY-MM-DD HH:MM:SS, a day on its own covers the whole day
+        if value is None:
+            return None
+        for format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+            try:
+                parsed = datetime.strptime(value, format)
+            except ValueError:
+                continue
+            if format == "%Y-%m-%d" and end:
+                return parsed.strftime("%Y-%m-%d") + " 23:59:59"
+            return parsed.strftime("%Y-%m-%d %H:%M:%S")
+        raise BadRequest("dates must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+
+    def text(self, value):
+        # MySQL hands back datetimes, SQLite the text it stored
+        return value.strftime("%Y-%m-%d %H:%M:%S") if isinstance(value, datetime) else value
+
+    def encodeCursor(self, values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii").rstrip("=")
+
+    def decodeCursor(self, cursor, length):
+        if not cursor:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        except ValueError:
+            raise BadRequest("invalid cursor")
+        if not isinstance(values, list) or len(values) != length:
+            raise BadRequest("invalid cursor")
+        return tuple(values)
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+import gzip
+import json
+import metrics
+import os
+import storage
+import threading
+import time
+
+COLUMNS = ("ID", "Time", "Type", "Chat", "TelegramMessageID", "SenderID", "SenderName", "SenderUsername", "Message", "MediaType", "MediaID")
+
+def writeArchive(path, rows, format):
+    # A temporary file synced and renamed into place, a crash never leaves half an archive behind
+    temporary = path + ".tmp"
+    if format == "parquet":
+        import pyarrow, pyarrow.parquet
+        columns = list(zip(*rows))
+        pyarrow.parquet.write_table(pyarrow.table({name: list(column) for name, column in zip(COLUMNS, columns)}), temporary, compression="zstd")
+    else:
+        with gzip.open(temporary, "wt", encoding="utf-8", compresslevel=9) as file:
+            file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+    with open(temporary, "rb") as file:
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+def readArchive(path):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+        return [tuple(row[name] for name in COLUMNS) for row in pyarrow.parquet.read_table(path).to_pylist()]
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return [tuple(json.loads(line)) for line in file]
+
+class Retention():
+
+    # Moves messages older than their hot window out of the message table into compressed files
+    # under path (<chat>/<type>-<first ID>-<last ID>), listed in the archive table so they can be
+    # looked up again. Windows are days per chat, else per type, else defaultDays, 0 keeps forever.
+    # Work goes in batches of at most batchSize rows of one chat and type, and after every batch
+    # the job rests so it runs at most dutyCycle of the time, longer while busy() says ingestion is behind
+
+    def __init__(self, storage, logError, path, defaultDays=0, chatDays=None, typeDays=None, format="jsonl", batchSize=5000, interval=3600, dutyCycle=0.2, busy=None):
+
+        self.storage = storage
+        self.logError = logError
+        self.path = path
+        self.defaultDays = defaultDays
+        self.chatDays = chatDays or {}
+        self.typeDays = typeDays or {}
+        self.format = format
+        self.batchSize = batchSize
+        self.interval = interval
+        self.dutyCycle = dutyCycle
+        self.busy = busy or (lambda: False)
+
+        self.stopping = threading.Event()
+        self.thread = None
+        self.archivedRows = metrics.registry.counter("telegram_retention_rows_total", "Messages moved to the cold archive")
+        self.batchTime = metrics.registry.histogram("telegram_retention_batch_seconds", "Time spent archiving one batch of messages")
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="Retention", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                moved = self.compact()
+                if moved:
+                    print("Retention - " + str(moved) + " messages moved to the archive")
+            except:
+                self.logError("Error while archiving old messages")
+            self.stopping.wait(self.interval)
+
+    def days(self, chatID, type):
+        return self.chatDays.get(chatID, self.typeDays.get(type, self.defaultDays))
+
+    def compact(self):
+        moved = 0
+        for chatID in self.storage.messageChats():
+            for type in storage.MESSAGE_TYPES:
+                days = self.days(chatID, type)
+                if not days:
+                    continue
+                cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+                while not self.stopping.is_set():
+                    self.rest()
+                    start = time.monotonic()
+                    with self.batchTime.time():
+                        count = self.archiveBatch(chatID, type, cutoff)
+                    moved += count
+                    if count < self.batchSize:
+                        break
+                    # Keep to the duty cycle: a batch that took t seconds is followed by a pause of t * (1 - d) / d
+                    self.stopping.wait((time.monotonic() - start) * (1 - self.dutyCycle) / self.dutyCycle)
+                if self.stopping.is_set():
+                    return moved
+        return moved
+
+    def rest(self):
+        while self.busy() and not self.stopping.is_set():
+            self.stopping.wait(1)
+
+    def archiveBatch(self, chatID, type, cutoff):
+        rows = [(row[0], row[1].strftime("%Y-%m-%d %H:%M:%S") if isinstance(row[1], datetime) else row[1]) + tuple(row[2:]) for row in self.storage.oldMessages(chatID, type, cutoff, self.batchSize)]
+        if not rows:
+            return 0
+        # Named after the rows it holds, archiving the same rows again after a crash rewrites the same file
+        directory = os.path.join(self.path, str(chatID))
+        os.makedirs(directory, exist_ok=True)
+        name = type + "-" + str(rows[0][0]) + "-" + str(rows[-1][0]) + (".parquet" if self.format == "parquet" else ".jsonl.gz")
+        writeArchive(os.path.join(directory, name), rows, self.format)
+        self.storage.saveArchive(chatID, type, rows[0][1], rows[-1][1], len(rows), os.path.join(str(chatID), name))
+        self.storage.markArchived([(row[3], row[4], row[2]) for row in rows if row[4] is not None])
+        self.storage.deleteMessages([row[0] for row in rows])
+        self.archivedRows.inc(amount=len(rows))
+        return len(rows)
+
+    def find(self, chatID, since=None, until=None, limit=None, after=None, catalog=None):
+        # Archived messages of a chat within [since, until] and past the (Time, ID) after, oldest first,
+        # at most limit of them. catalog is the storage to look up the archive table in, the read API
+        # passes its read-only one
+        if after and (since is None or after[0] > since):
+            since = after[0]
+        found = []
+        for file, firstTime in (catalog or self.storage).findArchives(chatID, since, until):
+            # Files come oldest first, once one starts after the last row kept the rest can't make the page
+            if limit and len(found) >= limit and firstTime > found[-1][1]:
+                break
+            for row in readArchive(os.path.join(self.path, file)):
+                if (since is None or row[1] >= since) and (until is None or row[1] <= until) and (after is None or (row[1], row[0]) > after):
+                    found.append(row)
+            found.sort(key=lambda row: (row[1], row[0]))
+            if limit:
+                del found[limit:]
+        return found
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
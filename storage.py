@@ -0,0 +1,740 @@
+import pymysql
+import pymysql.cursors
+import sqlite3
+import threading
+import warnings
+from datetime import datetime
+
+MESSAGE_TYPES = ("channel", "admin", "pinned")
+MEDIA_TYPES = ("photo", "video", "document", "other")
+
+class Storage():
+
+    # Everything the bot needs from the database. Methods raise on failure, the bot decides
+    # whether an error is fatal and logs it
+
+    placeholder = "%s"
+
+    def __init__(self, tables):
+        self.chatTable = tables["chat"]
+        self.messageTable = tables["message"]
+        self.senderTable = tables["sender"]
+        self.backfillTable = tables["backfill"]
+        self.schemaTable = tables["schema"]
+        self.mediaTable = tables["media"]
+        self.alertTable = tables["alert"]
+        self.archiveTable = tables["archive"]
+        self.stateTable = tables["state"]
+        self.archivedTable = tables["archived"]
+        self.archivedChats = None
+
+    def ensureSchema(self):
+        raise NotImplementedError
+
+    def migrations(self):
+        # Ordered list of (version, description, function taking a cursor). Every migration
+        # checks what is already there, so it is also safe on a freshly created table
+        return []
+
+    def schemaCurrent(self, c):
+        # A schema table already at the latest version means every table exists and is migrated
+        latest = max([version for version, description, migration in self.migrations()], default=0)
+        try:
+            c.execute("SELECT MAX(Version) FROM " + self.schemaTable)
+            row = c.fetchone()
+        except (pymysql.err.MySQLError, sqlite3.Error):
+            return False
+        return latest > 0 and (row[0] or 0) == latest
+
+    def schemaIsCurrent(self):
+        # For tools that must not change the database, checked without creating or migrating anything
+        latest = max([version for version, description, migration in self.migrations()], default=0)
+        try:
+            rows = self.execute("SELECT MAX(Version) FROM " + self.schemaTable)
+        except (pymysql.err.MySQLError, sqlite3.Error):
+            return False
+        return latest > 0 and (rows[0][0] or 0) == latest
+
+    def migrate(self, c, commit):
+        c.execute("SELECT MAX(Version) FROM " + self.schemaTable)
+        current = c.fetchone()[0] or 0
+        for version, description, migration in self.migrations():
+            if version <= current:
+                continue
+            print("Migrating database to schema version " + str(version) + " - " + description)
+            migration(c)
+            c.execute("INSERT INTO " + self.schemaTable + "(Version, Applied) VALUES (" + self.placeholder + ", " + self.placeholder + ")", (version, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            commit()
+
+    def upsertChats(self, chats):
+        # chats: list of (ID, Title, Username)
+        raise NotImplementedError
+
+    def deleteChats(self, ids):
+        raise NotImplementedError
+
+    def insertMessages(self, rows):
+        # rows: list of (Time, Type, Chat, TelegramMessageID, SenderID, SenderName, SenderUsername, Message, MediaType, MediaID),
+        # rows already stored for the same chat, message and type are skipped, and so are rows already archived
+        raise NotImplementedError
+
+    def unarchivedRows(self, rows):
+        # A journal replay or a backfill brings back messages retention has since moved out of the message table.
+        # Only rows of chats retention archived from are looked up, without retention writes never wait for it
+        if self.archivedChats is None:
+            self.archivedChats = {row[0] for row in self.execute("SELECT DISTINCT Chat FROM " + self.archivedTable)}
+        keys = list({(row[2], row[3]) for row in rows if row[3] is not None and row[2] in self.archivedChats})
+        archived = set()
+        # 400 pairs stay under SQLite's default limit of 999 parameters
+        for start in range(0, len(keys), 400):
+            part = keys[start:start + 400]
+            pair = "(" + self.placeholder + ", " + self.placeholder + ")"
+            archived.update(tuple(row) for row in self.execute("SELECT Chat, TelegramMessageID, Type FROM " + self.archivedTable + " WHERE (Chat, TelegramMessageID) IN (" + ", ".join([pair] * len(part)) + ")",
+                                                               [value for key in part for value in key]))
+        return [row for row in rows if (row[2], row[3], row[1]) not in archived] if archived else rows
+
+    def markArchived(self, keys):
+        # keys: list of (Chat, TelegramMessageID, Type) of messages moved to the archive
+        raise NotImplementedError
+
+    def noteArchived(self, keys):
+        if self.archivedChats is not None:
+            self.archivedChats.update(key[0] for key in keys)
+
+    def findMessages(self, chatID, messageIDs):
+        # {TelegramMessageID: (Time as a unix timestamp, SenderID, SenderName, SenderUsername, Message)}
+        rows = self.execute(
+            "SELECT m.TelegramMessageID, m.Time, m.SenderID, s.Name, s.Username, m.Message FROM " + self.messageTable + " m LEFT JOIN " + self.senderTable + " s ON s.ID = m.SenderID"
+            " WHERE m.Chat = " + self.placeholder + " AND m.TelegramMessageID IN (" + ", ".join([self.placeholder] * len(messageIDs)) + ")",
+            [chatID] + list(messageIDs)
+        )
+        found = {}
+        for row in rows:
+            # MySQL hands back datetimes, SQLite the text it stored
+            stored = row[1] if isinstance(row[1], datetime) else datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S")
+            found[row[0]] = (int(stored.timestamp()), row[2], row[3], row[4], row[5])
+        return found
+
+    def searchMessages(self, query, chatID=None, type=None, since=None, until=None, limit=20, after=None):
+        # Messages containing every word of query, best match first, as
+        # (Score, ID, Time, Type, Chat, SenderName, SenderUsername, Message).
+        # after is the (Score, ID) of the last row of the previous page
+        raise NotImplementedError
+
+    def searchTerms(self, query):
+        return [term.replace('"', "") for term in query.split() if term.replace('"', "")]
+
+    def searchFilters(self, chatID, type, since, until):
+        conditions = []
+        args = []
+        for condition, value in (("m.Chat = ", chatID), ("m.Type = ", type), ("m.Time >= ", since), ("m.Time <= ", until)):
+            if value is not None:
+                conditions.append(condition + self.placeholder)
+                args.append(value)
+        return conditions, args
+
+    def searchPage(self, ranked, rankedArgs, limit, after):
+        # ranked selects Score, ID, Time, Type, Chat, Name, Username, Message. Scores are rounded
+        # so the (Score, ID) cursor of a page compares equal when it's sent back
+        sql = "SELECT Score, ID, Time, Type, Chat, Name, Username, Message FROM (" + ranked + ") found"
+        args = list(rankedArgs)
+        if after:
+            sql += " WHERE Score < " + self.placeholder + " OR (Score = " + self.placeholder + " AND ID < " + self.placeholder + ")"
+            args += [after[0], after[0], after[1]]
+        sql += " ORDER BY Score DESC, ID DESC LIMIT " + self.placeholder
+        return self.execute(sql, args + [limit])
+
+    def searchScan(self, terms, conditions, args, limit, after):
+        # Without a full-text index, every word is a LIKE over the whole message table
+        for term in terms:
+            conditions = conditions + ["m.Message LIKE " + self.placeholder]
+            args = args + ["%" + term + "%"]
+        ranked = ("SELECT 0 AS Score, m.ID, m.Time, m.Type, m.Chat, s.Name, s.Username, m.Message FROM " + self.messageTable + " m LEFT JOIN " + self.senderTable + " s ON s.ID = m.SenderID"
+                  " WHERE " + " AND ".join(conditions))
+        return self.searchPage(ranked, args, limit, after)
+
+    def exportMessages(self, afterID=0, chatID=None, type=None, since=None, until=None, chunkSize=50000, batchSize=1000):
+        # Yields batches of (ID, Time, Type, Chat, TelegramMessageID, SenderID, SenderName, SenderUsername, Message, MediaType, MediaID)
+        # in ID order. Every chunk is its own short query that continues after the last ID seen,
+        # inside a chunk the rows are streamed from the server batchSize at a time
+        conditions, args = self.searchFilters(chatID, type, since, until)
+        sql = self.messageColumns() + " WHERE " + " AND ".join(["m.ID > " + self.placeholder] + conditions) + " ORDER BY m.ID LIMIT " + self.placeholder
+        while True:
+            count = 0
+            for rows in self.streamRows(sql, [afterID] + args + [chunkSize], batchSize):
+                count += len(rows)
+                afterID = rows[-1][0]
+                yield rows
+            if count < chunkSize:
+                return
+
+    def streamRows(self, sql, args, batchSize):
+        raise NotImplementedError
+
+    def messageColumns(self):
+        return ("SELECT m.ID, m.Time, m.Type, m.Chat, m.TelegramMessageID, m.SenderID, s.Name, s.Username, m.Message, m.MediaType, m.MediaID FROM " + self.messageTable + " m"
+                " LEFT JOIN " + self.senderTable + " s ON s.ID = m.SenderID")
+
+    def latestMessages(self, chatID, limit=50, before=None):
+        # Newest first, same columns as exportMessages. before is the (Time, ID) of the last row of
+        # the previous page, the ChatTime index holds (Chat, Time, ID) so a page is one index range
+        conditions = ["m.Chat = " + self.placeholder]
+        args = [chatID]
+        if before:
+            conditions.append("(m.Time < " + self.placeholder + " OR (m.Time = " + self.placeholder + " AND m.ID < " + self.placeholder + "))")
+            args += [before[0], before[0], before[1]]
+        return self.execute(self.messageColumns() + " WHERE " + " AND ".join(conditions) + " ORDER BY m.Time DESC, m.ID DESC LIMIT " + self.placeholder, args + [limit])
+
+    def listMessages(self, chatID=None, type=None, since=None, until=None, limit=50, after=None):
+        # Oldest first in (Chat, Time, ID) order, after is the (Chat, Time, ID) of the last row of the previous page
+        conditions, args = self.searchFilters(chatID, type, since, until)
+        if after:
+            conditions.append("(m.Chat > " + self.placeholder + " OR (m.Chat = " + self.placeholder + " AND (m.Time > " + self.placeholder + " OR (m.Time = " + self.placeholder + " AND m.ID > " + self.placeholder + "))))")
+            args += [after[0], after[0], after[1], after[1], after[2]]
+        return self.execute(self.messageColumns() + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY m.Chat, m.Time, m.ID LIMIT " + self.placeholder, args + [limit])
+
+    def countMessages(self, type=None, since=None, until=None):
+        # [(Chat, Title, Username, Count)] for every chat with matching messages
+        conditions, args = self.searchFilters(None, type, since, until)
+        return self.execute("SELECT m.Chat, c.Title, c.Username, COUNT(*) FROM " + self.messageTable + " m LEFT JOIN " + self.chatTable + " c ON c.ID = m.Chat"
+                            + (" WHERE " + " AND ".join(conditions) if conditions else "") + " GROUP BY m.Chat, c.Title, c.Username ORDER BY m.Chat", args)
+
+    def splitRows(self, rows):
+        # Sender names live in the sender table, the message table only keeps SenderID
+        senders = {}
+        for row in rows:
+            if row[4] is not None:
+                senders[row[4]] = (row[4], row[5], row[6])
+        messages = [(row[0], row[1], row[2], row[3], row[4], row[7], row[8], row[9]) for row in rows]
+        return list(senders.values()), messages
+
+    def loadMonitoredChats(self):
+        raise NotImplementedError
+
+    def findMedia(self, mediaID):
+        # Content hash of a downloaded media ID, or None
+        rows = self.execute("SELECT Hash FROM " + self.mediaTable + " WHERE ID = " + self.placeholder, (mediaID,))
+        return rows[0][0] if rows else None
+
+    def saveMedia(self, mediaID, hash, size, mimeType):
+        raise NotImplementedError
+
+    def messageChats(self):
+        return [row[0] for row in self.execute("SELECT DISTINCT Chat FROM " + self.messageTable)]
+
+    def oldMessages(self, chatID, type, before, limit):
+        # The oldest messages of one chat and type from before the given time, same columns as exportMessages
+        return self.execute(self.messageColumns() + " WHERE m.Chat = " + self.placeholder + " AND m.Type = " + self.placeholder + " AND m.Time < " + self.placeholder
+                            + " ORDER BY m.Time, m.ID LIMIT " + self.placeholder, (chatID, type, before, limit))
+
+    def deleteMessages(self, ids):
+        if ids:
+            self.execute("DELETE FROM " + self.messageTable + " WHERE ID IN (" + ", ".join([self.placeholder] * len(ids)) + ")", list(ids))
+
+    def saveArchive(self, chatID, type, firstTime, lastTime, rows, file):
+        raise NotImplementedError
+
+    def findArchives(self, chatID, since=None, until=None):
+        # Archive files of a chat that may hold messages within [since, until], oldest first
+        conditions = ["Chat = " + self.placeholder]
+        args = [chatID]
+        if since is not None:
+            conditions.append("LastTime >= " + self.placeholder)
+            args.append(since)
+        if until is not None:
+            conditions.append("FirstTime <= " + self.placeholder)
+            args.append(until)
+        # [(File, FirstTime)], FirstTime as text like the archived rows
+        return [(row[0], row[1].strftime("%Y-%m-%d %H:%M:%S") if isinstance(row[1], datetime) else row[1])
+                for row in self.execute("SELECT File, FirstTime FROM " + self.archiveTable + " WHERE " + " AND ".join(conditions) + " ORDER BY FirstTime", args)]
+
+    def loadAlertRules(self):
+        # [(Rule, Chat, Type, Pattern, IsRegex)], Chat and Type NULL for any
+        return [tuple(row) for row in self.execute("SELECT Rule, Chat, Type, Pattern, IsRegex FROM " + self.alertTable + " ORDER BY ID")]
+
+    def loadBackfillCursors(self):
+        # {Chat: [OffsetID, Done]}
+        raise NotImplementedError
+
+    def loadUpdateState(self):
+        # {(Session, Chat): (Pts, Qts, Date)}, Chat 0 holds an account's common state and
+        # Session is empty for channels, whose pts is the same for every account
+        return {(row[0], row[1]): (row[2], row[3], row[4]) for row in self.execute("SELECT Session, Chat, Pts, Qts, Date FROM " + self.stateTable)}
+
+    def saveUpdateState(self, rows):
+        # rows: list of (Session, Chat, Pts, Qts, Date)
+        raise NotImplementedError
+
+    def saveBackfillCursor(self, chatID, offsetID, done):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class MySQLStorage(Storage):
+
+    def __init__(self, pool, tables, partitionByMonth=False, partitionMonthsAhead=3):
+        Storage.__init__(self, tables)
+        self.pool = pool
+        self.partitionByMonth = partitionByMonth
+        self.partitionMonthsAhead = partitionMonthsAhead
+
+    def tableStatements(self):
+        types = ", ".join("'" + type + "'" for type in MESSAGE_TYPES)
+        tables = {}
+        tables["chat"] = {"name": self.chatTable, "statement": "(ID int unsigned not null, Title varchar(255), Username varchar(255), PRIMARY KEY (ID))"}
+        tables["sender"] = {"name": self.senderTable, "statement": "(ID bigint unsigned not null, Name varchar(255), Username varchar(255), PRIMARY KEY (ID))"}
+        tables["message"] = {"name": self.messageTable, "statement": "(ID int unsigned not null auto_increment, Time datetime not null, Type enum(" + types + ") not null, Chat int unsigned not null, Sender varchar(255), Message text, TelegramMessageID int unsigned, SenderID bigint unsigned, MediaType enum(" + ", ".join("'" + type + "'" for type in MEDIA_TYPES) + "), MediaID bigint, PRIMARY KEY(ID), UNIQUE KEY ChatMessage (Chat, TelegramMessageID, Type), KEY ChatTime (Chat, Time), FOREIGN KEY (Chat) REFERENCES " + self.chatTable + "(ID))"}
+        tables["backfill"] = {"name": self.backfillTable, "statement": "(Chat int unsigned not null, OffsetID int unsigned not null, Done tinyint(1) not null default 0, PRIMARY KEY (Chat))"}
+        tables["schema"] = {"name": self.schemaTable, "statement": "(Version int unsigned not null, Applied datetime not null, PRIMARY KEY (Version))"}
+        tables["media"] = {"name": self.mediaTable, "statement": "(ID bigint not null, Hash char(64) not null, Size bigint unsigned not null, MimeType varchar(255), Saved datetime not null, PRIMARY KEY (ID), KEY Hash (Hash))"}
+        tables["alert"] = {"name": self.alertTable, "statement": "(ID int unsigned not null auto_increment, Rule varchar(255) not null, Chat int unsigned, Type enum(" + types + "), Pattern varchar(1024) not null, IsRegex tinyint(1) not null default 0, PRIMARY KEY (ID))"}
+        tables["archive"] = {"name": self.archiveTable, "statement": "(ID int unsigned not null auto_increment, Chat int unsigned not null, Type enum(" + types + ") not null, FirstTime datetime not null, LastTime datetime not null, RowCount int unsigned not null, File varchar(255) not null, Created datetime not null, PRIMARY KEY (ID), UNIQUE KEY File (File), KEY ChatTime (Chat, FirstTime))"}
+        tables["state"] = {"name": self.stateTable, "statement": "(Session varchar(64) not null, Chat int unsigned not null, Pts int unsigned not null, Qts int unsigned not null default 0, Date int unsigned not null default 0, PRIMARY KEY (Session, Chat))"}
+        tables["archived"] = {"name": self.archivedTable, "statement": "(Chat int unsigned not null, TelegramMessageID int unsigned not null, Type enum(" + types + ") not null, PRIMARY KEY (Chat, TelegramMessageID, Type))"}
+        return tables
+
+    def ensureSchema(self):
+        tables = self.tableStatements()
+        with self.pool.connection() as connection:
+            c = connection.cursor()
+            if self.schemaCurrent(c):
+                print("Database schema is up to date, skipping table checks")
+            else:
+                for tableType in tables:
+                    table = tables[tableType]
+                    c.execute("SHOW TABLES LIKE '" + table["name"] + "'")
+                    if c.fetchone():
+                        print("Found " + tableType + " table (" + table["name"] + ")")
+                    else:
+                        print("Creating " + tableType + " table (" + table["name"] + ")")
+                        c.execute("CREATE TABLE " + table["name"] + " " + table["statement"])
+                        connection.commit()
+                self.migrate(c, connection.commit)
+            if self.partitionByMonth:
+                self.ensurePartitions(c)
+
+    def migrations(self):
+        return [
+            (1, "Telegram message and sender IDs", self.migrateMessageIDs),
+            (2, "compact message type", self.migrateMessageType),
+            (3, "chat and time index", self.migrateChatTimeIndex),
+            (4, "full-text message index", self.migrateMessageText),
+            (5, "media columns", self.migrateMedia),
+            (6, "alert rule table", self.migrateAlertTable),
+            (7, "message archive table", self.migrateArchiveTable),
+            (8, "update state table", self.migrateStateTable),
+            (9, "archived message table", self.migrateArchivedTable)
+        ]
+
+    def migrateMessageIDs(self, c):
+        # INSTANT only touches the data dictionary, servers without it fall back to an
+        # online INPLACE change, never a table copy
+        c.execute("SHOW COLUMNS FROM " + self.messageTable + " LIKE 'TelegramMessageID'")
+        if not c.fetchone():
+            columns = "ADD COLUMN TelegramMessageID int unsigned, ADD COLUMN SenderID bigint unsigned"
+            try:
+                c.execute("ALTER TABLE " + self.messageTable + " " + columns + ", ALGORITHM=INSTANT")
+            except pymysql.err.MySQLError:
+                c.execute("ALTER TABLE " + self.messageTable + " " + columns + ", ALGORITHM=INPLACE, LOCK=NONE")
+        c.execute("SHOW INDEX FROM " + self.messageTable + " WHERE Key_name='ChatMessage'")
+        if not c.fetchone():
+            c.execute("ALTER TABLE " + self.messageTable + " ADD UNIQUE INDEX ChatMessage (Chat, TelegramMessageID, Type), ALGORITHM=INPLACE, LOCK=NONE")
+
+    def migrateMessageType(self, c):
+        c.execute("SHOW COLUMNS FROM " + self.messageTable + " LIKE 'Type'")
+        if not c.fetchone()[1].startswith("enum"):
+            # Changing the column type cannot be done in place, this copies the table once
+            print("Converting message type column to enum, this rebuilds the message table")
+            types = ", ".join("'" + type + "'" for type in MESSAGE_TYPES)
+            c.execute("ALTER TABLE " + self.messageTable + " MODIFY Time datetime not null, MODIFY Type enum(" + types + ") not null")
+
+    def migrateChatTimeIndex(self, c):
+        c.execute("SHOW INDEX FROM " + self.messageTable + " WHERE Key_name='ChatTime'")
+        if not c.fetchone():
+            c.execute("ALTER TABLE " + self.messageTable + " ADD INDEX ChatTime (Chat, Time), ALGORITHM=INPLACE, LOCK=NONE")
+
+    def migrateMessageText(self, c):
+        if self.partitioned(c):
+            print("The message table is partitioned and MySQL has no FULLTEXT for partitioned tables, search scans the table instead")
+            return
+        c.execute("SHOW INDEX FROM " + self.messageTable + " WHERE Key_name='MessageText'")
+        if not c.fetchone():
+            # The first FULLTEXT index adds a hidden document ID column, writes are blocked while the table is rebuilt.
+            # InnoDB says so with warning 124, which the pool's warnings filter would turn into an error
+            print("Adding full-text index on messages, this rebuilds the message table")
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always", pymysql.err.Warning)
+                c.execute("ALTER TABLE " + self.messageTable + " ADD FULLTEXT INDEX MessageText (Message), ALGORITHM=INPLACE, LOCK=SHARED")
+            for warning in caught:
+                if not isinstance(warning.message, pymysql.err.Warning) or warning.message.args[0] != 124:
+                    raise warning.message
+
+    def migrateMedia(self, c):
+        c.execute("SHOW COLUMNS FROM " + self.messageTable + " LIKE 'MediaType'")
+        if not c.fetchone():
+            columns = "ADD COLUMN MediaType enum(" + ", ".join("'" + type + "'" for type in MEDIA_TYPES) + "), ADD COLUMN MediaID bigint"
+            try:
+                c.execute("ALTER TABLE " + self.messageTable + " " + columns + ", ALGORITHM=INSTANT")
+            except pymysql.err.MySQLError:
+                c.execute("ALTER TABLE " + self.messageTable + " " + columns + ", ALGORITHM=INPLACE, LOCK=NONE")
+
+    def createMissingTable(self, c, tableType):
+        # CREATE TABLE IF NOT EXISTS on a table that exists answers with note 1050, which the pool's
+        # warnings filter turns into an error
+        table = self.tableStatements()[tableType]
+        c.execute("SHOW TABLES LIKE %s", (table["name"],))
+        if not c.fetchone():
+            c.execute("CREATE TABLE " + table["name"] + " " + table["statement"])
+
+    def migrateAlertTable(self, c):
+        # Normally created by the table checks that run before any migration, this bumps the version
+        # so later starts take the fast path
+        self.createMissingTable(c, "alert")
+
+    def migrateArchiveTable(self, c):
+        self.createMissingTable(c, "archive")
+
+    def migrateStateTable(self, c):
+        self.createMissingTable(c, "state")
+
+    def migrateArchivedTable(self, c):
+        self.createMissingTable(c, "archived")
+
+    def partitioned(self, c):
+        c.execute("SELECT COUNT(*) FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND PARTITION_NAME IS NOT NULL", (self.messageTable,))
+        return c.fetchone()[0] > 0
+
+    def ensurePartitions(self, c):
+        c.execute("SELECT PARTITION_NAME FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND PARTITION_NAME IS NOT NULL", (self.messageTable,))
+        partitions = [row[0] for row in c.fetchall()]
+        now = datetime.now()
+        last = self.addMonths((now.year, now.month), self.partitionMonthsAhead)
+
+        if not partitions:
+            c.execute("SELECT MIN(Time) FROM " + self.messageTable)
+            first = c.fetchone()[0] or now
+            months = self.monthsBetween((first.year, first.month), last)
+            print("Partitioning message table (" + self.messageTable + ") by month, this rebuilds the table once")
+            # Partitioned tables can't have foreign keys, and every unique key must contain the partitioning column
+            c.execute("SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS WHERE CONSTRAINT_SCHEMA=DATABASE() AND TABLE_NAME=%s", (self.messageTable,))
+            for row in c.fetchall():
+                c.execute("ALTER TABLE " + self.messageTable + " DROP FOREIGN KEY " + row[0])
+            # Nor FULLTEXT indexes, search falls back to scanning
+            c.execute("SHOW INDEX FROM " + self.messageTable + " WHERE Key_name='MessageText'")
+            if c.fetchone():
+                c.execute("ALTER TABLE " + self.messageTable + " DROP INDEX MessageText")
+            c.execute("ALTER TABLE " + self.messageTable + " DROP PRIMARY KEY, ADD PRIMARY KEY (ID, Time), DROP INDEX ChatMessage, ADD UNIQUE KEY ChatMessage (Chat, TelegramMessageID, Type, Time) "
+                      + "PARTITION BY RANGE COLUMNS(Time) (" + ", ".join(self.partitionDefinition(month) for month in months) + ", PARTITION pmax VALUES LESS THAN (MAXVALUE))")
+        else:
+            months = self.monthsBetween((now.year, now.month), last)
+            missing = [month for month in months if "p%04d%02d" % month not in partitions]
+            if missing:
+                print("Adding message table partitions: " + ", ".join("p%04d%02d" % month for month in missing))
+                # Splitting the catch-all partition only moves the rows that are in it
+                c.execute("ALTER TABLE " + self.messageTable + " REORGANIZE PARTITION pmax INTO (" + ", ".join(self.partitionDefinition(month) for month in missing) + ", PARTITION pmax VALUES LESS THAN (MAXVALUE))")
+
+    def addMonths(self, month, count):
+        total = month[0] * 12 + month[1] - 1 + count
+        return (total // 12, total % 12 + 1)
+
+    def monthsBetween(self, first, last):
+        months = []
+        month = first
+        while month <= last:
+            months.append(month)
+            month = self.addMonths(month, 1)
+        return months
+
+    def partitionDefinition(self, month):
+        return "PARTITION p%04d%02d VALUES LESS THAN ('%04d-%02d-01')" % (month + self.addMonths(month, 1))
+
+    def execute(self, sql, args=None, many=False):
+        with self.pool.connection() as connection:
+            c = connection.cursor()
+            if many:
+                c.executemany(sql, args)
+            else:
+                c.execute(sql, args)
+            return c.fetchall()
+
+    def streamRows(self, sql, args, batchSize):
+        # An unbuffered cursor keeps only the current batch in client memory
+        # A generator closed before the end drops the connection, closing the cursor would read every remaining row
+        with self.pool.connection() as connection:
+            c = connection.cursor(pymysql.cursors.SSCursor)
+            c.execute(sql, args)
+            while True:
+                rows = c.fetchmany(batchSize)
+                if not rows:
+                    c.close()
+                    return
+                yield rows
+
+    def executeBatches(self, batches):
+        # Several executemany statements in one transaction
+        with self.pool.connection() as connection:
+            c = connection.cursor()
+            for sql, rows in batches:
+                if rows:
+                    c.executemany(sql, rows)
+
+    def upsertChats(self, chats):
+        if chats:
+            self.execute("INSERT INTO " + self.chatTable + "(ID, Title, Username) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE Title=VALUES(Title), Username=VALUES(Username)", chats, many=True)
+
+    def deleteChats(self, ids):
+        if ids:
+            self.execute("DELETE FROM " + self.chatTable + " WHERE ID IN (" + ", ".join(["%s"] * len(ids)) + ")", list(ids))
+
+    def insertMessages(self, rows):
+        rows = self.unarchivedRows(rows)
+        if rows:
+            senders, messages = self.splitRows(rows)
+            self.executeBatches([
+                ("INSERT INTO " + self.senderTable + "(ID, Name, Username) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE Name=VALUES(Name), Username=VALUES(Username)", senders),
+                ("INSERT INTO " + self.messageTable + "(Time, Type, Chat, TelegramMessageID, SenderID, Message, MediaType, MediaID) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE ID=ID", messages)
+            ])
+
+    def loadMonitoredChats(self):
+        rows = self.execute("SELECT ID, Title, Username FROM " + self.chatTable)
+        return {row[0]: [row[1], row[2]] for row in rows}
+
+    def searchMessages(self, query, chatID=None, type=None, since=None, until=None, limit=20, after=None):
+        terms = self.searchTerms(query)
+        conditions, args = self.searchFilters(chatID, type, since, until)
+        if not self.execute("SHOW INDEX FROM " + self.messageTable + " WHERE Key_name='MessageText'"):
+            return self.searchScan(terms, conditions, args, limit, after)
+        # Boolean mode with every word required, InnoDB still ranks by relevance
+        against = " ".join('+"' + term + '"' for term in terms)
+        match = "MATCH(m.Message) AGAINST(%s IN BOOLEAN MODE)"
+        ranked = ("SELECT ROUND(" + match + ", 6) AS Score, m.ID, m.Time, m.Type, m.Chat, s.Name, s.Username, m.Message FROM " + self.messageTable + " m LEFT JOIN " + self.senderTable + " s ON s.ID = m.SenderID"
+                  " WHERE " + " AND ".join([match] + conditions))
+        return self.searchPage(ranked, [against, against] + args, limit, after)
+
+    def loadBackfillCursors(self):
+        rows = self.execute("SELECT Chat, OffsetID, Done FROM " + self.backfillTable)
+        return {row[0]: [row[1], bool(row[2])] for row in rows}
+
+    def saveBackfillCursor(self, chatID, offsetID, done):
+        self.execute("INSERT INTO " + self.backfillTable + "(Chat, OffsetID, Done) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE OffsetID=VALUES(OffsetID), Done=VALUES(Done)", (chatID, offsetID, int(done)))
+
+    def saveUpdateState(self, rows):
+        if rows:
+            self.execute("INSERT INTO " + self.stateTable + "(Session, Chat, Pts, Qts, Date) VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE Pts=VALUES(Pts), Qts=VALUES(Qts), Date=VALUES(Date)", rows, many=True)
+
+    def saveMedia(self, mediaID, hash, size, mimeType):
+        self.execute("INSERT INTO " + self.mediaTable + "(ID, Hash, Size, MimeType, Saved) VALUES (%s, %s, %s, %s, NOW()) ON DUPLICATE KEY UPDATE ID=ID", (mediaID, hash, size, mimeType))
+
+    def saveArchive(self, chatID, type, firstTime, lastTime, rows, file):
+        self.execute("INSERT INTO " + self.archiveTable + "(Chat, Type, FirstTime, LastTime, RowCount, File, Created) VALUES (%s, %s, %s, %s, %s, %s, NOW()) ON DUPLICATE KEY UPDATE RowCount=VALUES(RowCount)", (chatID, type, firstTime, lastTime, rows, file))
+
+    def markArchived(self, keys):
+        if keys:
+            self.execute("INSERT INTO " + self.archivedTable + "(Chat, TelegramMessageID, Type) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE Chat=Chat", keys, many=True)
+            self.noteArchived(keys)
+
+class SQLiteStorage(Storage):
+
+    # Embedded backend for deployments without a database server. WAL mode lets readers run
+    # alongside the writer, synchronous=NORMAL only fsyncs at checkpoints
+
+    placeholder = "?"
+
+    def __init__(self, path, tables, readOnly=False):
+        Storage.__init__(self, tables)
+        self.path = path
+        self.textTable = self.messageTable + "_fts"
+        self.lock = threading.Lock()
+        if readOnly:
+            self.connection = sqlite3.connect("file:" + path + "?mode=ro", uri=True, check_same_thread=False)
+            return
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+
+    def tableStatements(self):
+        tables = {}
+        tables["chat"] = {"name": self.chatTable, "statement": "(ID integer not null, Title text, Username text, PRIMARY KEY (ID))"}
+        tables["sender"] = {"name": self.senderTable, "statement": "(ID integer not null, Name text, Username text, PRIMARY KEY (ID))"}
+        tables["message"] = {"name": self.messageTable, "statement": "(ID integer primary key autoincrement, Time text not null, Type text not null, Chat integer not null, Sender text, Message text, TelegramMessageID integer, SenderID integer, MediaType text, MediaID integer, FOREIGN KEY (Chat) REFERENCES " + self.chatTable + "(ID))"}
+        tables["backfill"] = {"name": self.backfillTable, "statement": "(Chat integer not null, OffsetID integer not null, Done integer not null default 0, PRIMARY KEY (Chat))"}
+        tables["schema"] = {"name": self.schemaTable, "statement": "(Version integer not null, Applied text not null, PRIMARY KEY (Version))"}
+        tables["media"] = {"name": self.mediaTable, "statement": "(ID integer not null, Hash text not null, Size integer not null, MimeType text, Saved text not null, PRIMARY KEY (ID))"}
+        tables["alert"] = {"name": self.alertTable, "statement": "(ID integer primary key autoincrement, Rule text not null, Chat integer, Type text, Pattern text not null, IsRegex integer not null default 0)"}
+        tables["archive"] = {"name": self.archiveTable, "statement": "(ID integer primary key autoincrement, Chat integer not null, Type text not null, FirstTime text not null, LastTime text not null, RowCount integer not null, File text not null unique, Created text not null)"}
+        tables["state"] = {"name": self.stateTable, "statement": "(Session text not null, Chat integer not null, Pts integer not null, Qts integer not null default 0, Date integer not null default 0, PRIMARY KEY (Session, Chat))"}
+        tables["archived"] = {"name": self.archivedTable, "statement": "(Chat integer not null, TelegramMessageID integer not null, Type text not null, PRIMARY KEY (Chat, TelegramMessageID, Type))"}
+        return tables
+
+    def ensureSchema(self):
+        tables = self.tableStatements()
+        with self.lock:
+            c = self.connection.cursor()
+            if self.schemaCurrent(c):
+                print("Database schema is up to date, skipping table checks")
+                return
+            for tableType in tables:
+                table = tables[tableType]
+                found = c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table["name"],)).fetchone()
+                if found:
+                    print("Found " + tableType + " table (" + table["name"] + ")")
+                else:
+                    print("Creating " + tableType + " table (" + table["name"] + ")")
+                    c.execute("CREATE TABLE " + table["name"] + " " + table["statement"])
+            self.connection.commit()
+            self.migrate(c, self.connection.commit)
+
+    def migrations(self):
+        # Type stays text here, SQLite stores short strings almost as compactly as an integer
+        return [
+            (1, "Telegram message and sender IDs", self.migrateMessageIDs),
+            (2, "chat and time index", self.migrateChatTimeIndex),
+            (3, "full-text message index", self.migrateMessageText),
+            (4, "media columns", self.migrateMedia),
+            (5, "alert rule table", self.migrateAlertTable),
+            (6, "message archive table", self.migrateArchiveTable),
+            (7, "update state table", self.migrateStateTable),
+            (8, "archived message table", self.migrateArchivedTable)
+        ]
+
+    def migrateMessageIDs(self, c):
+        # ADD COLUMN only rewrites the schema entry, existing rows are left as they are
+        columns = [row[1] for row in c.execute("PRAGMA table_info(" + self.messageTable + ")").fetchall()]
+        if "TelegramMessageID" not in columns:
+            c.execute("ALTER TABLE " + self.messageTable + " ADD COLUMN TelegramMessageID integer")
+            c.execute("ALTER TABLE " + self.messageTable + " ADD COLUMN SenderID integer")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS " + self.messageTable + "_ChatMessage ON " + self.messageTable + "(Chat, TelegramMessageID, Type)")
+
+    def migrateChatTimeIndex(self, c):
+        c.execute("CREATE INDEX IF NOT EXISTS " + self.messageTable + "_ChatTime ON " + self.messageTable + "(Chat, Time)")
+
+    def migrateMessageText(self, c):
+        # An external-content FTS5 table only stores the index, the triggers keep it in step with every insert
+        try:
+            c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS " + self.textTable + " USING fts5(Message, content='" + self.messageTable + "', content_rowid='ID')")
+        except sqlite3.OperationalError:
+            print("This SQLite build has no FTS5, search scans the message table instead")
+            return
+        c.execute("CREATE TRIGGER IF NOT EXISTS " + self.textTable + "_insert AFTER INSERT ON " + self.messageTable + " BEGIN INSERT INTO " + self.textTable + "(rowid, Message) VALUES (new.ID, new.Message); END")
+        c.execute("CREATE TRIGGER IF NOT EXISTS " + self.textTable + "_delete AFTER DELETE ON " + self.messageTable + " BEGIN INSERT INTO " + self.textTable + "(" + self.textTable + ", rowid, Message) VALUES ('delete', old.ID, old.Message); END")
+        c.execute("CREATE TRIGGER IF NOT EXISTS " + self.textTable + "_update AFTER UPDATE OF Message ON " + self.messageTable + " BEGIN INSERT INTO " + self.textTable + "(" + self.textTable + ", rowid, Message) VALUES ('delete', old.ID, old.Message); INSERT INTO " + self.textTable + "(rowid, Message) VALUES (new.ID, new.Message); END")
+        c.execute("INSERT INTO " + self.textTable + "(" + self.textTable + ") VALUES ('rebuild')")
+
+    def migrateMedia(self, c):
+        columns = [row[1] for row in c.execute("PRAGMA table_info(" + self.messageTable + ")").fetchall()]
+        if "MediaType" not in columns:
+            c.execute("ALTER TABLE " + self.messageTable + " ADD COLUMN MediaType text")
+            c.execute("ALTER TABLE " + self.messageTable + " ADD COLUMN MediaID integer")
+        c.execute("CREATE INDEX IF NOT EXISTS " + self.mediaTable + "_Hash ON " + self.mediaTable + "(Hash)")
+
+    def migrateAlertTable(self, c):
+        c.execute("CREATE TABLE IF NOT EXISTS " + self.alertTable + " " + self.tableStatements()["alert"]["statement"])
+
+    def migrateArchiveTable(self, c):
+        c.execute("CREATE TABLE IF NOT EXISTS " + self.archiveTable + " " + self.tableStatements()["archive"]["statement"])
+        c.execute("CREATE INDEX IF NOT EXISTS " + self.archiveTable + "_ChatTime ON " + self.archiveTable + "(Chat, FirstTime)")
+
+    def migrateStateTable(self, c):
+        c.execute("CREATE TABLE IF NOT EXISTS " + self.stateTable + " " + self.tableStatements()["state"]["statement"])
+
+    def migrateArchivedTable(self, c):
+        c.execute("CREATE TABLE IF NOT EXISTS " + self.archivedTable + " " + self.tableStatements()["archived"]["statement"])
+
+    def execute(self, sql, args=(), many=False):
+        with self.lock:
+            try:
+                if many:
+                    c = self.connection.executemany(sql, args)
+                else:
+                    c = self.connection.execute(sql, args)
+                rows = c.fetchall()
+                self.connection.commit()
+                return rows
+            except:
+                self.connection.rollback()
+                raise
+
+    def streamRows(self, sql, args, batchSize):
+        # A read-only connection of its own, WAL lets it read while the writer keeps inserting
+        connection = sqlite3.connect("file:" + self.path + "?mode=ro", uri=True)
+        try:
+            c = connection.execute(sql, args)
+            while True:
+                rows = c.fetchmany(batchSize)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            connection.close()
+
+    def executeBatches(self, batches):
+        with self.lock:
+            try:
+                for sql, rows in batches:
+                    if rows:
+                        self.connection.executemany(sql, rows)
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+
+    def upsertChats(self, chats):
+        if chats:
+            self.execute("INSERT INTO " + self.chatTable + "(ID, Title, Username) VALUES (?, ?, ?) ON CONFLICT(ID) DO UPDATE SET Title=excluded.Title, Username=excluded.Username", chats, many=True)
+
+    def deleteChats(self, ids):
+        if ids:
+            self.execute("DELETE FROM " + self.chatTable + " WHERE ID IN (" + ", ".join(["?"] * len(ids)) + ")", list(ids))
+
+    def insertMessages(self, rows):
+        rows = self.unarchivedRows(rows)
+        if rows:
+            senders, messages = self.splitRows(rows)
+            self.executeBatches([
+                ("INSERT INTO " + self.senderTable + "(ID, Name, Username) VALUES (?, ?, ?) ON CONFLICT(ID) DO UPDATE SET Name=excluded.Name, Username=excluded.Username", senders),
+                ("INSERT INTO " + self.messageTable + "(Time, Type, Chat, TelegramMessageID, SenderID, Message, MediaType, MediaID) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING", messages)
+            ])
+
+    def loadMonitoredChats(self):
+        rows = self.execute("SELECT ID, Title, Username FROM " + self.chatTable)
+        return {row[0]: [row[1], row[2]] for row in rows}
+
+    def searchMessages(self, query, chatID=None, type=None, since=None, until=None, limit=20, after=None):
+        terms = self.searchTerms(query)
+        conditions, args = self.searchFilters(chatID, type, since, until)
+        if not self.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (self.textTable,)):
+            return self.searchScan(terms, conditions, args, limit, after)
+        # Quoted terms are matched as plain words, bm25 is lower for better matches
+        match = " ".join('"' + term + '"' for term in terms)
+        ranked = ("SELECT round(-bm25(" + self.textTable + "), 6) AS Score, m.ID, m.Time, m.Type, m.Chat, s.Name, s.Username, m.Message FROM " + self.textTable
+                  + " JOIN " + self.messageTable + " m ON m.ID = " + self.textTable + ".rowid LEFT JOIN " + self.senderTable + " s ON s.ID = m.SenderID"
+                  " WHERE " + " AND ".join([self.textTable + " MATCH ?"] + conditions))
+        return self.searchPage(ranked, [match] + args, limit, after)
+
+    def loadBackfillCursors(self):
+        rows = self.execute("SELECT Chat, OffsetID, Done FROM " + self.backfillTable)
+        return {row[0]: [row[1], bool(row[2])] for row in rows}
+
+    def saveBackfillCursor(self, chatID, offsetID, done):
+        self.execute("INSERT INTO " + self.backfillTable + "(Chat, OffsetID, Done) VALUES (?, ?, ?) ON CONFLICT(Chat) DO UPDATE SET OffsetID=excluded.OffsetID, Done=excluded.Done", (chatID, offsetID, int(done)))
+
+    def saveUpdateState(self, rows):
+        if rows:
+            self.execute("INSERT INTO " + self.stateTable + "(Session, Chat, Pts, Qts, Date) VALUES (?, ?, ?, ?, ?) ON CONFLICT(Session, Chat) DO UPDATE SET Pts=excluded.Pts, Qts=excluded.Qts, Date=excluded.Date", rows, many=True)
+
+    def saveMedia(self, mediaID, hash, size, mimeType):
+        self.execute("INSERT INTO " + self.mediaTable + "(ID, Hash, Size, MimeType, Saved) VALUES (?, ?, ?, ?, ?) ON CONFLICT(ID) DO NOTHING", (mediaID, hash, size, mimeType, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+    def saveArchive(self, chatID, type, firstTime, lastTime, rows, file):
+        self.execute("INSERT INTO " + self.archiveTable + "(Chat, Type, FirstTime, LastTime, RowCount, File, Created) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(File) DO UPDATE SET RowCount=excluded.RowCount", (chatID, type, firstTime, lastTime, rows, file, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+    def markArchived(self, keys):
+        if keys:
+            self.execute("INSERT INTO " + self.archivedTable + "(Chat, TelegramMessageID, Type) VALUES (?, ?, ?) ON CONFLICT DO NOTHING", keys, many=True)
+            self.noteArchived(keys)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
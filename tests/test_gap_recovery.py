@@ -0,0 +1,133 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyrogram.api import functions, types
+import gap_recovery
+
+CHANNEL = 1001
+
+class FakeClient():
+
+    # Answers every request with the next prepared response and keeps the requests it got
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def send(self, query):
+        self.requests.append(query)
+        return self.responses.pop(0)
+
+class FakeStorage():
+
+    def __init__(self):
+        self.rows = []
+
+    def loadUpdateState(self):
+        return {}
+
+    def saveUpdateState(self, rows):
+        self.rows.extend(rows)
+
+def channel():
+    return types.Channel(id=CHANNEL, title="Channel", photo=types.ChatPhotoEmpty(), date=0, version=0, access_hash=1)
+
+def message(messageID):
+    return types.Message(id=messageID, to_id=types.PeerChannel(channel_id=CHANNEL), date=1500000000 + messageID, message="text " + str(messageID))
+
+def tooLong(pts, messages):
+    return types.updates.ChannelDifferenceTooLong(pts=pts, top_message=messages[-1].id, read_inbox_max_id=0, read_outbox_max_id=0, unread_count=0,
+                                                  unread_mentions_count=0, messages=messages, chats=[channel()], users=[], final=True)
+
+def newMessage(pts):
+    return types.UpdateNewChannelMessage(message=message(pts), pts=pts, pts_count=1)
+
+class RecoverChannelTest(unittest.TestCase):
+
+    def recovery(self, responses, record=None):
+        self.client = FakeClient(responses)
+        self.recorded = []
+        self.state = gap_recovery.UpdateState(FakeStorage(), self.fail)
+
+        def recordAll(records):
+            self.recorded.extend(records)
+            return len(records)
+
+        return gap_recovery.GapRecovery(self.state, {"main": self.client}, lambda chatID, session: types.InputPeerChannel(channel_id=chatID, access_hash=1),
+                                        lambda chat, message, users: {"messageID": message.id}, record or recordAll, lambda chatID, session: True, self.fail, pageSize=2)
+
+    def testUnknownChannelStartsFromItsDialog(self):
+        dialog = types.Dialog(peer=types.PeerChannel(channel_id=CHANNEL), top_message=50, read_inbox_max_id=0, read_outbox_max_id=0, unread_count=0,
+                              unread_mentions_count=0, notify_settings=types.PeerNotifySettingsEmpty(), pts=70)
+        recovery = self.recovery([types.messages.PeerDialogs(dialogs=[dialog], messages=[], chats=[channel()], users=[], state=types.updates.State(pts=1, qts=0, date=0, seq=0, unread_count=0))])
+        self.assertEqual(recovery.recoverChannel("main", CHANNEL), 0)
+        self.assertIsInstance(self.client.requests[0], functions.messages.GetPeerDialogs)
+        self.assertEqual(self.state.channel(CHANNEL), 70)
+
+    def testDifferencePagesUntilFinal(self):
+        recovery = self.recovery([
+            types.updates.ChannelDifference(pts=12, new_messages=[message(11), message(12)], other_updates=[], chats=[channel()], users=[]),
+            types.updates.ChannelDifference(pts=13, new_messages=[message(13)], other_updates=[], chats=[channel()], users=[], final=True)
+        ])
+        self.state.advance(gap_recovery.channelKey(CHANNEL), 10)
+        self.assertEqual(recovery.recoverChannel("main", CHANNEL), 3)
+        self.assertEqual([request.pts for request in self.client.requests], [10, 12])
+        self.assertEqual([record["messageID"] for record in self.recorded], [11, 12, 13])
+        self.assertEqual(self.state.channel(CHANNEL), 13)
+
+    def testEmptyDifference(self):
+        recovery = self.recovery([types.updates.ChannelDifferenceEmpty(pts=10, final=True)])
+        self.state.advance(gap_recovery.channelKey(CHANNEL), 10)
+        self.assertEqual(recovery.recoverChannel("main", CHANNEL), 0)
+        self.assertEqual(self.state.channel(CHANNEL), 10)
+
+    def testTooLongKeepsTheLatestMessages(self):
+        recovery = self.recovery([tooLong(900, [message(899), message(900)])])
+        self.state.advance(gap_recovery.channelKey(CHANNEL), 10)
+        self.assertEqual(recovery.recoverChannel("main", CHANNEL), 2)
+        self.assertEqual(self.state.channel(CHANNEL), 900)
+
+    def testFailedRecordDoesNotAdvance(self):
+
+        def failing(records):
+            raise IOError("Neither the database nor the journal took " + str(len(records)) + " messages")
+
+        recovery = self.recovery([tooLong(900, [message(900)])], failing)
+        self.state.advance(gap_recovery.channelKey(CHANNEL), 10)
+        recovery.logError = lambda *args: None
+        self.assertEqual(recovery.recover("main", CHANNEL), 0)
+        self.assertEqual(self.state.channel(CHANNEL), 10)
+
+class UpdateStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = gap_recovery.UpdateState(FakeStorage(), self.fail)
+        self.state.advance(gap_recovery.channelKey(CHANNEL), 10)
+
+    def testFinishedUpdatesAdvance(self):
+        for pts in (11, 12):
+            self.assertIsNone(self.state.observe("main", newMessage(pts)))
+        self.assertEqual(self.state.channel(CHANNEL), 10)
+        self.state.finish("main", newMessage(12))
+        self.assertEqual(self.state.channel(CHANNEL), 10)
+        self.state.finish("main", newMessage(11))
+        self.assertEqual(self.state.channel(CHANNEL), 12)
+
+    def testUnfinishedUpdateHoldsTheSequence(self):
+        for pts in (11, 12, 13):
+            self.state.observe("main", newMessage(pts))
+        self.state.finish("main", newMessage(11))
+        self.state.finish("main", newMessage(13))
+        self.assertEqual(self.state.channel(CHANNEL), 11)
+        self.state.advance(gap_recovery.channelKey(CHANNEL), 12)
+        self.assertEqual(self.state.channel(CHANNEL), 13)
+
+    def testGap(self):
+        self.assertEqual(self.state.observe("main", newMessage(15)), CHANNEL)
+        self.assertEqual(self.state.channel(CHANNEL), 10)
+
+if __name__ == "__main__":
+    unittest.main()
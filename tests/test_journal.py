@@ -0,0 +1,70 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import journal
+
+def rows(first, count):
+    return [["2020-01-01 00:00:00", "channel", 1, messageID, None, None, None, "text", None, None] for messageID in range(first, first + count)]
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def journal(self):
+        opened = journal.Journal(self.path).open()
+        self.addCleanup(opened.close)
+        return opened
+
+    def corrupt(self, offset):
+        # Flips a payload byte, the record keeps its length but fails its checksum
+        with open(os.path.join(self.path, "%012d.journal" % 1), "r+b") as file:
+            file.seek(offset + journal.HEADER.size + 5)
+            byte = file.read(1)
+            file.seek(-1, 1)
+            file.write(bytes([byte[0] ^ 0xFF]))
+
+    def write(self, *batches):
+        written = self.journal()
+        offsets = []
+        for batch in batches:
+            offsets.append(written.end[1])
+            written.append(batch)
+        written.close()
+        return offsets
+
+    def testOpenKeepsRecordsAfterACorruptOne(self):
+        offsets = self.write(rows(1, 2), rows(3, 2), rows(5, 2))
+        self.corrupt(offsets[1])
+        reopened = self.journal()
+        self.assertEqual(reopened.read(100)[0], rows(1, 2) + rows(5, 2))
+        self.assertEqual(reopened.corrupt, 1)
+
+    def testReadMovesPastACorruptRecord(self):
+        reopened = self.journal()
+        reopened.append(rows(1, 2))
+        reopened.acknowledge(reopened.read(100)[1])
+        start = reopened.end[1]
+        reopened.append(rows(3, 2))
+        reopened.sync()
+        self.corrupt(start)
+        self.assertEqual(reopened.read(100), ([], reopened.end))
+        reopened.acknowledge(reopened.end)
+        self.assertFalse(reopened.pending())
+
+    def testOpenTruncatesATornWrite(self):
+        self.write(rows(1, 2), rows(3, 2))
+        with open(os.path.join(self.path, "%012d.journal" % 1), "ab") as file:
+            file.write(journal.HEADER.pack(1000, 0) + b"[[")
+        reopened = self.journal()
+        self.assertEqual(reopened.read(100)[0], rows(1, 2) + rows(3, 2))
+        self.assertEqual(os.path.getsize(os.path.join(self.path, "%012d.journal" % 1)), reopened.end[1])
+
+if __name__ == "__main__":
+    unittest.main()
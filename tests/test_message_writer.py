@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import journal
+import message_writer
+
+class FakeStorage():
+
+    # Rejects every insert holding a row with no chat, like a foreign key violation would
+
+    def __init__(self, down=False):
+        self.down = down
+        self.rows = []
+        self.inserts = 0
+
+    def insertMessages(self, rows):
+        self.inserts += 1
+        if self.down or any(row[2] is None for row in rows):
+            raise IOError("rejected")
+        self.rows.extend(rows)
+
+    def schemaIsCurrent(self):
+        return not self.down
+
+def row(messageID, chatID=1):
+    return ["2020-01-01 00:00:00", "channel", chatID, messageID, None, None, None, "text", None, None]
+
+class StoreTest(unittest.TestCase):
+
+    def writer(self, storage):
+        self.errors = []
+        self.listened = []
+        writer = message_writer.MessageWriter(storage, self.errors.append)
+        writer.addListener(self.listened.extend)
+        return writer
+
+    def testOneBadRowOnlyLosesItself(self):
+        storage = FakeStorage()
+        writer = self.writer(storage)
+        batch = [row(1), row(2), row(3, None), row(4)]
+        self.assertTrue(writer.store(batch))
+        self.assertEqual([stored[3] for stored in storage.rows], [1, 2, 4])
+        self.assertEqual(self.listened, storage.rows)
+        self.assertEqual(len(self.errors), 1)
+        self.assertIn("message 3", self.errors[0])
+        self.assertEqual((writer.stats["rows"], writer.stats["failed"]), (3, 1))
+
+    def testDatabaseDownGivesUpAfterTheProbe(self):
+        storage = FakeStorage(down=True)
+        writer = self.writer(storage)
+        self.assertFalse(writer.store([row(messageID) for messageID in range(100)]))
+        self.assertEqual(storage.inserts, 1 + writer.probeRows)
+        self.assertEqual(writer.stats["failed"], 100)
+        with self.assertRaises(IOError):
+            writer.writeBatch([row(1)])
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.journal = journal.Journal(self.path).open()
+
+    def replay(self, storage, batch, seconds=5):
+        self.journal.append(batch)
+        writer = message_writer.MessageWriter(storage, lambda message: None, journal=self.journal, retryInterval=0.01, poisonRetries=2)
+        writer.start()
+        deadline = time.monotonic() + seconds
+        while self.journal.pending() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        writer.stop()
+        return writer
+
+    def testPoisonRowIsQuarantined(self):
+        storage = FakeStorage()
+        writer = self.replay(storage, [row(1), row(2, None), row(3)])
+        self.assertEqual([stored[3] for stored in storage.rows], [1, 3])
+        with open(os.path.join(self.path, "quarantine.jsonl")) as file:
+            self.assertEqual([json.loads(line) for line in file], [row(2, None)])
+        self.assertEqual((writer.stats["replayed"], writer.stats["quarantined"]), (2, 1))
+
+    def testNothingIsQuarantinedWhileTheDatabaseIsDown(self):
+        storage = FakeStorage(down=True)
+        writer = self.replay(storage, [row(1), row(2)], 0.3)
+        self.assertTrue(self.journal.pending())
+        self.assertFalse(os.path.exists(os.path.join(self.path, "quarantine.jsonl")))
+        self.assertEqual(writer.stats["quarantined"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
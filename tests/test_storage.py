@@ -0,0 +1,197 @@
+import contextlib
+import os
+import re
+import sys
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pymysql
+import pymysql_pool
+import storage
+
+TABLES = {tableType: tableType + "table" for tableType in ("chat", "message", "sender", "backfill", "schema", "media", "alert", "archive", "state", "archived")}
+
+class FakeServer():
+
+    # Just enough of a MySQL server for the schema code: the tables with their columns and indexes,
+    # and the notes and warnings the real server sends back for the same statements, raised the way
+    # pymysql 0.8.1 raises them
+
+    def __init__(self, version="8.0.34"):
+        self.version = version
+        self.tables = {}
+        self.versions = []
+        self.statements = []
+
+    def warn(self, code, message):
+        warnings.warn(pymysql.err.Warning(code, message), 4)
+
+    def define(self, name, statement):
+        columns = {}
+        indexes = set()
+        for part in re.split(r",\s*(?![^()]*\))", statement.strip()[1:-1]):
+            words = part.split()
+            if words[0] in ("PRIMARY", "FOREIGN"):
+                continue
+            if words[0] in ("UNIQUE", "KEY", "FULLTEXT"):
+                indexes.add(words[2] if words[0] != "KEY" else words[1])
+                continue
+            columns[words[0]] = words[1]
+        self.tables[name] = {"columns": columns, "indexes": indexes}
+
+    def execute(self, sql, args):
+        self.statements.append(sql)
+        match = re.match(r"SHOW TABLES LIKE (?:'(\w+)'|%s)$", sql)
+        if match:
+            name = match.group(1) or args[0]
+            return [(name,)] if name in self.tables else []
+        match = re.match(r"CREATE TABLE (IF NOT EXISTS )?(\w+) (.*)$", sql, re.DOTALL)
+        if match:
+            if match.group(2) in self.tables:
+                if match.group(1):
+                    self.warn(1050, "Table '" + match.group(2) + "' already exists")
+                    return []
+                raise pymysql.err.InternalError(1050, "Table '" + match.group(2) + "' already exists")
+            self.define(match.group(2), match.group(3))
+            return []
+        match = re.match(r"SELECT MAX\(Version\) FROM (\w+)$", sql)
+        if match:
+            if match.group(1) not in self.tables:
+                raise pymysql.err.ProgrammingError(1146, "Table '" + match.group(1) + "' doesn't exist")
+            return [(max(self.versions, default=None),)]
+        if sql.startswith("INSERT INTO " + TABLES["schema"]):
+            self.versions.append(args[0])
+            return []
+        match = re.match(r"SHOW COLUMNS FROM (\w+) LIKE '(\w+)'$", sql)
+        if match:
+            columns = self.tables[match.group(1)]["columns"]
+            return [(match.group(2), columns[match.group(2)])] if match.group(2) in columns else []
+        match = re.match(r"SHOW INDEX FROM (\w+) WHERE Key_name='(\w+)'$", sql)
+        if match:
+            return [(match.group(1), match.group(2))] if match.group(2) in self.tables[match.group(1)]["indexes"] else []
+        if sql.startswith("SELECT COUNT(*) FROM information_schema.PARTITIONS"):
+            return [(0,)]
+        if sql == "SELECT VERSION()":
+            return [(self.version,)]
+        match = re.match(r"ALTER TABLE (\w+) (.*)$", sql)
+        if match:
+            table = self.tables[match.group(1)]
+            for name in re.findall(r"ADD COLUMN (\w+)", match.group(2)):
+                table["columns"][name] = "added"
+            for kind, name in re.findall(r"ADD (UNIQUE |FULLTEXT )?INDEX (\w+)", match.group(2)):
+                if kind == "FULLTEXT " and "FTS_DOC_ID" not in table["columns"]:
+                    table["columns"]["FTS_DOC_ID"] = "bigint unsigned"
+                    self.warn(124, "InnoDB rebuilding table to add column FTS_DOC_ID")
+                table["indexes"].add(name)
+            return []
+        if sql.startswith("INSERT INTO "):
+            update = sql.partition("ON DUPLICATE KEY UPDATE")[2]
+            if "VALUES(" in update and tuple(int(part) for part in self.version.split("-")[0].split(".")) >= (8, 0, 20) and "MariaDB" not in self.version:
+                self.warn(1287, "'VALUES function' is deprecated and will be removed in a future release. Please use an alias (INSERT INTO ... VALUES (...) AS alias) and replace VALUES(col) in the ON DUPLICATE KEY UPDATE clause with alias.col instead")
+            return []
+        raise AssertionError("Unexpected statement: " + sql)
+
+class FakeCursor():
+
+    def __init__(self, server):
+        self.server = server
+        self.rows = []
+
+    def execute(self, sql, args=None):
+        self.rows = list(self.server.execute(sql, args))
+
+    def executemany(self, sql, rows):
+        for row in rows:
+            self.execute(sql, row)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+class FakeConnection():
+
+    def __init__(self, server):
+        self.server = server
+
+    def cursor(self, *args):
+        return FakeCursor(self.server)
+
+    def commit(self):
+        pass
+
+class FakePool():
+
+    def __init__(self, server):
+        self.server = server
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield FakeConnection(self.server)
+
+class FakeMySQLTest(unittest.TestCase):
+
+    def setUp(self):
+        # Test runners reset the warning filters, put back the ones pymysql_pool installs on import
+        filters = warnings.catch_warnings()
+        filters.__enter__()
+        self.addCleanup(filters.__exit__, None, None, None)
+        pymysql_pool.set_warning_filters()
+        self.server = FakeServer()
+        self.storage = storage.MySQLStorage(FakePool(self.server), TABLES)
+
+    def cursor(self):
+        return FakeCursor(self.server)
+
+class MySQLSchemaTest(FakeMySQLTest):
+
+    def testWarningsAreErrors(self):
+        self.server.define("existing", "(ID int)")
+        with self.assertRaises(pymysql.err.Warning):
+            self.cursor().execute("CREATE TABLE IF NOT EXISTS existing (ID int)")
+
+    def testAlertTableMigration(self):
+        self.storage.migrateAlertTable(self.cursor())
+        self.assertIn(TABLES["alert"], self.server.tables)
+        self.storage.migrateAlertTable(self.cursor())
+
+    def testArchiveTableMigrations(self):
+        for migrate, tableType in ((self.storage.migrateArchiveTable, "archive"), (self.storage.migrateArchivedTable, "archived")):
+            migrate(self.cursor())
+            self.assertIn(TABLES[tableType], self.server.tables)
+            migrate(self.cursor())
+
+    def testFullTextMigration(self):
+        self.server.define(TABLES["message"], "(ID int, Message text)")
+        self.storage.migrateMessageText(self.cursor())
+        self.assertIn("MessageText", self.server.tables[TABLES["message"]]["indexes"])
+
+    def testSchemaFromScratch(self):
+        self.storage.ensureSchema()
+        self.assertEqual(set(self.server.tables), set(TABLES.values()))
+        self.assertEqual(self.server.versions, [version for version, description, migration in self.storage.migrations()])
+        self.assertTrue(self.storage.schemaIsCurrent())
+
+    def testStateTableMigration(self):
+        self.storage.migrateStateTable(self.cursor())
+        self.assertIn(TABLES["state"], self.server.tables)
+        self.storage.migrateStateTable(self.cursor())
+
+class MySQLUpsertTest(FakeMySQLTest):
+
+    def testDeprecatedValuesFunction(self):
+        self.storage.upsertChats([(1, "Chat", None)])
+        self.storage.saveBackfillCursor(1, 100, False)
+        self.storage.saveUpdateState([("", 1, 10, 0, 0)])
+        self.assertEqual(len([sql for sql in self.server.statements if "VALUES(" in sql]), 3)
+
+    def testOtherWarningsStillRaise(self):
+        with self.assertRaises(pymysql.err.Warning):
+            self.server.warn(1265, "Data truncated for column 'Title' at row 1")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+from pyrogram.api.core import Object
+from io import BytesIO
+import gzip
+import struct
+import threading
+import time
+
+# A recording is a gzip stream of records, each one:
+#   double received time, uint32 user count, uint32 chat count,
+#   then the update, the users and the chats as length-prefixed TL serializations
+HEADER = struct.Struct("<dII")
+LENGTH = struct.Struct("<I")
+
+class UpdateRecorder():
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, "ab")
+        self.count = 0
+
+    def record(self, update, users, chats):
+        users = list(users.values())
+        chats = list(chats.values())
+        parts = [HEADER.pack(time.time(), len(users), len(chats))]
+        for item in [update] + users + chats:
+            data = item.write()
+            parts.append(LENGTH.pack(len(data)))
+            parts.append(data)
+        with self.lock:
+            self.file.write(b"".join(parts))
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        print("Update recorder closed - " + str(self.count) + " updates written to " + self.path)
+
+def readRecording(path):
+    # Yields (received, update, users, chats) in the shape RawUpdateHandler passes them
+    with gzip.open(path, "rb") as file:
+        while True:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            received, userCount, chatCount = HEADER.unpack(header)
+            objects = []
+            for i in range(1 + userCount + chatCount):
+                length = LENGTH.unpack(file.read(LENGTH.size))[0]
+                objects.append(Object.read(BytesIO(file.read(length))))
+            update = objects[0]
+            users = {user.id: user for user in objects[1:1 + userCount]}
+            chats = {chat.id: chat for chat in objects[1 + userCount:]}
+            yield received, update, users, chats